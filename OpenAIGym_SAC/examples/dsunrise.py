@@ -31,8 +31,19 @@ def parse_args():
     # train
     parser.add_argument('--batch_size', default=256, type=int)
     parser.add_argument('--save_freq', default=100, type=int)
+    parser.add_argument('--async_checkpoints', action='store_true', help='Write the model and replay buffer checkpoints on a background thread')
     parser.add_argument('--computation_device', default='cpu', type=str)
+    parser.add_argument('--prefetch_batches', default=0, type=int, help='Sample this many training batches ahead on a background thread')
+    parser.add_argument('--pin_memory', action='store_true', help='Prefetch the batches into pinned memory')
+    parser.add_argument('--batches_per_gather', default=1, type=int, help='Sample the training batches this many at a time from the replay buffer')
     parser.add_argument('--epochs', default=1000, type=int)
+    parser.add_argument('--observation_dtype', default='float32', choices=['float32', 'float16', 'bfloat16'], help='Storage dtype of the observations in the replay buffer')
+    parser.add_argument('--single_copy_obs', action='store_true', help='Store every observation once in the replay buffer instead of as observation and next observation (not with --num_envs > 1)')
+    parser.add_argument('--buffer_storage', default='memory', choices=['memory', 'memmap', 'torch'], help='Keep the replay buffer in RAM, in memory-mapped files in the buffer directory or in tensors on the computation device')
+    parser.add_argument('--incremental_buffer_checkpoints', action='store_true', help='Only write the transitions added since the last replay buffer checkpoint (always the case with memmap storage)')
+    parser.add_argument('--keep_last_checkpoints', default=None, type=int, help='Delete all replay buffer checkpoints but the last this many...')
+    parser.add_argument('--keep_checkpoint_every', default=None, type=int, help='...and those at multiples of this many epochs')
+    parser.add_argument('--member_sampling', action='store_true', help='Train each member on a batch drawn only from the transitions in its bootstrap mask')
 
     # misc
     parser.add_argument('--seed', default=1, type=int)
@@ -42,13 +53,21 @@ def parse_args():
 
     # env
     parser.add_argument('--env', default="Ant-v5", type=str)
+    parser.add_argument('--num_envs', default=1, type=int, help='Explore with a vector env of this many environments stepped in lockstep')
+    parser.add_argument('--async_envs', action='store_true', help='Step the exploration environments in subprocesses')
     
     # ensemble
     parser.add_argument('--num_ensemble', default=10, type=int)
     parser.add_argument('--ber_mean', default=0.5, type=float)
+    parser.add_argument('--vectorized_ensemble', action='store_true', help='Store the ensemble as stacked networks evaluated with batched matmuls')
+    parser.add_argument('--flat_parameters', action='store_true', help='Keep the parameters of each network role in one contiguous buffer')
+    parser.add_argument('--numpy_inference', action='store_true', help='Run the single observation policy forward of rollouts in NumPy')
+    parser.add_argument('--max_num_ensemble', default=None, type=int, help='Preallocate the ensemble for this many learners, so that learners can be added')
+    parser.add_argument('--add_learner_frequency', default=None, type=int, help='Add a copy of the best performing learner every this many steps, up to max_num_ensemble learners')
     
     # inference
     parser.add_argument('--inference_type', default=0.0, type=float) # Default to UCB exploration
+    parser.add_argument('--eval_aggregation', default='mean', choices=['mean', 'median', 'ucb', 'vote'], help='How the actions of the ensemble are combined for evaluation')
     
     # corrective feedback
     parser.add_argument('--temperature', default=20.0, type=float)
@@ -71,6 +90,10 @@ def parse_args():
     
 
 def experiment(variant):
+    if variant['single_copy_obs'] and variant['num_envs'] > 1:
+        # The sub-environments' steps are written interleaved, so no row links to the next one and every next
+        # observation would go to the side table
+        raise ValueError("--single_copy_obs is not supported with --num_envs > 1")
     expl_env = NormalizedBoxEnv(gym.make(variant['env']))
     eval_env = NormalizedBoxEnv(gym.make(variant['env']))
     
@@ -88,31 +111,13 @@ def experiment(variant):
         variant['performance_gamma'],
         variant['window_size'],
         variant['noise'],
-        variant['retrain_steps']
+        variant['retrain_steps'],
+        vectorized=variant['vectorized_ensemble'],
+        flat_parameters=variant['flat_parameters'],
+        numpy_inference=variant['numpy_inference'],
+        max_size=variant['max_num_ensemble'],
     )
 
-    eval_path_collector = DynamicEnsembleMdpPathCollector(
-        eval_env,
-        ensemble,
-        eval_flag=True,
-    )
-    
-    expl_path_collector = DynamicEnsembleMdpPathCollector(
-        expl_env,
-        ensemble,
-        ber_mean=variant['ber_mean'],
-        eval_flag=False,
-        inference_type=variant['inference_type'],
-        feedback_type=1,
-    )
-    
-    replay_buffer = DynamicEnsembleEnvReplayBuffer(
-        variant['replay_buffer_size'],
-        expl_env,
-        len(ensemble),
-        log_dir=variant['log_dir'],
-    )
-    
     trainer = DSunriseTrainer(
         env=eval_env,
         ensemble=ensemble,
@@ -124,6 +129,8 @@ def experiment(variant):
         **variant['trainer_kwargs']
     )
 
+    start_epoch = 0
+    loaded_epoch = None
     if variant['resume_dir']:
         print(f"Resuming from {variant['resume_dir']}")
 
@@ -134,14 +141,73 @@ def experiment(variant):
                 if match:
                     epoch_numbers.append(int(match.group(1)))
 
-            # Find the highest epoch number
-            highest_epoch = sorted(epoch_numbers, reverse=True) if epoch_numbers else 0
-            return highest_epoch
+            # Epoch numbers from the highest down
+            return sorted(set(epoch_numbers), reverse=True)
+
+        # Only epochs that have a replay buffer checkpoint too: a run can stop between writing the models and the
+        # buffer of an epoch, and retention deletes the buffers of older epochs
+        buffer_dir = os.path.join(variant['resume_dir'], 'buffer')
+        buffer_files = os.listdir(buffer_dir) if os.path.isdir(buffer_dir) else []
+        buffer_epochs = set(highest_epoch(f for f in buffer_files if f.startswith('replay_'))) & set(
+            highest_epoch(f for f in buffer_files if f.startswith('policy_rewards_')))
+        epochs = [
+            epoch for epoch in highest_epoch(os.listdir(os.path.join(variant['resume_dir'], 'model')))
+            if epoch in buffer_epochs
+        ]
 
-        trainer.load_models(highest_epoch(os.listdir(os.path.join(variant['resume_dir'], 'model'))))
-        replay_buffer.load_buffer(highest_epoch(os.listdir(os.path.join(variant['resume_dir'], 'buffer'))))
+        # Before the replay buffer is made, as the checkpoint may hold another number of members
+        loaded_epoch = trainer.load_models(epochs)
+        if loaded_epoch is None:
+            raise FileNotFoundError(f"No epoch in {variant['resume_dir']} has both a model and a replay buffer checkpoint")
 
+    eval_path_collector = DynamicEnsembleMdpPathCollector(
+        eval_env,
+        ensemble,
+        eval_flag=True,
+        eval_aggregation=variant['eval_aggregation'],
+    )
+    
+    replay_buffer = DynamicEnsembleEnvReplayBuffer(
+        variant['replay_buffer_size'],
+        expl_env,
+        len(ensemble),
+        log_dir=variant['log_dir'],
+        observation_dtype=variant['observation_dtype'],
+        single_copy_obs=variant['single_copy_obs'],
+        storage=variant['buffer_storage'],
+        incremental_checkpoints=variant['incremental_buffer_checkpoints'],
+        keep_last_checkpoints=variant['keep_last_checkpoints'],
+        keep_checkpoint_every=variant['keep_checkpoint_every'],
+        member_sampling=variant['member_sampling'],
+        performance_window_size=variant['window_size'],
+        performance_gamma=variant['performance_gamma'],
+        max_num_ensemble=ensemble.max_size,
+    )
 
+    if loaded_epoch is not None:
+        # The buffer of the same epoch, so that its mask matches the members. The warm-up is skipped on resume, so
+        # training can not start from an empty buffer.
+        if replay_buffer.load_buffer([loaded_epoch]) is None:
+            raise FileNotFoundError(f"The replay buffer checkpoint of epoch {loaded_epoch} could not be loaded")
+        start_epoch = loaded_epoch + 1
+
+    expl_collector_env = expl_env
+    if variant['num_envs'] > 1:
+        vector_env_class = gym.vector.AsyncVectorEnv if variant['async_envs'] else gym.vector.SyncVectorEnv
+        expl_collector_env = vector_env_class(
+            [lambda: NormalizedBoxEnv(gym.make(variant['env']))] * variant['num_envs']
+        )
+
+    expl_path_collector = DynamicEnsembleMdpPathCollector(
+        expl_collector_env,
+        ensemble,
+        ber_mean=variant['ber_mean'],
+        eval_flag=False,
+        inference_type=variant['inference_type'],
+        feedback_type=1,
+        replay_buffer=replay_buffer,
+    )
+    
     algorithm = DynamicTorchBatchRLAlgorithm(
         trainer=trainer,
         ensemble=ensemble,
@@ -155,7 +221,7 @@ def experiment(variant):
     )
     
     algorithm.to(ptu.device)
-    algorithm.train()
+    algorithm.train(start_epoch=start_epoch)
 
 
 if __name__ == "__main__":
@@ -167,6 +233,13 @@ if __name__ == "__main__":
         version="normal",
         layer_size=256,
         replay_buffer_size=int(1E6),
+        observation_dtype=args.observation_dtype,
+        single_copy_obs=args.single_copy_obs,
+        buffer_storage=args.buffer_storage,
+        incremental_buffer_checkpoints=args.incremental_buffer_checkpoints,
+        keep_last_checkpoints=args.keep_last_checkpoints,
+        keep_checkpoint_every=args.keep_checkpoint_every,
+        member_sampling=args.member_sampling,
         algorithm_kwargs=dict(
             num_epochs=args.epochs,
             num_eval_steps_per_epoch=1000,
@@ -176,8 +249,13 @@ if __name__ == "__main__":
             max_path_length=1000,
             batch_size=args.batch_size,
             save_frequency=args.save_freq,
+            async_checkpoints=args.async_checkpoints,
+            prefetch_batches=args.prefetch_batches,
+            pin_memory=args.pin_memory,
+            batches_per_gather=args.batches_per_gather,
             removal_check_frequency=args.removal_check_frequency,
-            removal_check_buffer_size=args.removal_check_buffer_size
+            removal_check_buffer_size=args.removal_check_buffer_size,
+            add_learner_frequency=args.add_learner_frequency,
         ),
         trainer_kwargs=dict(
             discount=0.99,
@@ -189,11 +267,18 @@ if __name__ == "__main__":
             use_automatic_entropy_tuning=True,
         ),
         num_ensemble=args.num_ensemble,
+        vectorized_ensemble=args.vectorized_ensemble,
+        flat_parameters=args.flat_parameters,
+        numpy_inference=args.numpy_inference,
+        max_num_ensemble=args.max_num_ensemble,
         num_layer=args.num_layer,
         seed=args.seed,
         ber_mean=args.ber_mean,
         env=args.env,
+        num_envs=args.num_envs,
+        async_envs=args.async_envs,
         inference_type=args.inference_type,
+        eval_aggregation=args.eval_aggregation,
         temperature=args.temperature,
         diversity_threshold = args.diversity_threshold,
         diversity_critical_threshold = args.diversity_critical_threshold,
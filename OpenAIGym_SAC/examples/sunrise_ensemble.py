@@ -1,8 +1,15 @@
 from rlkit.torch.sac.policies import TanhGaussianPolicy, MakeDeterministic
-from rlkit.torch.networks import FlattenMlp
+from rlkit.torch.sac.policies import EnsembleTanhGaussianPolicy, EnsembleMemberPolicy
+from rlkit.torch.networks import FlattenMlp, EnsembleFlattenMlp, EnsembleMember, ParameterArena
+import rlkit.torch.pytorch_util as ptu
 import torch
 import numpy as np
 
+# Number of pairwise action distances evaluated at once by compute_diversity_matrix
+DIVERSITY_CHUNK_SIZE = 2 ** 20
+# Number of observations evaluated at once by get_all_actions
+ACTION_CHUNK_SIZE = 2048
+
 class Ensemble:
     def __init__(
             self,
@@ -17,63 +24,152 @@ class Ensemble:
             window_size,
             noise,
             retrain_steps,
+            vectorized=False,
+            flat_parameters=False,
+            numpy_inference=False,
+            max_size=None,
         ):
+        """
+        If vectorized is True the networks of all the learners are stored as single stacked modules
+        (self.policy, self.qf1, self.qf2, self.target_qf1, self.target_qf2) that evaluate the whole ensemble
+        with batched matmuls. The per learner lists returned by the getters then hold views into those modules,
+        so code written against individual learners keeps working.
+
+        If flat_parameters is True the parameters of each network role are additionally stored in one contiguous
+        ParameterArena (self.arenas), which turns soft target updates, mutation noise and checkpoint snapshots
+        into single tensor operations.
+
+        If numpy_inference is True the single observation get_action of the policies runs its forward in NumPy
+        (see TanhGaussianInference), which is faster for small networks on the CPU.
+
+        max_size is the number of learners the ensemble can grow to with add_learner (starting_size by default).
+        The stacked modules, the arenas and the trainer's optimizer state are allocated for that many learners up
+        front, so adding and removing learners resizes them in place.
+        """
 
         self.diversity_threshold = diversity_threshold
         self.diversity_critical_threshold = diversity_critical_threshold
         self.performance_gamma = performance_gamma
-        self.window_size = window_size
+        self.window_size = int(window_size)
         self.noise = noise
         self.retrain_steps = retrain_steps
+        self.max_size = max(starting_size, max_size or 0)
+        # compute_performance weights, oldest return first
+        performance_weights = performance_gamma ** np.arange(self.window_size - 1, -1, -1)
+        self._performance_weights = performance_weights / performance_weights.sum()
         
 
         obs_dim = obs_space.shape[0]
         action_dim = action_space.shape[0]
         self.max_dist = np.sqrt(np.sum((action_space.high - action_space.low)**2))
+        # The samples, actions and diversity matrix of the last removal_check, which replace_policy updates
+        self._diversity_samples, self._diversity_actions, self.diversity_matrix = None, None, None
+
+        self.obs_dim = obs_dim
+        self.action_dim = action_dim
+        self.network_structure = network_structure
+        self.vectorized = vectorized
+        self.policy, self.qf1, self.qf2, self.target_qf1, self.target_qf2 = None, None, None, None, None
 
         self.L_qf1, self.L_qf2, self.L_target_qf1, self.L_target_qf2, self.L_policy, self.L_eval_policy = [], [], [], [], [], []
 
+        if vectorized:
+            self._build_vectorized(starting_size, obs_dim, action_dim, network_structure)
+            self._build_arenas(flat_parameters)
+            self._set_numpy_inference(numpy_inference)
+            return
+
         for idx in range(starting_size):
+            self._append_learner(*self._build_learner(idx))
 
-            qf1 = FlattenMlp(
-                input_size=obs_dim + action_dim,
-                output_size=1,
-                hidden_sizes=network_structure,
-            )
-            qf2 = FlattenMlp(
-                input_size=obs_dim + action_dim,
-                output_size=1,
-                hidden_sizes=network_structure,
-            )
-            target_qf1 = FlattenMlp(
-                input_size=obs_dim + action_dim,
+        self._build_arenas(flat_parameters)
+        self._set_numpy_inference(numpy_inference)
+
+    def _build_learner(self, idx):
+        """
+        New networks of one learner: qf1, qf2, target_qf1, target_qf2 and the policy.
+        """
+        critics = [
+            FlattenMlp(
+                input_size=self.obs_dim + self.action_dim,
                 output_size=1,
-                hidden_sizes=network_structure,
+                hidden_sizes=self.network_structure,
             )
-            target_qf2 = FlattenMlp(
+            for _ in range(4)
+        ]
+        policy = TanhGaussianPolicy(
+            obs_dim=self.obs_dim,
+            action_dim=self.action_dim,
+            hidden_sizes=self.network_structure,
+            id = idx,
+            init_w=1
+        )
+        return critics + [policy]
+
+    def _append_learner(self, qf1, qf2, target_qf1, target_qf2, policy):
+        self.L_qf1.append(qf1)
+        self.L_qf2.append(qf2)
+        self.L_target_qf1.append(target_qf1)
+        self.L_target_qf2.append(target_qf2)
+        self.L_policy.append(policy)
+        self.L_eval_policy.append(MakeDeterministic(policy))
+
+    def _set_numpy_inference(self, numpy_inference):
+        self.numpy_inference = numpy_inference
+        for policy in self.L_policy:
+            policy.numpy_inference = numpy_inference
+
+    def _build_vectorized(self, starting_size, obs_dim, action_dim, network_structure):
+        critics = [
+            EnsembleFlattenMlp(
+                starting_size,
                 input_size=obs_dim + action_dim,
                 output_size=1,
                 hidden_sizes=network_structure,
+                capacity=self.max_size,
             )
-            policy = TanhGaussianPolicy(
-                obs_dim=obs_dim,
-                action_dim=action_dim,
-                hidden_sizes=network_structure,
-                id = idx,
-                init_w=1
-            )
-            eval_policy = MakeDeterministic(policy)
-            
-            self.L_qf1.append(qf1)
-            self.L_qf2.append(qf2)
-            self.L_target_qf1.append(target_qf1)
-            self.L_target_qf2.append(target_qf2)
-            self.L_policy.append(policy)
-            self.L_eval_policy.append(eval_policy)
+            for _ in range(4)
+        ]
+        self.qf1, self.qf2, self.target_qf1, self.target_qf2 = critics
+        self.policy = EnsembleTanhGaussianPolicy(
+            starting_size,
+            obs_dim=obs_dim,
+            action_dim=action_dim,
+            hidden_sizes=network_structure,
+            init_w=1,
+            capacity=self.max_size,
+        )
+
+        for idx in range(starting_size):
+            self._append_member_views(idx)
+
+    def _append_member_views(self, idx):
+        self._append_learner(*[
+            EnsembleMember(network, idx) for network in [self.qf1, self.qf2, self.target_qf1, self.target_qf2]
+        ], EnsembleMemberPolicy(self.policy, idx, id=idx))
+
+    def _role_networks(self):
+        if self.vectorized:
+            return dict(policy=self.policy, qf1=self.qf1, qf2=self.qf2, target_qf1=self.target_qf1, target_qf2=self.target_qf2)
+        return dict(policy=self.L_policy, qf1=self.L_qf1, qf2=self.L_qf2, target_qf1=self.L_target_qf1, target_qf2=self.L_target_qf2)
+
+    def _build_arenas(self, flat_parameters):
+        self.arenas = None
+        if flat_parameters:
+            self.arenas = {
+                role: ParameterArena(networks, device=ptu.device, capacity=self.max_size)
+                for role, networks in self._role_networks().items()
+            }
 
     def __len__(self):
         return len(self.L_qf1)
 
+    def get_networks(self):
+        """
+        The stacked modules holding the weights of the whole ensemble (vectorized only).
+        """
+        return [self.policy, self.qf1, self.qf2, self.target_qf1, self.target_qf2]
+
     def get_policies(self):
         return self.L_policy
 
@@ -91,6 +187,119 @@ class Ensemble:
     def get_target_critic2s(self):
         return self.L_target_qf2
 
+    def policy_forward(self, obs, **kwargs):
+        """
+        Evaluate the policy of every learner on the same observations.
+        Args:
+            obs: tensor of shape (batch, obs_dim), or (num_learners, batch, obs_dim) to evaluate learner i on obs[i]
+            kwargs: passed on to the policy forward
+        Returns:
+            the TanhGaussianPolicy outputs with a leading ensemble dimension (None outputs stay None)
+        """
+        if self.vectorized:
+            return self.policy(obs, **kwargs)
+
+        observations = obs if obs.dim() == 3 else [obs] * len(self)
+        outputs = [policy(member_obs, **kwargs) for policy, member_obs in zip(self.L_policy, observations)]
+        return tuple(
+            None if output[0] is None else torch.stack(output)
+            for output in zip(*outputs)
+        )
+
+    def get_member_actions(self, obs, members, deterministic=False):
+        """
+        Pick an action for every observation with the policy of its own learner, in one batched call.
+        Args:
+            obs: np.array of shape (batch, obs_dim)
+            members: np.array of learner indices of shape (batch,)
+            deterministic: use the mean action instead of sampling
+        Returns:
+            np.array of shape (batch, action_dim)
+        """
+        obs = ptu.from_numpy(obs)
+        with torch.no_grad():
+            if self.vectorized:
+                members = torch.as_tensor(members, device=obs.device)
+                actions = self.policy(obs, deterministic=deterministic, member=members)[0]
+            else:
+                actions = obs.new_empty(obs.shape[0], self.action_dim)
+                for member in np.unique(members):
+                    rows = torch.as_tensor(members == member, device=obs.device)
+                    actions[rows] = self.L_policy[member](obs[rows], deterministic=deterministic)[0]
+        return ptu.get_numpy(actions)
+
+    def get_all_actions(self, observations, chunk_size=ACTION_CHUNK_SIZE):
+        """
+        The deterministic (eval policy) action of every learner on every observation, with one batched forward of
+        the ensemble per chunk of observations.
+        Args:
+            observations: np.array of shape (num_states, obs_dim)
+            chunk_size: number of observations evaluated at once, which bounds the memory of the activations
+        Returns:
+            np.array of shape (num_learners, num_states, action_dim)
+        """
+        obs = ptu.from_numpy(np.asarray(observations))
+        with torch.inference_mode():
+            actions = torch.cat([
+                self.policy_forward(chunk, deterministic=True)[0] for chunk in obs.split(chunk_size)
+            ], dim=1)
+        return ptu.get_numpy(actions)
+
+    def critic_forward(self, obs, actions, target=False):
+        """
+        Evaluate both critics of every learner on the observations and that learner's own actions.
+        Args:
+            obs: tensor of shape (batch, obs_dim), or (num_learners, batch, obs_dim) to evaluate learner i on obs[i]
+            actions: tensor of shape (num_learners, batch, action_dim), or (batch, action_dim) to evaluate every
+                learner on the same actions
+            target: use the target critics instead
+        Returns:
+            (Q1, Q2), each of shape (num_learners, batch, 1)
+        """
+        if self.vectorized:
+            qf1, qf2 = (self.target_qf1, self.target_qf2) if target else (self.qf1, self.qf2)
+            return qf1(obs, actions), qf2(obs, actions)
+
+        L_qf1, L_qf2 = (self.L_target_qf1, self.L_target_qf2) if target else (self.L_qf1, self.L_qf2)
+        observations = obs if obs.dim() == 3 else [obs] * len(self)
+        if actions.dim() == 2:
+            actions = [actions] * len(self)
+        Q1 = torch.stack([qf1(member_obs, action) for qf1, member_obs, action in zip(L_qf1, observations, actions)])
+        Q2 = torch.stack([qf2(member_obs, action) for qf2, member_obs, action in zip(L_qf2, observations, actions)])
+        return Q1, Q2
+
+    def soft_update_targets(self, tau):
+        """
+        Polyak average the critics of every learner into their target critics.
+        Args:
+            tau: weight of the critics
+        """
+        if self.arenas is not None:
+            self.arenas['target_qf1'].soft_update_from(self.arenas['qf1'], tau)
+            self.arenas['target_qf2'].soft_update_from(self.arenas['qf2'], tau)
+        elif self.vectorized:
+            ptu.soft_update_from_to(self.qf1, self.target_qf1, tau)
+            ptu.soft_update_from_to(self.qf2, self.target_qf2, tau)
+        else:
+            for qf, target_qf in zip(self.L_qf1 + self.L_qf2, self.L_target_qf1 + self.L_target_qf2):
+                ptu.soft_update_from_to(qf, target_qf, tau)
+
+    def get_parameter_snapshot(self):
+        """
+        Copy of the flat parameters of every network role (flat_parameters only).
+        Returns:
+            dict from role name to a tensor of shape (num_learners, num_params)
+        """
+        return {role: arena.snapshot() for role, arena in self.arenas.items()}
+
+    def load_parameter_snapshot(self, snapshot):
+        """
+        Load a snapshot taken by get_parameter_snapshot from an ensemble of the same size and architecture.
+        """
+        with torch.no_grad():
+            for role, arena in self.arenas.items():
+                arena.load_snapshot(snapshot[role])
+
     def compute_performance(self, returns) -> float:
         """
         Compute the performance metric for each learner in the ensemble.
@@ -103,9 +312,7 @@ class Ensemble:
             print(f"Not enough returns to compute performance, expected {self.window_size}, got {len(returns)}")
             return 1.0
 
-        weights = np.array([self.performance_gamma ** (self.window_size - 1 - i) for i in range(self.window_size)])
-        weights /= weights.sum()
-        performance = np.dot(returns[-self.window_size:].squeeze(), weights)
+        performance = np.dot(returns[-self.window_size:].squeeze(), self._performance_weights)
         return performance
 
     def compute_diversity(self, policy_actions, learner_idx):
@@ -114,46 +321,73 @@ class Ensemble:
         Returns a measure from 0 to 1 indicating how similar the actions of two policies are. It will find the closest policy and so that diversity is effectively a single linkage calculation.
 
         Args:
-            policy_actions: list of np.arrays, each of shape (num_states, action_dim), one per policy
+            policy_actions: np.array of shape (num_policies, num_states, action_dim), or a list of one
+                (num_states, action_dim) array per policy
             learner_idx: index of the learner to compute diversity for
 
         Returns:
             max_diversity: float, maximum diversity (1 - normalized L2 distance) to another policy
         """
-        a_i = policy_actions[learner_idx]  # shape: (num_states, action_dim)
+        return np.min(self._diversity_row(np.asarray(policy_actions), learner_idx))
 
-        diversities = [
-            (np.mean(np.linalg.norm(a_i - a_j, axis=1)) / self.max_dist)
-            for j, a_j in enumerate(policy_actions)
-            if j != learner_idx
-        ]
-
-        return np.min(diversities)
+    def _diversity_row(self, policy_actions, learner_idx):
+        """
+        The normalized mean action distance of learner_idx to every policy, inf to itself.
+        """
+        row = np.linalg.norm(policy_actions - policy_actions[learner_idx], axis=-1).mean(axis=-1) / self.max_dist
+        row[learner_idx] = np.inf
+        return row
 
-    def removal_check(self, samples, returns):
+    def compute_diversity_matrix(self, policy_actions):
+        """
+        The normalized mean action distance between every pair of policies, as batched per state distance matrices
+        over chunks of the states.
+        Args:
+            policy_actions: np.array of shape (num_policies, num_states, action_dim)
+        Returns:
+            np.array of shape (num_policies, num_policies) with inf on the diagonal, so that the minimum of row i
+            is compute_diversity(policy_actions, i)
+        """
+        num_policies, num_states, _ = policy_actions.shape
+        actions = torch.as_tensor(policy_actions).transpose(0, 1)
+        chunk_size = max(1, DIVERSITY_CHUNK_SIZE // (num_policies * num_policies))
+        distances = sum(
+            # Exact differences rather than the matmul expansion, which loses close policies to cancellation
+            torch.cdist(chunk, chunk, compute_mode='donot_use_mm_for_euclid_dist').sum(dim=0)
+            for chunk in actions.split(chunk_size)
+        )
+        diversity = distances.double().numpy() / num_states / self.max_dist
+        np.fill_diagonal(diversity, np.inf)
+        return diversity
+
+    def removal_check(self, samples, performances):
         """
         Check to see if any of the learners are too similar and could be removed.
+        Args:
+            samples: np.array of observations, of shape (num_states, obs_dim)
+            performances: the performance of every learner, e.g. from the PerformanceTracker of the replay buffer
+                (the same as compute_performance of the learner's returns)
         """
 
-        policy_actions = [
-            policy.get_actions(samples)  # Use batch processing to get actions
-            for policy in self.L_eval_policy
-        ]
+        policy_actions = self.get_all_actions(samples)
 
-        performances = [self.compute_performance(returns[i]) for i in range(len(self.L_eval_policy))]
+        performances = list(performances)
 
-        diversities = [self.compute_diversity(policy_actions, i) for i in range(len(self.L_eval_policy))]
+        self._diversity_samples, self._diversity_actions = samples, policy_actions
+        self.diversity_matrix = self.compute_diversity_matrix(policy_actions)
+        diversities = self.diversity_matrix.min(axis=1)
 
         # Find policies with low diversity
-        close_policies = [i for i, div in enumerate(diversities) if div < self.diversity_threshold and div == min(diversities)]
+        min_diversity = diversities.min()
+        close_policies = [i for i, div in enumerate(diversities) if div < self.diversity_threshold and div == min_diversity]
 
         worst_performaning_policy = sorted([(i, perf) for i, perf in enumerate(performances) if i in close_policies], key=lambda x: x[1], reverse=True)
 
         # Remove the worst performing policy
         if len(worst_performaning_policy) == 0:
-            return None, {"performances": performances, "diversities": diversities}
+            return None, {"performances": performances, "diversities": list(diversities)}
         if len(worst_performaning_policy) > 0:
-            return worst_performaning_policy[0][0], {"performances": performances, "diversities": diversities}
+            return worst_performaning_policy[0][0], {"performances": performances, "diversities": list(diversities)}
 
     def replace_policy(self, policy_index, samples, train_function, sampler):
         """
@@ -164,23 +398,28 @@ class Ensemble:
         Firstly apply gaussian noise to the policy parameters.
 
         Secondly retrain on a set of transitions for a certain number of steps
+
+        On the samples of the last removal_check only the actions of the replaced policy are recomputed, and only
+        its row and column of the diversity matrix.
         """
 
-        with torch.no_grad():
-            for param in self.L_policy[policy_index].parameters():
-                noise = torch.randn_like(param) * self.noise
-                param.add_(noise)
+        self._perturb_policy(policy_index)
 
         for _ in range(self.retrain_steps):
             train_function(sampler(), policy_index)
 
-        
-        policy_actions = [
-            policy.get_actions(samples)  # Use batch processing to get actions
-            for policy in self.L_eval_policy
-        ]
+        if samples is self._diversity_samples:
+            with torch.inference_mode():
+                self._diversity_actions[policy_index] = self.L_eval_policy[policy_index].get_actions(samples)
+            row = self._diversity_row(self._diversity_actions, policy_index)
+            self.diversity_matrix[policy_index, :] = row
+            self.diversity_matrix[:, policy_index] = row
+        else:
+            self._diversity_samples = samples
+            self._diversity_actions = self.get_all_actions(samples)
+            self.diversity_matrix = self.compute_diversity_matrix(self._diversity_actions)
 
-        div = self.compute_diversity(policy_actions, policy_index)
+        div = self.diversity_matrix[policy_index].min()
 
         if div < self.diversity_critical_threshold:
             print(f"Policy {policy_index} after mutation and retraining has a diversity of {div} which is below the threshold {self.diversity_critical_threshold}")
@@ -190,6 +429,68 @@ class Ensemble:
         else:
             return None, div
 
+    def _perturb_policy(self, policy_index):
+        """
+        Apply gaussian noise to the policy parameters.
+        """
+        with torch.no_grad():
+            if self.arenas is not None:
+                params = self.arenas['policy'].member(policy_index)
+                params.add_(torch.randn_like(params) * self.noise)
+            else:
+                for param in self.L_policy[policy_index].parameters():
+                    noise = torch.randn_like(param) * self.noise
+                    param.add_(noise)
+
+    def add_learner(self, source_index):
+        """
+        Add a learner to the ensemble that starts as a copy of learner source_index (e.g. the best performing one)
+        with gaussian noise applied to its policy parameters, as a replaced policy.
+
+        The stacked modules and arenas grow in place within max_size, and the learner lists (which the trainer and
+        the path collectors read) are appended to. On the samples of the last removal_check the diversity matrix
+        gains the new learner's row and column.
+        Args:
+            source_index: index of the learner to copy
+        Returns:
+            index of the new learner, the last one
+        """
+        if len(self) >= self.max_size:
+            raise ValueError("The ensemble already has max_size={} learners".format(self.max_size))
+        index = len(self)
+        if self.vectorized:
+            if self.arenas is not None:
+                for arena in self.arenas.values():
+                    arena.add_member()
+                    with torch.no_grad():
+                        arena.flat[index] = arena.flat[source_index]
+            else:
+                for network in self.get_networks():
+                    network.add_member(source_index)
+            self._append_member_views(index)
+        else:
+            networks = self._build_learner(index)
+            sources = [self.L_qf1, self.L_qf2, self.L_target_qf1, self.L_target_qf2, self.L_policy]
+            for network, source in zip(networks, sources):
+                network.to(ptu.device)
+                ptu.copy_model_params_from_to(source[source_index], network)
+            if self.arenas is not None:
+                for role, network in zip(['qf1', 'qf2', 'target_qf1', 'target_qf2', 'policy'], networks):
+                    self.arenas[role].add_member(network)
+            self._append_learner(*networks)
+        self.L_policy[index].numpy_inference = self.numpy_inference
+        self._perturb_policy(index)
+
+        if self.diversity_matrix is not None:
+            with torch.inference_mode():
+                actions = self.L_eval_policy[index].get_actions(self._diversity_samples)
+            self._diversity_actions = np.concatenate((self._diversity_actions, actions[None]))
+            row = self._diversity_row(self._diversity_actions, index)
+            self.diversity_matrix = np.pad(self.diversity_matrix, ((0, 1), (0, 1)))
+            self.diversity_matrix[index, :] = row
+            self.diversity_matrix[:, index] = row
+        return index
+
     def remove_policy(self, policy_index):
         """
         Remove the policy at the given index from the ensemble.
@@ -203,6 +504,20 @@ class Ensemble:
         del self.L_target_qf2[policy_index]
         del self.L_policy[policy_index]
         del self.L_eval_policy[policy_index]
+        if self.diversity_matrix is not None:
+            self._diversity_actions = np.delete(self._diversity_actions, policy_index, axis=0)
+            self.diversity_matrix = np.delete(np.delete(self.diversity_matrix, policy_index, axis=0), policy_index, axis=1)
+
+        if self.arenas is not None:
+            for arena in self.arenas.values():
+                arena.remove_member(policy_index)
+        elif self.vectorized:
+            for network in self.get_networks():
+                network.remove_member(policy_index)
+        if self.vectorized:
+            for members in [self.L_qf1, self.L_qf2, self.L_target_qf1, self.L_target_qf2, self.L_policy]:
+                for i, member in enumerate(members):
+                    member.index = i
 
         for i, policy in enumerate(self.L_policy):
             policy.id = i
\ No newline at end of file
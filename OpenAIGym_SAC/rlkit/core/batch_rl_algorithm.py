@@ -1,6 +1,10 @@
 import abc
+import time
+from collections import OrderedDict
 
 import gtimer as gt
+from rlkit.core import logger
+from rlkit.core.checkpoint_writer import CheckpointWriter, merge_checkpoints
 from rlkit.core.rl_algorithm import BaseRLAlgorithm
 from rlkit.data_management.replay_buffer import ReplayBuffer
 from rlkit.samplers.data_collector import PathCollector
@@ -24,7 +28,20 @@ class BatchRLAlgorithm(BaseRLAlgorithm, metaclass=abc.ABCMeta):
             num_train_loops_per_epoch=1,
             min_num_steps_before_training=0,
             save_frequency=0,
+            async_checkpoints=False,
+            max_pending_checkpoints=1,
+            batches_per_gather=1,
     ):
+        """
+        :param async_checkpoints: Snapshot the models and the replay buffer
+        every save_frequency epochs and write them on a background thread
+        instead of stalling training until they are written.
+        :param max_pending_checkpoints: How many snapshots may wait to be
+        written before the next checkpoint blocks.
+        :param batches_per_gather: Draw the training batches this many at a
+        time with replay_buffer.random_batches, and train on views of the
+        gathered block.
+        """
         super().__init__(
             trainer,
             exploration_env,
@@ -42,15 +59,19 @@ class BatchRLAlgorithm(BaseRLAlgorithm, metaclass=abc.ABCMeta):
         self.num_expl_steps_per_train_loop = num_expl_steps_per_train_loop
         self.min_num_steps_before_training = min_num_steps_before_training
         self.save_frequency = save_frequency
+        self.batches_per_gather = batches_per_gather
+        self.checkpoint_writer = CheckpointWriter(max_pending_checkpoints) if async_checkpoints else None
+        self._checkpoint_stall_time = 0.
         
     def _train(self):
-        if self.min_num_steps_before_training > 0:
+        # A resumed run already has the warm-up data in its replay buffer
+        if self.min_num_steps_before_training > 0 and self._start_epoch == 0:
             init_expl_paths = self.expl_data_collector.collect_new_paths(
                 self.max_path_length,
                 self.min_num_steps_before_training,
                 discard_incomplete_paths=False,
             )
-            self.replay_buffer.add_paths(init_expl_paths)
+            self._store_expl_paths(init_expl_paths)
             self.expl_data_collector.end_epoch(-1)
 
         # Check if it has a removal check function
@@ -76,13 +97,11 @@ class BatchRLAlgorithm(BaseRLAlgorithm, metaclass=abc.ABCMeta):
                 )
                 gt.stamp('exploration sampling', unique=False)
 
-                self.replay_buffer.add_paths(new_expl_paths)
+                self._store_expl_paths(new_expl_paths)
                 gt.stamp('data storing', unique=False)
 
                 self.training_mode(True)
-                for _ in range(self.num_trains_per_train_loop):
-                    train_data = self.replay_buffer.random_batch(
-                        self.batch_size)
+                for train_data in self._training_batches(self.num_trains_per_train_loop):
                     self.trainer.train(train_data)
                 gt.stamp('training', unique=False)
                 self.training_mode(False)
@@ -90,5 +109,59 @@ class BatchRLAlgorithm(BaseRLAlgorithm, metaclass=abc.ABCMeta):
             self._end_epoch(epoch)
             if self.save_frequency > 0:
                 if epoch % self.save_frequency == 0:
-                    self.trainer.save_models(epoch)
-                    self.replay_buffer.save_buffer(epoch)
\ No newline at end of file
+                    self._save_checkpoint(epoch)
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+
+    def _training_batches(self, num_batches):
+        if self.batches_per_gather <= 1:
+            for _ in range(num_batches):
+                yield self._random_batch()
+            return
+        for start in range(0, num_batches, self.batches_per_gather):
+            num_gathered = min(self.batches_per_gather, num_batches - start)
+            batches = self._gather_batches(num_gathered)
+            for i in range(num_gathered):
+                yield {key: value[i] for key, value in batches.items()}
+
+    def _random_batch(self):
+        return self.replay_buffer.random_batch(self.batch_size)
+
+    def _gather_batches(self, num_batches):
+        return self.replay_buffer.random_batches(num_batches, self.batch_size)
+
+    def _save_checkpoint(self, epoch):
+        start = time.time()
+        if self.checkpoint_writer is None:
+            self.trainer.save_models(epoch)
+            self.replay_buffer.save_buffer(epoch)
+        else:
+            self.checkpoint_writer.submit(*merge_checkpoints(
+                self.trainer.get_checkpoint(epoch),
+                self.replay_buffer.get_checkpoint(epoch),
+            ))
+        self._checkpoint_stall_time = time.time() - start
+
+    def _log_stats(self, epoch):
+        if self.save_frequency > 0:
+            logger.record_dict(self._get_checkpoint_diagnostics(), prefix='checkpoint/')
+        super()._log_stats(epoch)
+
+    def _get_checkpoint_diagnostics(self):
+        """
+        Timings of the last checkpoint. They are saved after the epoch is
+        logged, so they show up in the row of the next epoch.
+        """
+        stats = OrderedDict([('stall (s)', self._checkpoint_stall_time)])
+        if self.checkpoint_writer is not None:
+            # Of the last checkpoint the writer thread finished
+            stats['write (s)'] = self.checkpoint_writer.last_write_time
+            stats['written (MB)'] = self.checkpoint_writer.last_write_bytes / 1e6
+            stats['pending'] = self.checkpoint_writer.num_pending()
+        return stats
+
+    def _store_expl_paths(self, paths):
+        # Collectors streaming into the replay buffer already stored them
+        if getattr(self.expl_data_collector, 'replay_buffer', None) is not self.replay_buffer:
+            self.replay_buffer.add_paths(paths)
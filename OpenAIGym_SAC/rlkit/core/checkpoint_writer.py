@@ -0,0 +1,129 @@
+"""
+Writing checkpoints, synchronously or on a background thread.
+
+A checkpoint is a list of (path, save_fn, payload) files, written in order
+with save_fn(payload, file_object), and an optional `finalize` callable that
+is run once all of them are written (e.g. to delete old checkpoints). The
+payloads must not share memory with anything that keeps changing, see
+snapshot_state.
+"""
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+def torch_save(payload, file):
+    torch.save(payload, file)
+
+
+def npz_save(payload, file):
+    np.savez(file, **payload)
+
+
+def snapshot_state(state):
+    """
+    Copy of a (nested dict / list / tuple of) state with every tensor and
+    array copied, e.g. a state_dict that training keeps updating.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, np.ndarray):
+        return state.copy()
+    if isinstance(state, dict):
+        return type(state)((key, snapshot_state(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value) for value in state)
+    return state
+
+
+def write_file_atomic(path, save_fn, payload):
+    """
+    Write to a temporary file next to `path`, fsync it and rename it over
+    `path`, so that `path` is either the old or the complete new file.
+
+    :return: The number of bytes written.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        save_fn(payload, f)
+        f.flush()
+        os.fsync(f.fileno())
+        num_bytes = f.tell()
+    os.replace(tmp_path, path)
+    return num_bytes
+
+
+def write_checkpoint(files, finalize=None):
+    """
+    :return: The number of bytes written.
+    """
+    num_bytes = sum(write_file_atomic(path, save_fn, payload) for path, save_fn, payload in files)
+    if finalize is not None:
+        finalize()
+    return num_bytes
+
+
+def merge_checkpoints(*checkpoints):
+    """
+    One checkpoint writing the files of all `checkpoints` in order, then
+    running their finalize callables.
+    """
+    files = [file for checkpoint_files, _ in checkpoints for file in checkpoint_files]
+    finalizes = [finalize for _, finalize in checkpoints if finalize is not None]
+
+    def finalize():
+        for checkpoint_finalize in finalizes:
+            checkpoint_finalize()
+    return files, finalize
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in submission order on a daemon thread. At most
+    `max_pending` checkpoints wait to be written: submit blocks when that
+    many are queued, which bounds the memory held by snapshots. An error of
+    the writer thread is raised by the next submit or wait.
+    """
+
+    def __init__(self, max_pending=1):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self.last_write_time = 0.
+        self.last_write_bytes = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            files, finalize = self._queue.get()
+            try:
+                start = time.time()
+                self.last_write_bytes = write_checkpoint(files, finalize)
+                self.last_write_time = time.time() - start
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def submit(self, files, finalize=None):
+        self._raise_error()
+        self._queue.put((files, finalize))
+
+    def num_pending(self):
+        return self._queue.unfinished_tasks
+
+    def wait(self):
+        """
+        Block until every submitted checkpoint is written.
+        """
+        self._queue.join()
+        self._raise_error()
@@ -1,11 +1,13 @@
 from gymnasium.spaces import Discrete
 import torch
 
+from rlkit.core.checkpoint_writer import torch_save, snapshot_state
 from rlkit.data_management.simple_replay_buffer import SimpleReplayBuffer, EnsembleSimpleReplayBuffer
 from rlkit.data_management.simple_replay_buffer import RandomReplayBuffer, GaussianReplayBuffer
+from rlkit.data_management.simple_replay_buffer import _to_numpy
+from rlkit.data_management.performance_tracker import PerformanceTracker
 from rlkit.envs.env_utils import get_dim
 import numpy as np
-from collections import deque
 
 
 class EnvReplayBuffer(SimpleReplayBuffer):
@@ -59,11 +61,31 @@ class EnsembleEnvReplayBuffer(EnsembleSimpleReplayBuffer):
             env,
             num_ensemble,
             log_dir,
-            env_info_sizes=None
+            env_info_sizes=None,
+            observation_dtype='float32',
+            single_copy_obs=False,
+            storage='memory',
+            incremental_checkpoints=False,
+            keep_last_checkpoints=None,
+            keep_checkpoint_every=None,
+            max_num_ensemble=None,
     ):
         """
         :param max_replay_buffer_size:
         :param env:
+        :param observation_dtype: 'float32', 'float16' or 'bfloat16'
+        :param single_copy_obs: Store every observation once, see
+        EnsembleSimpleReplayBuffer
+        :param storage: 'memory', 'memmap' for memory-mapped files in the
+        buffer directory, or 'torch' for tensors on ptu.device
+        :param incremental_checkpoints: Only write the transitions added
+        since the last save_buffer (always the case with storage='memmap')
+        :param keep_last_checkpoints: If given, delete all checkpoints but
+        the last keep_last_checkpoints ones...
+        :param keep_checkpoint_every: ...and those at multiples of this many
+        epochs
+        :param max_num_ensemble: The number of members the masks have room
+        for, see DynamicEnsembleEnvReplayBuffer.add_policy
         """
         self.env = env
         self._ob_space = env.observation_space
@@ -82,6 +104,13 @@ class EnsembleEnvReplayBuffer(EnsembleSimpleReplayBuffer):
             env_info_sizes=env_info_sizes,
             num_ensemble=num_ensemble,
             log_dir=log_dir,
+            observation_dtype=observation_dtype,
+            single_copy_obs=single_copy_obs,
+            storage=storage,
+            incremental_checkpoints=incremental_checkpoints,
+            keep_last_checkpoints=keep_last_checkpoints,
+            keep_checkpoint_every=keep_checkpoint_every,
+            max_num_ensemble=max_num_ensemble,
         )
 
     def add_sample(self, observation, action, reward, terminal, next_observation, mask, **kwargs):
@@ -100,6 +129,76 @@ class EnsembleEnvReplayBuffer(EnsembleSimpleReplayBuffer):
             **kwargs
         )
 
+    def add_path(self, path):
+        if isinstance(self._action_space, Discrete):
+            path = dict(path, actions=np.eye(self._action_dim)[np.reshape(path["actions"], -1)])
+        super().add_path(path)
+
+class MaskedRows(object):
+    """
+    The rows of the buffer whose mask bit is set for one ensemble member, in
+    no particular order. Rows are added and removed in O(1) each by swapping
+    the removed row with the last one.
+    """
+
+    def __init__(self, capacity):
+        self.rows = np.zeros(capacity, dtype=np.int32)
+        # Position of each buffer row in self.rows, -1 if it is not there
+        self.positions = np.full(capacity, -1, dtype=np.int32)
+        self.count = 0
+
+    def remove(self, rows):
+        """
+        :param rows: Distinct buffer rows, present or not.
+        """
+        rows = rows[self.positions[rows] >= 0]
+        if len(rows) == 0:
+            return
+        holes = self.positions[rows]
+        self.positions[rows] = -1
+        count = self.count - len(rows)
+        # The rows left behind the new end fill the holes before it
+        tail = self.rows[count:self.count]
+        movers = tail[self.positions[tail] >= 0]
+        holes = holes[holes < count]
+        self.rows[holes] = movers
+        self.positions[movers] = holes
+        self.count = count
+
+    def add(self, rows):
+        """
+        :param rows: Distinct buffer rows that are not present.
+        """
+        self.rows[self.count:self.count + len(rows)] = rows
+        self.positions[rows] = np.arange(self.count, self.count + len(rows))
+        self.count += len(rows)
+
+    def set_row(self, row, in_mask):
+        """
+        Add or remove a single buffer row, without the array overhead of
+        add and remove.
+        """
+        position = self.positions[row]
+        if in_mask and position < 0:
+            self.rows[self.count] = row
+            self.positions[row] = self.count
+            self.count += 1
+        elif not in_mask and position >= 0:
+            self.count -= 1
+            last = self.rows[self.count]
+            self.rows[position] = last
+            self.positions[last] = position
+            self.positions[row] = -1
+
+    def reset(self, rows):
+        self.positions[self.rows[:self.count]] = -1
+        self.count = 0
+        self.add(rows)
+
+    def sample(self, batch_size):
+        return self.rows[np.random.randint(0, self.count, batch_size)]
+
+
 class DynamicEnsembleEnvReplayBuffer(EnsembleEnvReplayBuffer):
     def __init__(
             self,
@@ -107,75 +206,218 @@ class DynamicEnsembleEnvReplayBuffer(EnsembleEnvReplayBuffer):
             env,
             num_ensemble,
             log_dir,
-            env_info_sizes=None
+            env_info_sizes=None,
+            observation_dtype='float32',
+            single_copy_obs=False,
+            storage='memory',
+            incremental_checkpoints=False,
+            keep_last_checkpoints=None,
+            keep_checkpoint_every=None,
+            member_sampling=False,
+            performance_window_size=1000,
+            performance_gamma=0.95,
+            max_num_ensemble=None,
     ):
         """
         :param max_replay_buffer_size:
         :param env:
+        :param observation_dtype: 'float32', 'float16' or 'bfloat16'
+        :param single_copy_obs: Store every observation once, see
+        EnsembleSimpleReplayBuffer
+        :param storage: 'memory', 'memmap' for memory-mapped files in the
+        buffer directory, or 'torch' for tensors on ptu.device
+        :param incremental_checkpoints: Only write the transitions added
+        since the last save_buffer (always the case with storage='memmap')
+        :param keep_last_checkpoints: If given, delete all checkpoints but
+        the last keep_last_checkpoints ones...
+        :param keep_checkpoint_every: ...and those at multiples of this many
+        epochs
+        :param member_sampling: Keep the rows of every member's mask (two
+        int32 per row and member) to sample them with random_member_batch
+        :param performance_window_size: Number of the latest rewards of each
+        policy its performance is computed from, see PerformanceTracker...
+        :param performance_gamma: ...and their discount. Both should match
+        the Ensemble's window_size and performance_gamma.
+        :param max_num_ensemble: The number of policies add_policy can grow
+        the buffer to without allocating (num_ensemble by default), which
+        should match the Ensemble's max_size
         """
         super().__init__(
             max_replay_buffer_size=max_replay_buffer_size,
             env=env,
             num_ensemble=num_ensemble,
             log_dir=log_dir,
-            env_info_sizes=env_info_sizes
+            env_info_sizes=env_info_sizes,
+            observation_dtype=observation_dtype,
+            single_copy_obs=single_copy_obs,
+            storage=storage,
+            incremental_checkpoints=incremental_checkpoints,
+            keep_last_checkpoints=keep_last_checkpoints,
+            keep_checkpoint_every=keep_checkpoint_every,
+            max_num_ensemble=max_num_ensemble,
         )
 
-        self.policy_rewards = [deque(maxlen=max_replay_buffer_size) for _ in range(num_ensemble)]
+        self.policy_performance = PerformanceTracker(
+            num_ensemble, performance_window_size, performance_gamma, capacity=self._max_num_ensemble)
+        self.member_sampling = member_sampling
+        self._member_rows = None
+        if member_sampling:
+            self._member_rows = [MaskedRows(max_replay_buffer_size) for _ in range(num_ensemble)]
+            # Those of removed policies and for added ones
+            self._free_member_rows = [
+                MaskedRows(max_replay_buffer_size) for _ in range(self._max_num_ensemble - num_ensemble)
+            ]
     
     def add_sample(self, observation, action, reward, terminal, next_observation, mask, agent_info, **kwargs):
         super().add_sample(observation, action, reward, terminal, next_observation, mask, agent_infos=agent_info, **kwargs)
-        self.policy_rewards[agent_info["policy_id"]].append(reward)
+        if self._member_rows is not None:
+            row = (self._top - 1) % self._max_replay_buffer_size
+            for member_rows, in_mask in zip(self._member_rows, np.ravel(_to_numpy(mask)).tolist()):
+                member_rows.set_row(row, in_mask)
+        self.policy_performance.add(agent_info["policy_id"], reward)
+
+    def add_path(self, path):
+        super().add_path(path)
+        num_rows = min(len(path["rewards"]), self._max_replay_buffer_size)
+        self._index_rows((self._top - num_rows + np.arange(num_rows)) % self._max_replay_buffer_size)
+        policy_ids = np.array([agent_info["policy_id"] for agent_info in path["agent_infos"]])
+        for policy_id in np.unique(policy_ids):
+            self.policy_performance.extend(policy_id, path["rewards"][policy_ids == policy_id])
 
     def update_mask(self, actor, mask):
         """
-        Update the mask for a particular action. I.e just update a column
+        Update the mask for a particular action. I.e just update the actor's bit of every row
         """
-        print(f"Mask if of shape {self._mask.shape} and actor {actor} has shape {mask.shape}")
-
-        print(f"Selection mask is of shape: {self._mask[:, actor]}")
-
-        self._mask[:, actor] = mask
+        self._set_mask_column(actor, mask)
+        if self._member_rows is not None:
+            self._member_rows[actor].reset(np.flatnonzero(_to_numpy(mask)[:self._size]))
     
     def refresh_policy_rewards(self, policy):
         """
-        Refresh the rewards for a particular policy. I.e reset the deque
+        Refresh the rewards for a particular policy. I.e reset its performance window
         """
-        self.policy_rewards[policy] = deque(maxlen=self._max_replay_buffer_size)
+        self.policy_performance.reset(policy)
     
     def remove_policy(self, policy_idx):
         """
-        Remove a policy from the mask. I.e remove the column from the mask
+        Remove a policy from the mask. I.e free its slot, the bits of the
+        other policies stay where they are
+        """
+        self._set_mask_slots(np.delete(self._mask_slots, policy_idx))
+        self.policy_performance.remove(policy_idx)
+        if self._member_rows is not None:
+            self._free_member_rows.append(self._member_rows.pop(policy_idx))
+
+    def add_policy(self, mask):
+        """
+        Add a policy to the mask, in a free slot, with `mask` as its mask of
+        every row. I.e set its bit of every row
         """
-        self._mask = np.delete(self._mask, policy_idx, axis=1)
-        del self.policy_rewards[policy_idx]
+        if len(self._mask_slots) >= self._max_num_ensemble:
+            raise ValueError("The buffer already has max_num_ensemble={} policies".format(self._max_num_ensemble))
+        free_slots = np.setdiff1d(np.arange(self._mask.shape[1] * 8), self._mask_slots)
+        self._set_mask_slots(np.append(self._mask_slots, free_slots[0]))
+        self.policy_performance.add_member()
+        if self._member_rows is not None:
+            self._member_rows.append(
+                self._free_member_rows.pop() if self._free_member_rows else MaskedRows(self._max_replay_buffer_size))
+        self.update_mask(len(self._mask_slots) - 1, mask)
+
+    def _index_rows(self, rows):
+        """
+        Update the rows of every member's mask after `rows` were written.
+        """
+        if self._member_rows is None:
+            return
+        mask = _to_numpy(self._unpack_mask(self._mask[rows])) != 0
+        for member, member_rows in enumerate(self._member_rows):
+            member_rows.remove(rows)
+            member_rows.add(rows[mask[:, member]])
+
+    def _reindex_rows(self):
+        if self._member_rows is None:
+            return
+        mask = self._host_mask() != 0
+        for member, member_rows in enumerate(self._member_rows):
+            member_rows.reset(np.flatnonzero(mask[:, member]))
+
+    def random_member_batch(self, batch_size):
+        """
+        A batch of batch_size rows for every member, drawn from the rows its
+        mask is set for, so that no member trains on rows it masks out. A
+        member without any row gets placeholder rows with a zero mask, which
+        leaves it out of the losses. Requires member_sampling.
+
+        :return: dict from key to an array of shape
+        (num_ensemble, batch_size, ...), with the mask bit of every member on
+        its own rows as masks, of shape (num_ensemble, batch_size).
+        """
+        batches = self.random_member_batches(1, batch_size)
+        return {key: value[0] for key, value in batches.items()}
+
+    def random_member_batches(self, num_batches, batch_size):
+        """
+        num_batches random_member_batch drawn at once, with one gather per
+        array.
+
+        :return: dict from key to an array of shape
+        (num_batches, num_ensemble, batch_size, ...)
+        """
+        num_ensemble = len(self._member_rows)
+        indices = np.stack([
+            member_rows.sample((num_batches, batch_size)) if member_rows.count > 0
+            else np.zeros((num_batches, batch_size), dtype=np.int64)
+            for member_rows in self._member_rows
+        ], axis=1)
+        batches = self._gather_blocks(indices.reshape(num_batches * num_ensemble, batch_size))
+        members = np.tile(np.arange(num_ensemble), num_batches)
+        batches['masks'] = batches['masks'][np.arange(len(members)), :, members]
+        return {
+            key: value.reshape((num_batches, num_ensemble) + tuple(value.shape[1:]))
+            for key, value in batches.items()
+        }
 
     def get_policy_historic_performance(self):
         """
-        Get the historic performance of a policy
+        Get the historic performance of a policy, i.e. its last performance_window_size rewards
         """
-        return [np.array(policy_rewards) for policy_rewards in self.policy_rewards]
+        return [self.policy_performance.history(policy) for policy in range(len(self.policy_performance))]
 
-    def save_buffer(self, epoch):
-        super().save_buffer(epoch)
+    def get_policy_performances(self):
+        """
+        The discounted performance of every policy over its last performance_window_size rewards, see
+        Ensemble.removal_check
+        """
+        return self.policy_performance.performances()
+
+    def _checkpoint_files(self, epoch):
+        return super()._checkpoint_files(epoch) + ['policy_rewards_%d.pt' % epoch]
 
+    def get_checkpoint(self, epoch):
+        files, finalize = super().get_checkpoint(epoch)
         policy_rewards_path = self.buffer_dir + '/policy_rewards_%d.pt' % (epoch)
-        payload = [np.array(policy_rewards) for policy_rewards in self.policy_rewards]
-        torch.save(payload, policy_rewards_path)
+        payload = snapshot_state(self.policy_performance.state_dict())
+        files.append((policy_rewards_path, torch_save, payload))
+        return files, finalize
     
     def load_buffer(self, epochs):
+        """
+        Load the first of `epochs` that has a checkpoint.
+        :return: The loaded epoch, or None if none of them has one.
+        """
         for epoch in epochs:
             try:
                 policy_rewards_path = self.buffer_dir + '/policy_rewards_%d.pt' % (epoch)
                 payload = torch.load(policy_rewards_path, weights_only=False)
-                for i, policy_rewards in enumerate(payload):
-                    self.policy_rewards[i] = deque(policy_rewards, maxlen=self._max_replay_buffer_size)
+                self.policy_performance.load_state_dict(payload)
                 super().load_buffer(epoch)
+                self._reindex_rows()
             except FileNotFoundError:
                 print(f"Policy rewards not found for epoch {epoch}. Skipping loading policy rewards.")
                 continue
             print(f"Loaded replay buffer for epoch {epoch} from {policy_rewards_path}")
-            break
+            return epoch
+        return None
 
 class RandomEnvReplayBuffer(RandomReplayBuffer):
     def __init__(
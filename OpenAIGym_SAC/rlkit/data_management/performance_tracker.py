@@ -0,0 +1,140 @@
+"""
+Streaming exponentially weighted performance of the ensemble members.
+"""
+import numpy as np
+
+
+class PerformanceTracker(object):
+    """
+    The last `window_size` rewards of every member in a ring buffer, and their
+    discounted sum (the newest reward weighted 1, the one before it gamma,
+    ...), updated in O(1) per reward. performances() normalizes the sums by
+    the sum of the weights, which is Ensemble.compute_performance of each
+    member's reward history.
+
+    The O(1) updates accumulate rounding errors, so each member's sum is
+    recomputed from its ring once per window_size rewards.
+
+    The arrays have rows for `capacity` members (num_members by default),
+    and rewards, counts and scores are views of the rows of the current
+    members, so add_member and remove only allocate beyond the capacity.
+    """
+
+    def __init__(self, num_members, window_size, gamma, capacity=None):
+        self.window_size = int(window_size)
+        self.gamma = gamma
+        # Weight of the reward k steps before the newest one
+        self._weights = gamma ** np.arange(self.window_size)
+        # Weight the oldest reward would have one step later
+        self._dropped_weight = gamma ** self.window_size
+        capacity = max(num_members, capacity or 0)
+        self._rewards = np.zeros((capacity, self.window_size))
+        # Rewards added since the last reset, the newest one is in slot (count - 1) % window_size
+        self._counts = np.zeros(capacity, dtype=np.int64)
+        self._scores = np.zeros(capacity)
+        self._resize(num_members)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _resize(self, num_members):
+        if num_members > len(self._counts):
+            self._rewards, self._counts, self._scores = [
+                np.concatenate((array, np.zeros((num_members - len(array),) + array.shape[1:], dtype=array.dtype)))
+                for array in [self._rewards, self._counts, self._scores]
+            ]
+        self.rewards = self._rewards[:num_members]
+        self.counts = self._counts[:num_members]
+        self.scores = self._scores[:num_members]
+
+    def add_member(self):
+        """
+        Append a member without rewards.
+        """
+        self._resize(len(self) + 1)
+        self.reset(len(self) - 1)
+
+    def add(self, member, reward):
+        reward = np.asarray(reward).item()
+        count = self.counts[member]
+        slot = count % self.window_size
+        # The reward that leaves the window
+        dropped = self.rewards[member, slot] if count >= self.window_size else 0.
+        self.rewards[member, slot] = reward
+        self.counts[member] = count + 1
+        if slot == self.window_size - 1:
+            self.scores[member] = self._score(member)
+        else:
+            self.scores[member] = (
+                self.gamma * self.scores[member] + reward - self._dropped_weight * dropped
+            )
+
+    def extend(self, member, rewards):
+        rewards = np.ravel(rewards)
+        count = self.counts[member]
+        self.counts[member] = count + len(rewards)
+        rewards = rewards[-self.window_size:]
+        first = self.counts[member] - len(rewards)
+        self.rewards[member, (first + np.arange(len(rewards))) % self.window_size] = rewards
+        self.scores[member] = self._score(member)
+
+    def _score(self, member):
+        count = self.counts[member]
+        num_rewards = min(count, self.window_size)
+        newest_first = (count - 1 - np.arange(num_rewards)) % self.window_size
+        return np.dot(self.rewards[member, newest_first], self._weights[:num_rewards])
+
+    def performances(self):
+        """
+        :return: np.array of shape (num_members,), the normalized discounted
+        sum of each member's last window_size rewards, or 1 for members with
+        fewer rewards.
+        """
+        return np.where(self.counts >= self.window_size, self.scores / self._weights.sum(), 1.)
+
+    def history(self, member):
+        """
+        :return: The member's last (up to window_size) rewards, oldest first.
+        """
+        count = self.counts[member]
+        num_rewards = min(count, self.window_size)
+        return self.rewards[member, (count - num_rewards + np.arange(num_rewards)) % self.window_size]
+
+    def reset(self, member):
+        self.counts[member] = 0
+        self.scores[member] = 0.
+
+    def remove(self, member):
+        for array in [self.rewards, self.counts, self.scores]:
+            array[member:-1] = array[member + 1:]
+        self._resize(len(self) - 1)
+
+    def state_dict(self):
+        return dict(
+            window_size=self.window_size,
+            gamma=self.gamma,
+            rewards=self.rewards,
+            counts=self.counts,
+            scores=self.scores,
+        )
+
+    def load_state_dict(self, state):
+        """
+        Load a state_dict, or the reward histories of older checkpoints (one
+        array per member). Histories of another window_size or gamma are
+        replayed into this tracker's.
+        """
+        if isinstance(state, dict):
+            if state['window_size'] == self.window_size and state['gamma'] == self.gamma:
+                self._resize(len(state['counts']))
+                self.rewards[:] = state['rewards']
+                self.counts[:] = state['counts']
+                self.scores[:] = state['scores']
+                return
+            source = PerformanceTracker(len(state['counts']), state['window_size'], state['gamma'])
+            source.load_state_dict(state)
+            state = [source.history(member) for member in range(len(source))]
+        self._resize(len(state))
+        for member, rewards in enumerate(state):
+            self.reset(member)
+            self.extend(member, rewards)
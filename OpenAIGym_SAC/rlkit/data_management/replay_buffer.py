@@ -1,5 +1,7 @@
 import abc
 
+import numpy as np
+
 
 class ReplayBuffer(object, metaclass=abc.ABCMeta):
     """
@@ -83,6 +85,14 @@ class ReplayBuffer(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    def random_batches(self, num_batches, batch_size):
+        """
+        Return `num_batches` batches of size `batch_size`, stacked along a new
+        first axis.
+        """
+        batches = [self.random_batch(batch_size) for _ in range(num_batches)]
+        return {key: np.stack([batch[key] for batch in batches]) for key in batches[0]}
+
     def get_diagnostics(self):
         return {}
 
@@ -177,6 +187,14 @@ class EnsembleReplayBuffer(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    def random_batches(self, num_batches, batch_size):
+        """
+        Return `num_batches` batches of size `batch_size`, stacked along a new
+        first axis.
+        """
+        batches = [self.random_batch(batch_size) for _ in range(num_batches)]
+        return {key: np.stack([batch[key] for batch in batches]) for key in batches[0]}
+
     def get_diagnostics(self):
         return {}
 
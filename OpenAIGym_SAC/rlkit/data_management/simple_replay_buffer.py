@@ -1,9 +1,13 @@
 from collections import OrderedDict
+from functools import partial
 
 import os
+import re
 import numpy as np
 import torch
 
+import rlkit.torch.pytorch_util as ptu
+from rlkit.core.checkpoint_writer import npz_save, torch_save, write_checkpoint
 from rlkit.data_management.replay_buffer import ReplayBuffer, EnsembleReplayBuffer
 
 
@@ -94,7 +98,68 @@ class SimpleReplayBuffer(ReplayBuffer):
             ('size', self._size)
         ])
 
+# Storage dtypes of the observations of EnsembleSimpleReplayBuffer. NumPy has
+# no bfloat16, so bfloat16 observations are kept as their raw 16 bits.
+OBSERVATION_DTYPES = dict(
+    float32=np.float32,
+    float16=np.float16,
+    bfloat16=np.int16,
+)
+
+TORCH_DTYPES = {
+    np.float32: torch.float32,
+    np.float16: torch.float16,
+    np.int16: torch.bfloat16,
+    np.uint8: torch.uint8,
+}
+
+STORAGE_BACKENDS = ('memory', 'memmap', 'torch')
+
+
 class EnsembleSimpleReplayBuffer(EnsembleReplayBuffer):
+    """
+    Everything is stored as float32 (the dtype the networks train in), the
+    masks as packed bits, and the observations optionally in half precision
+    (observation_dtype='float16' or 'bfloat16'). random_batch always returns
+    float32 arrays that np_to_pytorch_batch can use without another copy.
+
+    The mask of each row is stored as bits, 8 members per uint8 column, and
+    self._mask_slots maps every member to its bit (its slot). Removing a
+    member frees its slot rather than moving the other members' bits, and a
+    new member takes a free slot, of which there are at least
+    max_num_ensemble - num_ensemble. Only the sampled rows are unpacked.
+    Checkpoints hold the unpacked (size, num_members) masks.
+
+    With single_copy_obs=True every observation is stored once: the next
+    observation of row i is read from row i + 1 (wrapping around the end of
+    the buffer) whenever that row holds it, which is the case for every step
+    of an episode but its last. The next observations of the other rows
+    (episode ends, and the newest row) are kept in a small side table. The
+    sampled batches are the same as with two copies. Steps of several
+    episodes written interleaved (e.g. streamed from a vector env) are
+    correct too but save nothing, as every row then ends up in the table.
+
+    With storage='memmap' the arrays are memory-mapped .npy files in
+    buffer_dir instead of in-RAM arrays, so buffers larger than RAM are
+    paged in and out by the OS. The files keep changing as rows are added,
+    so they are not a checkpoint themselves: save_buffer flushes them and
+    always writes incremental checkpoints (see below), and load_buffer writes
+    the rows of the checkpoint back into the files. Other processes can map
+    the same files read-only with np.load(path, mmap_mode='r').
+
+    With storage='torch' the arrays are tensors on ptu.device (bfloat16
+    observations natively), and random_batch samples on that device with
+    torch.randint and index_select and returns float32 tensors that
+    np_to_pytorch_batch passes through. Its checkpoints are the same files
+    as those of in-RAM buffers.
+
+    With incremental_checkpoints=True, save_buffer only writes the
+    transitions added since the previous save, as a chunk file, and
+    replay_<epoch>.pt becomes a manifest of the chunks that still hold
+    live rows (plus the masks, which removal checks rewrite as a whole).
+    keep_last_checkpoints / keep_checkpoint_every set which checkpoints are
+    kept; the others, and the chunks only they used, are deleted.
+    """
 
     def __init__(
         self,
@@ -104,49 +169,333 @@ class EnsembleSimpleReplayBuffer(EnsembleReplayBuffer):
         env_info_sizes,
         num_ensemble,
         log_dir,
+        observation_dtype='float32',
+        single_copy_obs=False,
+        storage='memory',
+        incremental_checkpoints=False,
+        keep_last_checkpoints=None,
+        keep_checkpoint_every=None,
+        max_num_ensemble=None,
     ):
+        if observation_dtype not in OBSERVATION_DTYPES:
+            raise ValueError("Unknown observation_dtype: {}".format(observation_dtype))
+        if storage not in STORAGE_BACKENDS:
+            raise ValueError("Unknown storage: {}".format(storage))
+        if single_copy_obs and storage == 'memmap':
+            # The side table lives in RAM and would go out of sync with the
+            # files after a crash
+            raise ValueError("single_copy_obs is not supported with storage='memmap'")
+        if storage == 'torch' and (single_copy_obs or incremental_checkpoints):
+            raise ValueError("single_copy_obs and incremental_checkpoints are not supported with storage='torch'")
+        self.buffer_dir = log_dir + '/buffer/'
+        os.makedirs(self.buffer_dir, exist_ok=True)
+        self._storage = storage
+        self._device = (ptu.device or torch.device('cpu')) if storage == 'torch' else None
+        self._observation_dtype = observation_dtype
         self._observation_dim = observation_dim
         self._action_dim = action_dim
         self._max_replay_buffer_size = max_replay_buffer_size
-        self._observations = np.zeros((max_replay_buffer_size, observation_dim))
-        # It's a bit memory inefficient to save the observations twice,
-        # but it makes the code *much* easier since you no longer have to
-        # worry about termination conditions.
-        self._next_obs = np.zeros((max_replay_buffer_size, observation_dim))
-        self._actions = np.zeros((max_replay_buffer_size, action_dim))
+        self._single_copy_obs = single_copy_obs
+        self._observations = self._zeros_observations('observations')
+        if single_copy_obs:
+            self._next_obs = None
+            # self._next_obs_linked[i] = the next observation of row i is
+            # the observation of row i + 1, else it is self._episode_next_obs[i]
+            self._next_obs_linked = np.zeros(max_replay_buffer_size, dtype=bool)
+            self._episode_next_obs = {}
+        else:
+            # It's a bit memory inefficient to save the observations twice,
+            # but it makes the code *much* easier since you no longer have to
+            # worry about termination conditions.
+            self._next_obs = self._zeros_observations('next_obs')
+        self._actions = self._zeros('actions', (max_replay_buffer_size, action_dim), np.float32)
         # Make everything a 2D np array to make it easier for other code to
         # reason about the shape of the data
-        self._rewards = np.zeros((max_replay_buffer_size, 1))
+        self._rewards = self._zeros('rewards', (max_replay_buffer_size, 1), np.float32)
         # self._terminals[i] = a terminal was received at time i
-        self._terminals = np.zeros((max_replay_buffer_size, 1), dtype='uint8')
+        self._terminals = self._zeros('terminals', (max_replay_buffer_size, 1), np.uint8)
         # Define self._env_infos[key][i] to be the return value of env_info[key]
         # at time i
         self._env_infos = {}
         for key, size in env_info_sizes.items():
-            self._env_infos[key] = np.zeros((max_replay_buffer_size, size))
+            self._env_infos[key] = self._zeros('env_info_' + key, (max_replay_buffer_size, size), np.float32)
         self._env_info_keys = env_info_sizes.keys()
         
-        # define mask
-        self._mask = np.zeros((max_replay_buffer_size, num_ensemble))
+        # define mask, with room for max_num_ensemble members
+        self._max_num_ensemble = max(num_ensemble, max_num_ensemble or 0)
+        self._reset_mask(num_ensemble)
         
         self._top = 0
         self._size = 0
-        self.buffer_dir = log_dir + '/buffer/'
-        os.makedirs(self.buffer_dir, exist_ok=True)
+        # Number of transitions ever added, and up to which of them chunks
+        # have been written
+        self._num_added = 0
+        self._num_checkpointed = 0
+        self._incremental_checkpoints = incremental_checkpoints or storage == 'memmap'
+        self._keep_last_checkpoints = keep_last_checkpoints
+        self._keep_checkpoint_every = keep_checkpoint_every
+        # The chunks holding live rows, oldest first, and the chunks used by
+        # every checkpoint manifest read or written so far
+        self._checkpoint_chunks = []
+        self._manifest_chunks = {}
+
+    def _zeros(self, name, shape, dtype):
+        """
+        A new array for the rows of `name`. Memory-mapped files of a previous
+        run are reused if they have the same layout rather than truncated
+        (only the first self._size rows are ever read). Files of another
+        layout are replaced.
+        """
+        if self._storage == 'memory':
+            return np.zeros(shape, dtype=dtype)
+        if self._storage == 'torch':
+            return torch.zeros(shape, dtype=TORCH_DTYPES[dtype], device=self._device)
+        path = self._memmap_path(name)
+        if os.path.exists(path):
+            array = np.load(path, mmap_mode='r+')
+            if array.shape == shape and array.dtype == dtype:
+                return array
+            del array
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def _reset_mask(self, num_members):
+        """
+        New all-zero masks with members 0..num_members - 1 in slots 0..num_members - 1.
+        """
+        num_columns = max(1, -(-max(num_members, self._max_num_ensemble) // 8))
+        self._mask = self._zeros('mask', (self._max_replay_buffer_size, num_columns), np.uint8)
+        self._set_mask_slots(np.arange(num_members))
+
+    def _set_mask_slots(self, slots):
+        self._mask_slots = slots
+        # The packed row of a mask row is mask_row @ self._mask_bits
+        self._mask_bits = np.zeros((len(slots), self._mask.shape[1]), dtype=np.uint8)
+        self._mask_bits[np.arange(len(slots)), slots // 8] = 1 << (slots % 8)
+
+    def _pack_mask(self, masks):
+        """
+        :param masks: (num_rows, num_members) array, nonzero where the member
+        uses the row
+        :return: The rows in the layout of self._mask, as a NumPy array.
+        """
+        masks = np.asarray(masks).reshape(-1, len(self._mask_slots)) != 0
+        return masks.astype(np.uint8) @ self._mask_bits
+
+    def _unpack_mask(self, packed):
+        """
+        :param packed: rows of self._mask, as a NumPy array or a tensor
+        :return: (num_rows, num_members) uint8 masks of the same type
+        """
+        shifts, slots = np.arange(8, dtype=np.uint8), self._mask_slots
+        if isinstance(packed, torch.Tensor):
+            shifts = torch.as_tensor(shifts, device=packed.device)
+            slots = torch.as_tensor(slots, device=packed.device)
+        bits = (packed[:, :, None] >> shifts) & 1
+        return bits.reshape(len(packed), -1)[:, slots]
+
+    def _host_mask(self):
+        """
+        The unpacked masks of the first self._size rows as a NumPy array.
+        """
+        return self._unpack_mask(self._host_copy(self._mask))
+
+    def _set_mask_column(self, member, values):
+        """
+        Set the mask of one member for every row of the buffer.
+        """
+        column, bit = divmod(int(self._mask_slots[member]), 8)
+        if self._storage == 'torch':
+            values = torch.as_tensor(values, device=self._device).ne(0).to(torch.uint8)
+        else:
+            values = (np.asarray(_to_numpy(values)) != 0).astype(np.uint8)
+        self._mask[:, column] = (self._mask[:, column] & (255 ^ (1 << bit))) | (values << bit)
+
+    def _zeros_observations(self, name):
+        return self._zeros(
+            name,
+            (self._max_replay_buffer_size, self._observation_dim),
+            OBSERVATION_DTYPES[self._observation_dtype],
+        )
+
+    def _memmap_path(self, name):
+        return os.path.join(self.buffer_dir, name + '.npy')
+
+    def _named_arrays(self):
+        arrays = dict(
+            observations=self._observations,
+            next_obs=self._next_obs,
+            actions=self._actions,
+            rewards=self._rewards,
+            terminals=self._terminals,
+            mask=self._mask,
+        )
+        for key in self._env_info_keys:
+            arrays['env_info_' + key] = self._env_infos[key]
+        return arrays
+
+    def _set_rows(self, array, rows, values):
+        """
+        array[rows] = values, for arrays of any storage.
+        """
+        if self._storage == 'torch':
+            values = torch.as_tensor(values, dtype=array.dtype, device=array.device)
+        array[rows] = values
+
+    def _host_copy(self, array):
+        """
+        Copy of the first self._size rows of `array` as a NumPy array in the
+        dtype an in-RAM buffer stores it in.
+        """
+        rows = array[:self._size]
+        if self._storage != 'torch':
+            return rows.copy()
+        if rows.dtype == torch.bfloat16:
+            rows = rows.view(torch.int16)
+        return rows.to('cpu', copy=True).numpy()
+
+    def _encode_observations(self, observations):
+        if self._storage == 'torch':
+            # Converted to the storage dtype by _set_rows
+            return np.asarray(observations, dtype=np.float32)
+        if self._observation_dtype == 'bfloat16':
+            observations = torch.as_tensor(np.asarray(observations, dtype=np.float32))
+            return observations.to(torch.bfloat16).view(torch.int16).numpy()
+        return np.asarray(observations, dtype=OBSERVATION_DTYPES[self._observation_dtype])
+
+    def _decode_observations(self, observations):
+        if self._observation_dtype == 'bfloat16':
+            return torch.from_numpy(observations).view(torch.bfloat16).float().numpy()
+        return observations.astype(np.float32, copy=False)
 
     def add_sample(self, observation, action, reward, next_observation,
                    terminal, mask, env_info, **kwargs):
+        observation = self._encode_observations(observation)
+        if self._single_copy_obs:
+            self._link_previous_row(self._top, observation)
+            self._next_obs_linked[self._top] = False
+            self._episode_next_obs[self._top] = self._encode_observations(next_observation).copy()
+        elif self._storage == 'torch':
+            self._set_rows(self._next_obs, self._top, self._encode_observations(next_observation))
+        else:
+            self._next_obs[self._top] = self._encode_observations(next_observation)
+        if self._storage == 'torch':
+            for array, values in [
+                (self._observations, observation),
+                (self._actions, action),
+                (self._rewards, reward),
+                (self._terminals, terminal),
+                (self._mask, self._pack_mask(mask)[0]),
+            ]:
+                self._set_rows(array, self._top, values)
+            for key in self._env_info_keys:
+                self._set_rows(self._env_infos[key], self._top, env_info[key])
+            self._advance()
+            return
         self._observations[self._top] = observation
         self._actions[self._top] = action
         self._rewards[self._top] = reward
         self._terminals[self._top] = terminal
-        self._next_obs[self._top] = next_observation
-        self._mask[self._top] = mask
+        self._mask[self._top] = self._pack_mask(mask)[0]
         
         for key in self._env_info_keys:
             self._env_infos[key][self._top] = env_info[key]
         self._advance()
 
+    def add_path(self, path):
+        """
+        Add a whole path with one slice write per array (two when the path
+        wraps around the end of the buffer) instead of one add_sample per
+        step.
+        """
+        observations = self._encode_observations(path["observations"])
+        next_observations = self._encode_observations(path["next_observations"])
+        columns = [
+            (self._observations, observations),
+            (self._actions, path["actions"]),
+            (self._rewards, path["rewards"]),
+            (self._terminals, path["terminals"]),
+            (self._mask, self._pack_mask(path["masks"])),
+        ]
+        if self._single_copy_obs:
+            # The rows that survive the write, see _write_rows
+            observations = observations[-self._max_replay_buffer_size:]
+            next_observations = next_observations[-self._max_replay_buffer_size:]
+            top = (self._top + len(path["observations"]) - len(observations)) % self._max_replay_buffer_size
+            self._link_next_observations(top, observations, next_observations)
+        else:
+            columns.append((self._next_obs, next_observations))
+        for key in self._env_info_keys:
+            columns.append((
+                self._env_infos[key],
+                np.array([env_info[key] for env_info in path["env_infos"]]).reshape(
+                    len(path["env_infos"]), -1),
+            ))
+        self._write_rows(columns)
+        self.terminate_episode()
+
+    def _write_rows(self, columns):
+        """
+        Write consecutive rows from self._top on, as that many add_sample
+        calls would.
+
+        :param columns: (buffer array, values) pairs, all values having the
+        same number of rows.
+        """
+        num_rows = len(columns[0][1])
+        self._num_added += num_rows
+        top = self._top
+        if num_rows > self._max_replay_buffer_size:
+            # Only the last max_replay_buffer_size rows would survive
+            top = (top + num_rows - self._max_replay_buffer_size) % self._max_replay_buffer_size
+            columns = [(array, values[-self._max_replay_buffer_size:]) for array, values in columns]
+            num_rows = self._max_replay_buffer_size
+        first = min(num_rows, self._max_replay_buffer_size - top)
+        for array, values in columns:
+            self._set_rows(array, slice(top, top + first), values[:first])
+            self._set_rows(array, slice(0, num_rows - first), values[first:])
+        self._top = (top + num_rows) % self._max_replay_buffer_size
+        self._size = min(self._size + num_rows, self._max_replay_buffer_size)
+
+    def _link_next_observations(self, top, observations, next_observations):
+        """
+        Single-copy bookkeeping for writing `observations` (encoded) to the
+        consecutive rows from `top` on. Must be called before the rows are
+        written.
+        """
+        size = self._max_replay_buffer_size
+        num_rows = len(observations)
+        rows = (top + np.arange(num_rows)) % size
+        if 0 < num_rows < size:
+            self._link_previous_row(top, observations[0])
+        for row in rows[~self._next_obs_linked[rows]]:
+            self._episode_next_obs.pop(row, None)
+        linked = np.zeros(num_rows, dtype=bool)
+        linked[:-1] = np.all(next_observations[:-1] == observations[1:], axis=1)
+        self._next_obs_linked[rows] = linked
+        for k in np.flatnonzero(~linked):
+            self._episode_next_obs[rows[k]] = next_observations[k].copy()
+
+    def _link_previous_row(self, top, observation):
+        """
+        The newest row so far always has its next observation in the side
+        table. Link it to row `top` if its episode continues with
+        `observation`, and drop what row `top` held.
+        """
+        prev = (top - 1) % self._max_replay_buffer_size
+        if self._size > 0 and np.array_equal(self._episode_next_obs[prev], observation):
+            del self._episode_next_obs[prev]
+            self._next_obs_linked[prev] = True
+        self._episode_next_obs.pop(top, None)
+
+    def _get_next_observations(self, indices):
+        if not self._single_copy_obs:
+            return self._next_obs[indices]
+        next_obs = self._observations[(indices + 1) % self._max_replay_buffer_size]
+        ends = np.flatnonzero(~self._next_obs_linked[indices])
+        if len(ends) > 0:
+            next_obs[ends] = np.stack([self._episode_next_obs[i] for i in indices[ends]])
+        return next_obs
+
     def terminate_episode(self):
         pass
 
@@ -154,22 +503,70 @@ class EnsembleSimpleReplayBuffer(EnsembleReplayBuffer):
         self._top = (self._top + 1) % self._max_replay_buffer_size
         if self._size < self._max_replay_buffer_size:
             self._size += 1
+        self._num_added += 1
 
     def random_batch(self, batch_size):
-        indices = np.random.randint(0, self._size, batch_size)
+        if self._storage == 'torch':
+            return self._gather_torch(torch.randint(0, self._size, (batch_size,), device=self._device))
+        return self._gather(np.random.randint(0, self._size, batch_size))
+
+    def random_batches(self, num_batches, batch_size):
+        """
+        num_batches random batches drawn at once: the same as that many
+        random_batch calls, but with one draw of the indices and one gather
+        per array.
+
+        :return: dict from key to an array (a tensor with storage='torch') of
+        shape (num_batches, batch_size, ...), whose i-th entry is the i-th batch
+        """
+        if self._storage == 'torch':
+            indices = torch.randint(0, self._size, (num_batches, batch_size), device=self._device)
+        else:
+            indices = np.random.randint(0, self._size, (num_batches, batch_size))
+        return self._gather_blocks(indices)
+
+    def _gather_blocks(self, indices):
+        """
+        :param indices: of shape (num_batches, batch_size)
+        :return: dict from key to an array of shape (num_batches, batch_size, ...)
+        """
+        if self._storage == 'torch':
+            batch = self._gather_torch(torch.as_tensor(indices, device=self._device).reshape(-1))
+        else:
+            batch = self._gather(indices.reshape(-1))
+        return {
+            key: value.reshape(tuple(indices.shape) + tuple(value.shape[1:]))
+            for key, value in batch.items()
+        }
+
+    def _gather(self, indices):
         batch = dict(
-            observations=self._observations[indices],
+            observations=self._decode_observations(self._observations[indices]),
             actions=self._actions[indices],
             rewards=self._rewards[indices],
             terminals=self._terminals[indices],
-            next_observations=self._next_obs[indices],
-            masks=self._mask[indices],
+            next_observations=self._decode_observations(self._get_next_observations(indices)),
+            masks=self._unpack_mask(self._mask[indices]).astype(np.float32),
         )
         for key in self._env_info_keys:
             assert key not in batch.keys()
             batch[key] = self._env_infos[key][indices]
         return batch
 
+    def _gather_torch(self, indices):
+        batch = dict(
+            observations=self._observations.index_select(0, indices).float(),
+            actions=self._actions.index_select(0, indices),
+            rewards=self._rewards.index_select(0, indices),
+            terminals=self._terminals.index_select(0, indices).float(),
+            next_observations=self._next_obs.index_select(0, indices).float(),
+            masks=self._unpack_mask(self._mask.index_select(0, indices)).float(),
+        )
+        for key in self._env_info_keys:
+            assert key not in batch.keys()
+            batch[key] = self._env_infos[key].index_select(0, indices)
+        return batch
+
     def rebuild_env_info_dict(self, idx):
         return {
             key: self._env_infos[key][idx]
@@ -191,38 +588,257 @@ class EnsembleSimpleReplayBuffer(EnsembleReplayBuffer):
         ])
     
     def save_buffer(self, epoch):
+        write_checkpoint(*self.get_checkpoint(epoch))
+
+    def get_checkpoint(self, epoch):
+        """
+        Snapshot of the buffer for save_buffer, as (files, finalize) for
+        rlkit.core.checkpoint_writer. The payloads are copies, so they can be
+        written on another thread while the buffer keeps changing.
+        """
         path = self.buffer_dir + '/replay_%d.pt' % (epoch)
-        payload = [
-            self._observations[:self._size],
-            self._actions[:self._size],
-            self._rewards[:self._size],
-            self._terminals[:self._size],
-            self._next_obs[:self._size],
-            self._mask[:self._size],
-            self._size,
-        ]
-        torch.save(payload, path)
+        if self._storage == 'memmap':
+            for array in self._named_arrays().values():
+                array.flush()
+        if self._incremental_checkpoints:
+            files = self._checkpoint_chunk_files(epoch, path)
+        else:
+            payload = [
+                self._host_copy(self._observations),
+                self._host_copy(self._actions),
+                self._host_copy(self._rewards),
+                self._host_copy(self._terminals),
+                self._get_next_observations(np.arange(self._size)) if self._single_copy_obs
+                else self._host_copy(self._next_obs),
+                self._host_mask(),
+                self._size,
+            ]
+            files = [(path, torch_save, payload)]
+        return files, partial(self._apply_checkpoint_retention, epoch)
 
     def load_buffer(self, epoch):
         path = self.buffer_dir + '/replay_%d.pt' % (epoch)
         payload = torch.load(path, weights_only=False)
+        if isinstance(payload, dict) and payload.get('storage') == 'chunks':
+            self._load_checkpoint_chunks(epoch, payload)
+            return
         size = payload[0].shape[0]
-        # Expand arrays to max_replay_buffer_size, fill with zeros, then copy loaded data
-        self._observations = np.zeros((self._max_replay_buffer_size, self._observation_dim))
-        self._observations[:size] = payload[0]
-        self._actions = np.zeros((self._max_replay_buffer_size, self._action_dim))
-        self._actions[:size] = payload[1]
-        self._rewards = np.zeros((self._max_replay_buffer_size, 1))
-        self._rewards[:size] = payload[2]
-        self._terminals = np.zeros((self._max_replay_buffer_size, 1), dtype='uint8')
-        self._terminals[:size] = payload[3]
-        self._next_obs = np.zeros((self._max_replay_buffer_size, self._observation_dim))
-        self._next_obs[:size] = payload[4]
-        self._mask = np.zeros((self._max_replay_buffer_size, self._mask.shape[1]))
-        self._mask[:size] = payload[5]
+        # Expand arrays to max_replay_buffer_size, fill with zeros, then copy
+        # loaded data. Buffers saved in another dtype are converted.
+        rows = slice(0, size)
+        self._observations = self._zeros_observations('observations')
+        self._set_rows(self._observations, rows, self._load_observations(payload[0]))
+        self._actions = self._zeros('actions', (self._max_replay_buffer_size, self._action_dim), np.float32)
+        self._set_rows(self._actions, rows, payload[1])
+        self._rewards = self._zeros('rewards', (self._max_replay_buffer_size, 1), np.float32)
+        self._set_rows(self._rewards, rows, payload[2])
+        self._terminals = self._zeros('terminals', (self._max_replay_buffer_size, 1), np.uint8)
+        self._set_rows(self._terminals, rows, payload[3])
+        self._reset_mask(np.shape(payload[5])[1])
+        self._set_rows(self._mask, rows, self._pack_mask(payload[5]))
+        if self._single_copy_obs:
+            self._size = 0
+            self._next_obs_linked[:] = False
+            self._episode_next_obs = {}
+            self._link_next_observations(
+                0, self._observations[:size], self._load_observations(payload[4]))
+        else:
+            self._next_obs = self._zeros_observations('next_obs')
+            self._set_rows(self._next_obs, rows, self._load_observations(payload[4]))
         self._size = size
         self._top = self._size % self._max_replay_buffer_size
+        self._num_added = size
+        self._num_checkpointed = 0
+        self._checkpoint_chunks = []
+
+    def _chunk_arrays(self):
+        """
+        The per-row arrays stored in chunks: everything but the masks.
+        """
+        return {
+            name: array for name, array in self._named_arrays().items()
+            if array is not None and name != 'mask'
+        }
+
+    def _checkpoint_chunk_files(self, epoch, path):
+        """
+        A chunk file of the rows added since the last checkpoint (if any),
+        then the manifest of the checkpoint, which drops the chunks that no
+        longer hold live rows.
+        """
+        size = self._max_replay_buffer_size
+        num_rows = min(self._num_added - self._num_checkpointed, size)
+        files = []
+        if num_rows > 0:
+            first = self._num_added - num_rows
+            rows = (self._top - num_rows + np.arange(num_rows)) % size
+            name = 'chunk_%d_%d.npz' % (first, self._num_added)
+            files.append((
+                os.path.join(self.buffer_dir, name),
+                npz_save,
+                {key: array[rows] for key, array in self._chunk_arrays().items()},
+            ))
+            self._checkpoint_chunks.append(dict(name=name, first=first, num_rows=num_rows))
+            self._num_checkpointed = self._num_added
+        first_live = self._num_added - self._size
+        self._checkpoint_chunks = [
+            chunk for chunk in self._checkpoint_chunks
+            if chunk['first'] + chunk['num_rows'] > first_live
+        ]
+        self._manifest_chunks[epoch] = [chunk['name'] for chunk in self._checkpoint_chunks]
+        manifest = dict(
+            storage='chunks',
+            size=self._size,
+            top=self._top,
+            num_added=self._num_added,
+            chunks=list(self._checkpoint_chunks),
+            mask=self._host_mask(),
+        )
+        if self._single_copy_obs:
+            manifest['next_obs_linked'] = self._next_obs_linked.copy()
+            manifest['episode_next_obs'] = dict(self._episode_next_obs)
+        files.append((path, torch_save, manifest))
+        return files
+
+    def _load_checkpoint_chunks(self, epoch, manifest):
+        """
+        Reassemble the ring buffer from the chunks of a manifest, writing
+        them oldest first so that newer rows overwrite older ones.
+        """
+        size = self._max_replay_buffer_size
+        offset = manifest['top'] - manifest['num_added']
+        arrays = self._chunk_arrays()
+        for chunk in manifest['chunks']:
+            rows = (chunk['first'] + offset + np.arange(chunk['num_rows'])) % size
+            with np.load(os.path.join(self.buffer_dir, chunk['name'])) as data:
+                for key, array in arrays.items():
+                    array[rows] = data[key]
+        mask = manifest['mask']
+        self._reset_mask(mask.shape[1])
+        self._mask[:len(mask)] = self._pack_mask(mask)
+        if self._single_copy_obs:
+            self._next_obs_linked[:] = manifest['next_obs_linked']
+            self._episode_next_obs = dict(manifest['episode_next_obs'])
+        self._size = manifest['size']
+        self._top = manifest['top']
+        self._num_added = manifest['num_added']
+        self._num_checkpointed = self._num_added
+        self._checkpoint_chunks = list(manifest['chunks'])
+        self._manifest_chunks[epoch] = [chunk['name'] for chunk in manifest['chunks']]
+
+    def _checkpoint_files(self, epoch):
+        return ['replay_%d.pt' % epoch]
+
+    def _apply_checkpoint_retention(self, epoch):
+        """
+        Delete the checkpoints that are neither among the last
+        keep_last_checkpoints nor at a multiple of keep_checkpoint_every
+        epochs, then the chunks no kept checkpoint uses.
+        """
+        if self._keep_last_checkpoints is None:
+            return
+        epochs = []
+        for file in os.listdir(self.buffer_dir):
+            match = re.match(r'replay_(\d+)\.pt$', file)
+            if match:
+                epochs.append(int(match.group(1)))
+        epochs.sort()
+        kept = set(epochs[max(len(epochs) - self._keep_last_checkpoints, 0):]) | {epoch}
+        if self._keep_checkpoint_every:
+            kept.update(e for e in epochs if e % self._keep_checkpoint_every == 0)
+        for old_epoch in set(epochs) - kept:
+            for file in self._checkpoint_files(old_epoch):
+                path = os.path.join(self.buffer_dir, file)
+                if os.path.exists(path):
+                    os.remove(path)
+            self._manifest_chunks.pop(old_epoch, None)
+        if not self._incremental_checkpoints:
+            return
+
+        used_chunks = set()
+        for kept_epoch in kept:
+            if kept_epoch not in self._manifest_chunks:
+                manifest = torch.load(self.buffer_dir + '/replay_%d.pt' % kept_epoch, weights_only=False)
+                chunks = manifest.get('chunks', []) if isinstance(manifest, dict) else []
+                self._manifest_chunks[kept_epoch] = [chunk['name'] for chunk in chunks]
+            used_chunks.update(self._manifest_chunks[kept_epoch])
+        for file in os.listdir(self.buffer_dir):
+            if re.match(r'chunk_\d+_\d+\.npz$', file) and file not in used_chunks:
+                os.remove(os.path.join(self.buffer_dir, file))
+
+    def _load_observations(self, observations):
+        if self._storage == 'torch':
+            if observations.dtype == np.int16:
+                # The raw bits of bfloat16 observations
+                return torch.from_numpy(observations).view(torch.bfloat16)
+            return observations
+        if observations.dtype == self._observations.dtype:
+            return observations
+        return self._encode_observations(observations)
         
+def _to_numpy(values):
+    if isinstance(values, torch.Tensor):
+        return ptu.get_numpy(values)
+    return values
+
+
+class ReplayBufferSink(object):
+    """
+    Streams the steps of one rollout straight into the rows of an
+    EnsembleSimpleReplayBuffer as they happen. It has the interface of
+    PathBuilder, so rollouts can write to either.
+
+    Only the agent and env infos are kept on the side. get_all_stacked reads
+    the actions, rewards and terminals of the path back from the buffer for
+    the path statistics. The observations and masks stay in the buffer only.
+    """
+
+    def __init__(self, replay_buffer):
+        self._replay_buffer = replay_buffer
+        self._rows = []
+        self._agent_infos = []
+        self._env_infos = []
+
+    def add_all(
+            self,
+            observations,
+            actions,
+            rewards,
+            next_observations,
+            terminals,
+            masks,
+            agent_infos,
+            env_infos,
+    ):
+        self._rows.append(self._replay_buffer._top)
+        self._replay_buffer.add_sample(
+            observation=observations,
+            action=actions,
+            reward=rewards,
+            next_observation=next_observations,
+            terminal=terminals,
+            mask=masks,
+            agent_info=agent_infos,
+            env_info=env_infos,
+        )
+        self._agent_infos.append(agent_infos)
+        self._env_infos.append(env_infos)
+
+    def get_all_stacked(self):
+        self._replay_buffer.terminate_episode()
+        rows = np.array(self._rows, dtype=int)
+        return dict(
+            actions=_to_numpy(self._replay_buffer._actions[rows]),
+            rewards=_to_numpy(self._replay_buffer._rewards[rows]),
+            terminals=_to_numpy(self._replay_buffer._terminals[rows]),
+            agent_infos=self._agent_infos,
+            env_infos=self._env_infos,
+        )
+
+    def __len__(self):
+        return len(self._rows)
+
+
 class RandomReplayBuffer(ReplayBuffer):
 
     def __init__(
@@ -1,8 +1,14 @@
 from collections import deque, OrderedDict
 
+import numpy as np
+import torch
+from gymnasium.vector import AutoresetMode, VectorEnv
+
 from rlkit.core.eval_util import create_stats_ordered_dict
+from rlkit.data_management.path_builder import PathBuilder
+from rlkit.data_management.simple_replay_buffer import ReplayBufferSink
 from rlkit.samplers.rollout_functions import rollout, multitask_rollout, ensemble_rollout, ensemble_eval_rollout
-from rlkit.samplers.rollout_functions import ensemble_ucb_rollout
+from rlkit.samplers.rollout_functions import ensemble_ucb_rollout, get_ucb_actions, EVAL_AGGREGATIONS
 from rlkit.samplers.data_collector.base import PathCollector
 
 class MdpPathCollector(PathCollector):
@@ -140,6 +146,8 @@ class EnsembleMdpPathCollector(PathCollector):
             critic2=None,
             inference_type=0.0,
             feedback_type=1,
+            eval_aggregation='mean',
+            replay_buffer=None,
     ):
         if render_kwargs is None:
             render_kwargs = {}
@@ -156,6 +164,13 @@ class EnsembleMdpPathCollector(PathCollector):
         self.critic2 = critic2
         self.inference_type = inference_type
         self.feedback_type = feedback_type
+        if eval_aggregation not in EVAL_AGGREGATIONS:
+            raise ValueError("Unknown eval_aggregation: {}".format(eval_aggregation))
+        self.eval_aggregation = eval_aggregation
+        if replay_buffer is not None and eval_flag:
+            raise ValueError("Evaluation paths are not stored in a replay buffer")
+        # Exploration steps are streamed straight into this buffer if given
+        self.replay_buffer = replay_buffer
         self._noise_flag = noise_flag
         
         self._num_steps_total = 0
@@ -167,6 +182,7 @@ class EnsembleMdpPathCollector(PathCollector):
             num_steps,
             discard_incomplete_paths,
     ):
+        _check_discard(self.replay_buffer, discard_incomplete_paths)
         paths = []
         num_steps_collected = 0
         while num_steps_collected < num_steps:
@@ -180,6 +196,10 @@ class EnsembleMdpPathCollector(PathCollector):
                     self._policy,
                     self.num_ensemble,
                     max_path_length=max_path_length_this_loop,
+                    aggregation=self.eval_aggregation,
+                    critic1=self.critic1,
+                    critic2=self.critic2,
+                    inference_type=self.inference_type,
                 )
             else:
                 if self.inference_type > 0: # UCB
@@ -194,6 +214,7 @@ class EnsembleMdpPathCollector(PathCollector):
                         noise_flag=self._noise_flag,
                         max_path_length=max_path_length_this_loop,
                         ber_mean=self.ber_mean,
+                        sink=_new_sink(self.replay_buffer),
                     )
                 else:
                     path = ensemble_rollout(
@@ -203,6 +224,7 @@ class EnsembleMdpPathCollector(PathCollector):
                         noise_flag=self._noise_flag,
                         max_path_length=max_path_length_this_loop,
                         ber_mean=self.ber_mean,
+                        sink=_new_sink(self.replay_buffer),
                     )
             path_len = len(path['actions'])
             if (
@@ -243,7 +265,45 @@ class EnsembleMdpPathCollector(PathCollector):
             policy=self._policy,
         )
 
+def _check_discard(replay_buffer, discard_incomplete_paths):
+    if replay_buffer is not None and discard_incomplete_paths:
+        raise ValueError("Paths streamed into a replay buffer cannot be discarded")
+
+
+def _new_sink(replay_buffer):
+    """
+    Where the steps of a new path go: straight into replay_buffer if given,
+    else into a PathBuilder.
+    """
+    if replay_buffer is None:
+        return PathBuilder()
+    return ReplayBufferSink(replay_buffer)
+
+
+def _sub_env_info(infos, index):
+    """
+    The info dict of sub-environment `index` from the dict of arrays returned
+    by a vector env. Keys the sub-environment did not report (see the `_key`
+    masks) are left out.
+    """
+    info = {}
+    for key, value in infos.items():
+        if key.startswith('_'):
+            continue
+        reported = infos.get('_' + key)
+        if reported is not None and not reported[index]:
+            continue
+        info[key] = _sub_env_info(value, index) if isinstance(value, dict) else value[index]
+    return info
+
+
 class DynamicEnsembleMdpPathCollector(PathCollector):
+    """
+    `env` can also be a gymnasium vector env (SyncVectorEnv or
+    AsyncVectorEnv) for exploration. Its sub-environments are stepped in
+    lockstep with one batched policy call per step and the paths come out in
+    the same format as with a single env, see _collect_vec_paths.
+    """
     def __init__(
             self,
             env,
@@ -256,6 +316,8 @@ class DynamicEnsembleMdpPathCollector(PathCollector):
             render_kwargs=None,
             inference_type=0.0,
             feedback_type=1,
+            eval_aggregation='mean',
+            replay_buffer=None,
     ):
         if render_kwargs is None:
             render_kwargs = {}
@@ -269,17 +331,38 @@ class DynamicEnsembleMdpPathCollector(PathCollector):
         self.ber_mean = ber_mean
         self.inference_type = inference_type
         self.feedback_type = feedback_type
+        if eval_aggregation not in EVAL_AGGREGATIONS:
+            raise ValueError("Unknown eval_aggregation: {}".format(eval_aggregation))
+        self.eval_aggregation = eval_aggregation
+        if replay_buffer is not None and eval_flag:
+            raise ValueError("Evaluation paths are not stored in a replay buffer")
+        # Exploration steps are streamed straight into this buffer if given
+        self.replay_buffer = replay_buffer
         self._noise_flag = noise_flag
         
         self._num_steps_total = 0
         self._num_paths_total = 0
 
+        self._vec_env = isinstance(env, VectorEnv)
+        if self._vec_env:
+            if eval_flag:
+                raise ValueError("Vector envs are only supported for exploration")
+            if env.metadata.get('autoreset_mode') == AutoresetMode.SAME_STEP:
+                raise ValueError("Vector envs with AutoresetMode.SAME_STEP are not supported")
+        # cache variables of the vector env episodes
+        self._vec_obs = None
+        self._vec_path_lengths = None
+        self._vec_members = None
+
     def collect_new_paths(
             self,
             max_path_length,
             num_steps,
             discard_incomplete_paths,
     ):
+        _check_discard(self.replay_buffer, discard_incomplete_paths)
+        if self._vec_env:
+            return self._collect_vec_paths(max_path_length, num_steps, discard_incomplete_paths)
 
         if self.eval_flag:
             policy = self.ensemble.get_eval_policies()
@@ -305,6 +388,11 @@ class DynamicEnsembleMdpPathCollector(PathCollector):
                     policy,
                     num_ensemble,
                     max_path_length=max_path_length_this_loop,
+                    aggregation=self.eval_aggregation,
+                    critic1=critic1,
+                    critic2=critic2,
+                    inference_type=self.inference_type,
+                    ensemble=self.ensemble,
                 )
             else:
                 if self.inference_type > 0: # UCB
@@ -319,6 +407,8 @@ class DynamicEnsembleMdpPathCollector(PathCollector):
                         noise_flag=self._noise_flag,
                         max_path_length=max_path_length_this_loop,
                         ber_mean=self.ber_mean,
+                        ensemble=self.ensemble,
+                        sink=_new_sink(self.replay_buffer),
                     )
                 else:
                     path = ensemble_rollout(
@@ -328,6 +418,7 @@ class DynamicEnsembleMdpPathCollector(PathCollector):
                         noise_flag=self._noise_flag,
                         max_path_length=max_path_length_this_loop,
                         ber_mean=self.ber_mean,
+                        sink=_new_sink(self.replay_buffer),
                     )
             path_len = len(path['actions'])
             if (
@@ -343,6 +434,97 @@ class DynamicEnsembleMdpPathCollector(PathCollector):
         self._epoch_paths.extend(paths)
         return paths
 
+    def _collect_vec_paths(
+            self,
+            max_path_length,
+            num_steps,
+            discard_incomplete_paths,
+    ):
+        """
+        Step every sub-environment of the vector env until at least
+        `num_steps` transitions are collected (num_steps rounded up to a
+        multiple of num_envs).
+
+        Each sub-environment follows the policy of its own randomly drawn
+        member for a whole episode (or the UCB choice if inference_type > 0),
+        and the actions of all of them come from one batched call. Episodes
+        are carried over between calls: episodes still running when the call
+        ends are returned as incomplete paths and continued by the next call.
+        """
+        env = self._env
+        num_envs = env.num_envs
+        num_ensemble = len(self.ensemble)
+        policies = self.ensemble.get_policies()
+        critic1 = self.ensemble.get_critic1s()
+        critic2 = self.ensemble.get_critic2s()
+
+        if self._vec_obs is None:
+            self._vec_obs, _ = env.reset()
+            self._vec_path_lengths = np.zeros(num_envs, dtype=int)
+        if self._vec_members is None or self._vec_members.max() >= num_ensemble:
+            # Members drawn before the ensemble shrank may no longer exist
+            self._vec_members = np.random.randint(num_ensemble, size=num_envs)
+
+        builders = [_new_sink(self.replay_buffer) for _ in range(num_envs)]
+        paths = []
+        num_steps_stepped = 0
+        while num_steps_stepped < num_steps:
+            obs = self._vec_obs
+            if self.inference_type > 0: # UCB
+                actions, policy_index = get_ucb_actions(
+                    obs,
+                    policies,
+                    critic1,
+                    critic2,
+                    self.inference_type,
+                    self.feedback_type,
+                    ensemble=self.ensemble,
+                )
+            else:
+                actions = self.ensemble.get_member_actions(obs, self._vec_members)
+                policy_index = self._vec_members
+            next_obs, rewards, terms, truncs, env_infos = env.step(actions)
+            dones = np.logical_or(terms, truncs)
+            if self._noise_flag == 1:
+                rewards = rewards + np.random.normal(0, 1, num_envs)
+            masks = torch.bernoulli(torch.full((num_envs, num_ensemble), self.ber_mean))
+            empty = masks.sum(dim=1) == 0
+            masks[empty, torch.randint(num_ensemble, (int(empty.sum()),))] = 1
+            masks = masks.numpy()
+
+            self._vec_path_lengths += 1
+            for k in range(num_envs):
+                builders[k].add_all(
+                    observations=obs[k],
+                    actions=actions[k],
+                    rewards=np.array([rewards[k]]),
+                    next_observations=next_obs[k],
+                    terminals=np.array([dones[k]]),
+                    agent_infos={"policy_id": policies[policy_index[k]].id},
+                    env_infos=_sub_env_info(env_infos, k),
+                    masks=masks[k],
+                )
+            num_steps_stepped += num_envs
+
+            ends = dones | (self._vec_path_lengths >= max_path_length)
+            if ends.any():
+                for k in np.flatnonzero(ends):
+                    paths.append(builders[k].get_all_stacked())
+                    builders[k] = _new_sink(self.replay_buffer)
+                reset_obs, _ = env.reset(options={'reset_mask': ends})
+                next_obs = next_obs.copy()
+                next_obs[ends] = reset_obs[ends]
+                self._vec_path_lengths[ends] = 0
+                self._vec_members[ends] = np.random.randint(num_ensemble, size=int(ends.sum()))
+            self._vec_obs = next_obs
+
+        if not discard_incomplete_paths:
+            paths.extend(builder.get_all_stacked() for builder in builders if len(builder) > 0)
+        self._num_paths_total += len(paths)
+        self._num_steps_total += sum(len(path['actions']) for path in paths)
+        self._epoch_paths.extend(paths)
+        return paths
+
     def get_epoch_paths(self):
         return self._epoch_paths
 
@@ -1,5 +1,6 @@
 import numpy as np
 import torch 
+from rlkit.data_management.path_builder import PathBuilder
 from rlkit.torch import pytorch_util as ptu
 
 def multitask_rollout(
@@ -152,6 +153,14 @@ def rollout(
     )
 
 
+def _bootstrap_mask(num_ensemble, ber_mean):
+    mask = torch.bernoulli(torch.Tensor([ber_mean]*num_ensemble))
+    if mask.sum() == 0:
+        rand_index = np.random.randint(num_ensemble, size=1)
+        mask[rand_index] = 1
+    return mask.numpy()
+
+
 def ensemble_rollout(
         env,
         agent,
@@ -161,6 +170,7 @@ def ensemble_rollout(
         ber_mean=0.5,
         render=False,
         render_kwargs=None,
+        sink=None,
 ):
     """
     The following value for the following keys will be a 2D array, with the
@@ -170,25 +180,24 @@ def ensemble_rollout(
      - rewards
      - next_observations
      - terminals
+     - masks
 
     The next two elements will be lists of dictionaries, with the index into
     the list being the index into the time
      - agent_infos
      - env_infos
+
+    :param sink: Receives every step as it happens, through the PathBuilder
+    interface. Defaults to a new PathBuilder; a ReplayBufferSink writes the
+    steps straight into a replay buffer instead.
     """
     if render_kwargs is None:
         render_kwargs = {}
-    observations = []
-    actions = []
-    rewards = []
-    terminals = []
-    agent_infos = []
-    env_infos = []
-    masks = [] # mask for bootstrapping
+    if sink is None:
+        sink = PathBuilder()
     o, _ = env.reset()
     en_index = np.random.randint(num_ensemble)
     agent[en_index].reset()
-    next_o = None
     path_length = 0
     if render:
         env.render(**render_kwargs)
@@ -198,94 +207,130 @@ def ensemble_rollout(
         d = term or trun
         if noise_flag == 1:
             r += np.random.normal(0,1,1)[0]
-        observations.append(o)
-        rewards.append(r)
-        terminals.append(d)
-        actions.append(a)
-        agent_infos.append(agent_info)
-        env_infos.append(env_info)
-        mask = torch.bernoulli(torch.Tensor([ber_mean]*num_ensemble))
-        if mask.sum() == 0:
-            rand_index = np.random.randint(num_ensemble, size=1)
-            mask[rand_index] = 1
-        mask = mask.numpy()
-        masks.append(mask)
-  
+        sink.add_all(
+            observations=o,
+            actions=a,
+            rewards=np.array([r]),
+            next_observations=next_o,
+            terminals=np.array([d]),
+            masks=_bootstrap_mask(num_ensemble, ber_mean),
+            agent_infos=agent_info,
+            env_infos=env_info,
+        )
         path_length += 1
         if d:
             break
         o = next_o
         if render:
             env.render(**render_kwargs)
-    
-    actions = np.array(actions)
-    if len(actions.shape) == 1:
-        actions = np.expand_dims(actions, 1)
-    observations = np.array(observations)
-    if len(observations.shape) == 1:
-        observations = np.expand_dims(observations, 1)
-        next_o = np.array([next_o])
-    next_observations = np.vstack(
-        (
-            observations[1:, :],
-            np.expand_dims(next_o, 0)
-        )
-    )
-    masks = np.array(masks)
+    return sink.get_all_stacked()
 
-    return dict(
-        observations=observations,
-        actions=actions,
-        rewards=np.array(rewards).reshape(-1, 1),
-        next_observations=next_observations,
-        terminals=np.array(terminals).reshape(-1, 1),
-        agent_infos=agent_infos,
-        env_infos=env_infos,
-        masks=masks,
+
+def _ensemble_actions(obs, agent, ensemble=None, deterministic=False):
+    """
+    The actions of every policy of the ensemble on a [batch, obs_dim] tensor,
+    as a [num_ensemble, batch, action_dim] tensor. Policies wrapped in
+    MakeDeterministic are evaluated through the policy they wrap.
+    """
+    if ensemble is not None:
+        return ensemble.policy_forward(obs, deterministic=deterministic)[0]
+    return torch.stack([
+        getattr(policy, 'stochastic_policy', policy)(obs, deterministic=deterministic)[0]
+        for policy in agent
+    ])
+
+
+def _candidate_q_values(obs, candidates, critic1, critic2, ensemble=None):
+    """
+    Q1 and Q2 of every member's critics on every candidate action.
+
+    :param obs: [batch, obs_dim] tensor
+    :param candidates: [num_candidates, batch, action_dim] tensor
+    :return: Two [num_critics, num_candidates, batch] tensors
+    """
+    num_candidates, batch_size = candidates.shape[:2]
+    candidates = candidates.reshape(num_candidates * batch_size, -1)
+    obs = obs.repeat(num_candidates, 1)
+    if ensemble is not None:
+        Q1, Q2 = ensemble.critic_forward(obs, candidates)
+    else:
+        Q1 = torch.stack([qf(obs, candidates) for qf in critic1])
+        Q2 = torch.stack([qf(obs, candidates) for qf in critic2])
+    return (
+        Q1.reshape(-1, num_candidates, batch_size),
+        Q2.reshape(-1, num_candidates, batch_size),
     )
 
 
-def get_ucb_std(obs, policy_action, inference_type, critic1, critic2, 
-                feedback_type, en_index, num_ensemble):
-    obs = ptu.from_numpy(obs).float()
-    policy_action = ptu.from_numpy(policy_action).float()
-    obs = obs.reshape(1,-1)
-    policy_action = policy_action.reshape(1,-1)
-    
-    if feedback_type == 0 or feedback_type==2:
-        with torch.no_grad():
-            target_Q1 = critic1[en_index](obs, policy_action)
-            target_Q2 = critic2[en_index](obs, policy_action)
-        mean_Q = 0.5*(target_Q1.detach() + target_Q2.detach())
-        var_Q = 0.5*((target_Q1.detach() - mean_Q)**2 + (target_Q2.detach() - mean_Q)**2)
-        ucb_score = mean_Q + inference_type * torch.sqrt(var_Q).detach()
-
-    elif feedback_type == 1 or feedback_type==3:
-        mean_Q, var_Q = None, None
-        L_target_Q = []
-        for en_index in range(num_ensemble):
-            with torch.no_grad():
-                target_Q1 = critic1[en_index](obs, policy_action)
-                target_Q2 = critic2[en_index](obs, policy_action)
-                L_target_Q.append(target_Q1)
-                L_target_Q.append(target_Q2)
-                if en_index == 0:
-                    mean_Q = 0.5*(target_Q1 + target_Q2) / num_ensemble
-                else:
-                    mean_Q += 0.5*(target_Q1 + target_Q2) / num_ensemble
-
-        temp_count = 0
-        for target_Q in L_target_Q:
-            if temp_count == 0:
-                var_Q = (target_Q.detach() - mean_Q)**2
+def get_ucb_actions(
+        obs,
+        agent,
+        critic1,
+        critic2,
+        inference_type,
+        feedback_type,
+        ensemble=None,
+        deterministic=False,
+):
+    """
+    Select, for every observation of a batch, the candidate action with the
+    highest UCB score among the actions sampled by every policy of the
+    ensemble, like get_action + get_ucb_std for each policy in turn, but with
+    one batched policy evaluation and one batched critic evaluation:
+     - feedback_type 0/2: each member's candidate is scored by its own critics
+     - feedback_type 1/3: every candidate is scored by the critics of every
+       member
+
+    If `ensemble` is given (an Ensemble from examples/sunrise_ensemble.py),
+    its batched policy_forward / critic_forward are used instead of looping
+    over the networks in agent / critic1 / critic2.
+
+    :param obs: [batch, obs_dim] numpy array
+    :param deterministic: Use the mean action of every policy as its
+    candidate instead of a sample.
+    :return: The selected actions as a [batch, action_dim] numpy array and the
+    index of the policy that proposed each of them.
+    """
+    obs = ptu.from_numpy(obs)
+    batch_size = obs.shape[0]
+    with torch.no_grad():
+        actions = _ensemble_actions(obs, agent, ensemble, deterministic)
+        num_ensemble = actions.shape[0]
+
+        if feedback_type == 0 or feedback_type == 2:
+            # [num_ensemble, batch, 1]: member i on its own candidates
+            if ensemble is not None:
+                Q1, Q2 = ensemble.critic_forward(obs, actions)
             else:
-                var_Q += (target_Q.detach() - mean_Q)**2
-            temp_count += 1
-        var_Q = var_Q / temp_count
-        ucb_score = mean_Q + inference_type * torch.sqrt(var_Q).detach()
-        
-    return ucb_score
-    
+                Q1 = torch.stack([qf(obs, action) for qf, action in zip(critic1, actions)])
+                Q2 = torch.stack([qf(obs, action) for qf, action in zip(critic2, actions)])
+            mean_Q = 0.5*(Q1 + Q2)
+            var_Q = 0.5*((Q1 - mean_Q)**2 + (Q2 - mean_Q)**2)
+        else:
+            # [num_ensemble, num_ensemble, batch]: member i on candidate j
+            Q1, Q2 = _candidate_q_values(obs, actions, critic1, critic2, ensemble)
+            L_target_Q = torch.cat((Q1, Q2))
+            mean_Q = L_target_Q.mean(dim=0)
+            var_Q = ((L_target_Q - mean_Q)**2).mean(dim=0)
+        ucb_score = (mean_Q + inference_type * torch.sqrt(var_Q)).reshape(num_ensemble, batch_size)
+
+        # argmax keeps the first of equal scores, as the sequential comparison did
+        index = torch.argmax(ucb_score, dim=0)
+        actions = actions[index, torch.arange(batch_size, device=index.device)]
+    return ptu.get_numpy(actions), ptu.get_numpy(index)
+
+
+def get_ucb_action(obs, agent, critic1, critic2, inference_type, feedback_type, ensemble=None):
+    """
+    get_ucb_actions for a single observation.
+
+    Returns the action as a numpy array and the agent info of its policy.
+    """
+    actions, index = get_ucb_actions(
+        obs.reshape(1, -1), agent, critic1, critic2, inference_type, feedback_type, ensemble=ensemble,
+    )
+    return actions[0], {"policy_id": agent[index[0]].id}
+
 def ensemble_ucb_rollout(
         env,
         agent,
@@ -299,104 +344,108 @@ def ensemble_ucb_rollout(
         ber_mean=0.5,
         render=False,
         render_kwargs=None,
+        ensemble=None,
+        sink=None,
 ):
     """
-    The following value for the following keys will be a 2D array, with the
-    first dimension corresponding to the time dimension.
-     - observations
-     - actions
-     - rewards
-     - next_observations
-     - terminals
-
-    The next two elements will be lists of dictionaries, with the index into
-    the list being the index into the time
-     - agent_infos
-     - env_infos
+    Like ensemble_rollout, except that the action of each step is chosen by
+    get_ucb_action.
     """
     if render_kwargs is None:
         render_kwargs = {}
-    observations = []
-    actions = []
-    rewards = []
-    terminals = []
-    agent_infos = []
-    env_infos = []
-    masks = [] # mask for bootstrapping
+    if sink is None:
+        sink = PathBuilder()
     o, _ = env.reset()
     for en_index in range(num_ensemble):
         agent[en_index].reset()
-    next_o = None
     path_length = 0
     if render:
         env.render(**render_kwargs)
         
     while path_length < max_path_length:
-        a_max, ucb_max, agent_info_max = None, None, None
-        for en_index in range(num_ensemble):
-            _a, agent_info = agent[en_index].get_action(o)
-            ucb_score = get_ucb_std(o, _a, inference_type, critic1, critic2,
-                                    feedback_type, en_index, num_ensemble)
-            
-            if en_index == 0:
-                a_max = _a
-                ucb_max = ucb_score
-                agent_info_max = agent_info
-            else:
-                if ucb_score > ucb_max:
-                    ucb_max = ucb_score
-                    a_max = _a
-                    agent_info_max = agent_info
+        a_max, agent_info_max = get_ucb_action(
+            o, agent, critic1, critic2, inference_type, feedback_type, ensemble=ensemble,
+        )
 
         next_o, r, trunc, term, env_info = env.step(a_max)
         d = term or trunc
         if noise_flag == 1:
             r += np.random.normal(0,1,1)[0]
-        observations.append(o)
-        rewards.append(r)
-        terminals.append(d)
-        actions.append(a_max)
-        agent_infos.append(agent_info_max)
-        env_infos.append(env_info)
-        mask = torch.bernoulli(torch.Tensor([ber_mean]*num_ensemble))
-        if mask.sum() == 0:
-            rand_index = np.random.randint(num_ensemble, size=1)
-            mask[rand_index] = 1
-        mask = mask.numpy()
-        masks.append(mask)
-  
+        sink.add_all(
+            observations=o,
+            actions=a_max,
+            rewards=np.array([r]),
+            next_observations=next_o,
+            terminals=np.array([d]),
+            masks=_bootstrap_mask(num_ensemble, ber_mean),
+            agent_infos=agent_info_max,
+            env_infos=env_info,
+        )
         path_length += 1
         if d:
             break
         o = next_o
         if render:
             env.render(**render_kwargs)
-    
-    actions = np.array(actions)
-    if len(actions.shape) == 1:
-        actions = np.expand_dims(actions, 1)
-    observations = np.array(observations)
-    if len(observations.shape) == 1:
-        observations = np.expand_dims(observations, 1)
-        next_o = np.array([next_o])
-    next_observations = np.vstack(
-        (
-            observations[1:, :],
-            np.expand_dims(next_o, 0)
-        )
-    )
-    masks = np.array(masks)
+    return sink.get_all_stacked()
 
-    return dict(
-        observations=observations,
-        actions=actions,
-        rewards=np.array(rewards).reshape(-1, 1),
-        next_observations=next_observations,
-        terminals=np.array(terminals).reshape(-1, 1),
-        agent_infos=agent_infos,
-        env_infos=env_infos,
-        masks=masks,
-    )
+
+EVAL_AGGREGATIONS = ('mean', 'median', 'ucb', 'vote')
+
+
+def get_ensemble_eval_actions(
+        obs,
+        agent,
+        aggregation='mean',
+        critic1=None,
+        critic2=None,
+        inference_type=0.0,
+        ensemble=None,
+):
+    """
+    Combine the deterministic actions of every policy of the ensemble into
+    one action per observation:
+     - mean: the average action
+     - median: the per-dimension median action (the lower one of the two
+       middle actions for an even ensemble size)
+     - ucb: the action with the highest UCB score under the critics of every
+       member, see get_ucb_actions
+     - vote: every member votes for the action its critics rate highest and
+       the action with the most votes wins, ties going to the lowest index
+
+    If `ensemble` is given, the whole ensemble is evaluated with its batched
+    policy_forward / critic_forward.
+
+    :param obs: [batch, obs_dim] numpy array
+    :return: The actions as a [batch, action_dim] numpy array and, for ucb
+    and vote, the index of the policy that proposed each of them (None for
+    mean and median).
+    """
+    if aggregation == 'ucb':
+        return get_ucb_actions(
+            obs, agent, critic1, critic2, inference_type, 1, ensemble=ensemble, deterministic=True,
+        )
+    obs = ptu.from_numpy(obs)
+    with torch.no_grad():
+        actions = _ensemble_actions(obs, agent, ensemble, deterministic=True)
+        index = None
+        if aggregation == 'mean':
+            actions = actions.mean(dim=0)
+        elif aggregation == 'median':
+            actions = actions.median(dim=0).values
+        elif aggregation == 'vote':
+            num_ensemble, batch_size = actions.shape[:2]
+            Q1, Q2 = _candidate_q_values(obs, actions, critic1, critic2, ensemble)
+            # [num_ensemble, batch]: the candidate each member votes for
+            votes = (0.5*(Q1 + Q2)).argmax(dim=1)
+            counts = torch.zeros(num_ensemble, batch_size, device=votes.device)
+            counts.scatter_add_(0, votes, torch.ones_like(votes, dtype=counts.dtype))
+            index = counts.argmax(dim=0)
+            actions = actions[index, torch.arange(batch_size, device=index.device)]
+            index = ptu.get_numpy(index)
+        else:
+            raise ValueError("Unknown aggregation: {}".format(aggregation))
+    return ptu.get_numpy(actions), index
 
 
 def ensemble_eval_rollout(
@@ -406,6 +455,11 @@ def ensemble_eval_rollout(
         max_path_length=np.inf,
         render=False,
         render_kwargs=None,
+        aggregation='mean',
+        critic1=None,
+        critic2=None,
+        inference_type=0.0,
+        ensemble=None,
 ):
     """
     The following value for the following keys will be a 2D array, with the
@@ -420,6 +474,10 @@ def ensemble_eval_rollout(
     the list being the index into the time
      - agent_infos
      - env_infos
+
+    The action of each step combines the deterministic actions of all
+    policies with get_ensemble_eval_actions. critic1 / critic2 are only used
+    by the ucb and vote aggregations.
     """
     if render_kwargs is None:
         render_kwargs = {}
@@ -437,14 +495,18 @@ def ensemble_eval_rollout(
     if render:
         env.render(**render_kwargs)
     while path_length < max_path_length:
-        a = None
-        for en_index in range(num_ensemble):
-            _a, agent_info = agent[en_index].get_action(o)
-            if en_index == 0:
-                a = _a
-            else:
-                a += _a
-        a = a / num_ensemble
+        a, index = get_ensemble_eval_actions(
+            o.reshape(1, -1),
+            agent,
+            aggregation=aggregation,
+            critic1=critic1,
+            critic2=critic2,
+            inference_type=inference_type,
+            ensemble=ensemble,
+        )
+        a = a[0]
+        policy = agent[num_ensemble - 1 if index is None else index[0]]
+        agent_info = {"policy_id": getattr(policy, 'stochastic_policy', policy).id}
         next_o, r, trunc, term, env_info = env.step(a)
         d = term or trunc
         observations.append(o)
@@ -46,16 +46,67 @@ def _elem_or_tuple_to_variable(elem_or_tuple):
 
 def _filter_batch(np_batch):
     for k, v in np_batch.items():
-        if v.dtype == np.bool:
+        if isinstance(v, torch.Tensor):
+            yield k, v
+        elif v.dtype == np.bool:
             yield k, v.astype(int)
         else:
             yield k, v
 
 
 def np_to_pytorch_batch(np_batch):
+    """
+    Tensors (e.g. of a BatchPrefetcher or a replay buffer with
+    storage='torch') are used as they are.
+    """
     return {
-        k: _elem_or_tuple_to_variable(x)
+        k: x if isinstance(x, torch.Tensor) else _elem_or_tuple_to_variable(x)
         for k, x in _filter_batch(np_batch)
-        if x.dtype != np.dtype('O')  # ignore object (e.g. dictionaries)
+        if isinstance(x, torch.Tensor) or x.dtype != np.dtype('O')  # ignore object (e.g. dictionaries)
     }
 
+
+
+class ForwardCache(object):
+    """
+    Memoize no-grad network outputs for the duration of one training step.
+
+    Entries are keyed by network role, ensemble member and the identity of the
+    input tensor (which the entry keeps alive, so that its id is not reused),
+    so the cache must be cleared whenever the inputs or the networks change
+    (i.e. at least once per step). member=None stands for the
+    whole ensemble: a whole-ensemble entry also serves single member lookups
+    by indexing its leading ensemble dimension.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+
+    def clear(self):
+        self._entries.clear()
+
+    def put(self, role, input, value, member=None):
+        """
+        :param value: A tensor or a tuple of tensors (None entries allowed).
+        """
+        self._entries[(role, member, id(input))] = (input, value)
+
+    def get(self, role, input, member=None):
+        """
+        :return: The cached value, or None if it has not been computed.
+        """
+        _, value = self._entries.get((role, member, id(input)), (None, None))
+        if value is None and member is not None:
+            _, value = self._entries.get((role, None, id(input)), (None, None))
+            if value is not None:
+                value = _index_member(value, member)
+        if value is not None:
+            self.hits += 1
+        return value
+
+
+def _index_member(value, member):
+    if isinstance(value, tuple):
+        return tuple(None if v is None else v[member] for v in value)
+    return value[member]
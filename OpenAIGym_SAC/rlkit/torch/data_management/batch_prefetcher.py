@@ -0,0 +1,133 @@
+"""
+Sampling training batches ahead of the trainer on a background thread.
+"""
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+import rlkit.torch.pytorch_util as ptu
+
+
+class BatchPrefetcher(object):
+    """
+    Samples batches from a replay buffer and converts them to float tensors
+    on a daemon thread, up to `num_prefetch` batches ahead of the trainer,
+    so that sampling overlaps with the gradient steps.
+
+    The batches are written into preallocated host tensors (pinned when
+    `pin_memory` and CUDA is available), one set per slot. There are
+    num_prefetch + 1 slots: the one the trainer is using and those being
+    filled. A slot is reused once the trainer asked for the next batch, so a
+    batch must not be kept beyond its training step. A slot is allocated
+    again when the shapes of the batches change, e.g. the masks after
+    members were added to or removed from the ensemble.
+
+    The replay buffer is only sampled while `batches` is iterated and must
+    not be added to in that time. Stopping the iteration early cancels the
+    batches that were not used yet.
+    """
+
+    def __init__(self, replay_buffer, batch_size, num_prefetch=2, pin_memory=False, device=None,
+                 sample_batch=None):
+        """
+        :param sample_batch: Function drawing one batch, by default
+        replay_buffer.random_batch(batch_size).
+        """
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.num_prefetch = num_prefetch
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.device = device if device is not None else ptu.device
+        self.sample_batch = sample_batch or (lambda: self.replay_buffer.random_batch(self.batch_size))
+        # Time the trainer spent waiting for batches
+        self.wait_time = 0.
+
+        self._slots = [None] * (num_prefetch + 1)
+        # CUDA events of the copies out of each slot, which must finish
+        # before the slot is overwritten.
+        self._copy_events = [None] * (num_prefetch + 1)
+        self._free_slots = queue.Queue()
+        for slot in range(num_prefetch + 1):
+            self._free_slots.put(slot)
+        # Filled slots, then an exception if sampling failed, then None at
+        # the end of each request
+        self._ready_slots = queue.Queue()
+        self._requests = queue.Queue()
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            num_batches = self._requests.get()
+            for _ in range(num_batches):
+                slot = self._free_slots.get()
+                if self._cancelled.is_set():
+                    self._free_slots.put(slot)
+                    break
+                try:
+                    self._fill(slot, self.sample_batch())
+                except Exception as e:
+                    self._free_slots.put(slot)
+                    self._ready_slots.put(e)
+                    break
+                self._ready_slots.put(slot)
+            self._ready_slots.put(None)
+
+    def _allocate(self, np_batch):
+        return {
+            key: torch.empty(value.shape, dtype=torch.float32, pin_memory=self.pin_memory)
+            for key, value in np_batch.items()
+            if isinstance(value, (np.ndarray, torch.Tensor))  # ignore others (e.g. dictionaries)
+        }
+
+    def _fill(self, slot, np_batch):
+        if self._copy_events[slot] is not None:
+            self._copy_events[slot].synchronize()
+        if self._slots[slot] is None or any(
+                tensor.shape != np_batch[key].shape for key, tensor in self._slots[slot].items()):
+            self._slots[slot] = self._allocate(np_batch)
+        for key, tensor in self._slots[slot].items():
+            tensor.copy_(torch.as_tensor(np_batch[key]))
+
+    def _to_device(self, slot):
+        if self.device is None or self.device.type == 'cpu':
+            return dict(self._slots[slot])
+        batch = {
+            key: tensor.to(self.device, non_blocking=self.pin_memory)
+            for key, tensor in self._slots[slot].items()
+        }
+        self._copy_events[slot] = torch.cuda.Event()
+        self._copy_events[slot].record()
+        return batch
+
+    def batches(self, num_batches):
+        """
+        Yield `num_batches` batches, as dicts from key to float tensor on
+        `device`, in the format of np_to_pytorch_batch.
+        """
+        self._requests.put(num_batches)
+        try:
+            for _ in range(num_batches):
+                start = time.time()
+                slot = self._ready_slots.get()
+                self.wait_time += time.time() - start
+                if isinstance(slot, Exception):
+                    raise RuntimeError("Sampling a batch failed") from slot
+                try:
+                    yield self._to_device(slot)
+                finally:
+                    self._free_slots.put(slot)
+        finally:
+            # Cancel the rest of the request and give back its slots, so
+            # that the next request starts from free slots only
+            self._cancelled.set()
+            slot = self._ready_slots.get()
+            while slot is not None:
+                if not isinstance(slot, Exception):
+                    self._free_slots.put(slot)
+                slot = self._ready_slots.get()
+            self._cancelled.clear()
@@ -3,6 +3,8 @@ General networks for pytorch.
 
 Algorithm-specific networks should go else-where.
 """
+from collections import OrderedDict
+
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
@@ -121,3 +123,282 @@ class TanhMlpPolicy(MlpPolicy):
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, output_activation=torch.tanh, **kwargs)
+
+
+class EnsembleLinear(nn.Module):
+    """
+    `ensemble_size` independent linear layers evaluated with one batched
+    matmul. weight[i] and bias[i] have the same layout as nn.Linear.
+    """
+
+    def __init__(self, ensemble_size, in_features, out_features):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(
+            torch.empty(ensemble_size, out_features, in_features)
+        )
+        self.bias = nn.Parameter(torch.empty(ensemble_size, out_features))
+
+    def forward(self, input, member=None):
+        """
+        :param input: [ensemble_size, batch, in_features], or
+        [batch, in_features] to feed the same batch to every member.
+        :param member: If given, only evaluate this member on a
+        [batch, in_features] input. A tensor of member indices of shape
+        [batch] evaluates every row with its own member.
+        """
+        if isinstance(member, torch.Tensor):
+            return torch.baddbmm(
+                self.bias[member].unsqueeze(1),
+                input.unsqueeze(1),
+                self.weight[member].transpose(1, 2),
+            ).squeeze(1)
+        if member is not None:
+            return F.linear(input, self.weight[member], self.bias[member])
+        if input.dim() == 2:
+            input = input.expand(self.weight.shape[0], -1, -1)
+        return torch.baddbmm(
+            self.bias.unsqueeze(1), input, self.weight.transpose(1, 2)
+        )
+
+
+class EnsembleMlp(nn.Module):
+    """
+    `ensemble_size` Mlps with the same architecture whose weights are stacked
+    along a leading ensemble dimension, so that the whole ensemble runs in a
+    handful of batched kernels. Every member is initialised like Mlp.
+
+    The stacked weights have room for `capacity` members (ensemble_size by
+    default), so that members can be added and removed without allocating.
+    Moving the network to another device only moves the current members,
+    the first add_member after that allocates the capacity again.
+    """
+
+    def __init__(
+            self,
+            ensemble_size,
+            hidden_sizes,
+            output_size,
+            input_size,
+            init_w=3e-3,
+            hidden_activation=F.relu,
+            output_activation=identity,
+            hidden_init=ptu.fanin_init,
+            b_init_value=0.1,
+            capacity=None,
+    ):
+        super().__init__()
+        self.capacity = max(ensemble_size, capacity or 0)
+
+        self.input_size = input_size
+        self.output_size = output_size
+        self.hidden_activation = hidden_activation
+        self.output_activation = output_activation
+        self.fcs = []
+        in_size = input_size
+
+        for i, next_size in enumerate(hidden_sizes):
+            fc = EnsembleLinear(ensemble_size, in_size, next_size)
+            in_size = next_size
+            for member_weight in fc.weight.data:
+                hidden_init(member_weight)
+            fc.bias.data.fill_(b_init_value)
+            self.__setattr__("fc{}".format(i), fc)
+            self.fcs.append(fc)
+
+        self.last_fc = EnsembleLinear(ensemble_size, in_size, output_size)
+        self.last_fc.weight.data.uniform_(-init_w, init_w)
+        self.last_fc.bias.data.uniform_(-init_w, init_w)
+        self._reserve()
+
+    def _reserve(self):
+        for param in self.parameters():
+            param.data = ptu.resize_rows(param.data, len(param), self.capacity)
+
+    @property
+    def ensemble_size(self):
+        return self.last_fc.weight.shape[0]
+
+    def forward(self, input, return_preactivations=False, member=None):
+        h = input
+        for fc in self.fcs:
+            h = self.hidden_activation(fc(h, member=member))
+        preactivation = self.last_fc(h, member=member)
+        output = self.output_activation(preactivation)
+        if return_preactivations:
+            return output, preactivation
+        else:
+            return output
+
+    def remove_member(self, index):
+        """
+        Drop member `index`. The parameter objects are kept so that anything
+        holding a reference to them (e.g. an optimizer) stays valid.
+        """
+        for param in self.parameters():
+            param.data = ptu.delete_row(param.data, index)
+            param.grad = None
+
+    def add_member(self, source_index):
+        """
+        Append a member with the weights of member `source_index`.
+        """
+        for param in self.parameters():
+            param.data = ptu.resize_rows(param.data, len(param) + 1, self.capacity)
+            param.data[-1] = param.data[source_index]
+            param.grad = None
+
+
+class EnsembleFlattenMlp(EnsembleMlp):
+    """
+    Concatenate inputs along the last dimension and then pass through the
+    ensemble. Inputs shared by all members ([batch, dim]) are broadcast
+    against per-member inputs ([ensemble_size, batch, dim]).
+    """
+
+    def forward(self, *inputs, **kwargs):
+        if kwargs.get('member') is None and any(x.dim() == 3 for x in inputs):
+            inputs = [
+                x.expand(self.ensemble_size, -1, -1) if x.dim() == 2 else x
+                for x in inputs
+            ]
+        flat_inputs = torch.cat(inputs, dim=-1)
+        return super().forward(flat_inputs, **kwargs)
+
+
+class EnsembleMember(nn.Module):
+    """
+    A single member of an ensemble network that can be used in place of the
+    per-member network it replaces. It owns no parameters itself:
+    `parameters()` and `state_dict()` expose the member's slice of the
+    ensemble weights, using the same names and shapes as the per-member
+    network.
+    """
+
+    def __init__(self, ensemble_network, index):
+        super().__init__()
+        # Not registered as a submodule so that the ensemble weights are not
+        # moved or counted once per member.
+        object.__setattr__(self, 'ensemble_network', ensemble_network)
+        self.index = index
+
+    def forward(self, *inputs, **kwargs):
+        return self.ensemble_network(*inputs, member=self.index, **kwargs)
+
+    def parameters(self, recurse=True):
+        for param in self.ensemble_network.parameters():
+            yield param[self.index]
+
+    def state_dict(self, *args, **kwargs):
+        return OrderedDict(
+            (name, param.detach()[self.index].clone())
+            for name, param in self.ensemble_network.named_parameters()
+        )
+
+    def load_state_dict(self, state_dict, strict=True):
+        with torch.no_grad():
+            for name, param in self.ensemble_network.named_parameters():
+                param[self.index].copy_(state_dict[name])
+
+
+class ParameterArena(object):
+    """
+    Flat, contiguous storage for the parameters of one network role across
+    an ensemble. Every parameter is rebound to a view into a single
+    [ensemble_size, num_params] buffer, one row per member, so operations on
+    the whole role are single tensor ops: Polyak averaging is one lerp,
+    mutation noise one randn and snapshots or broadcasts one copy.
+
+    `networks` is either a list of identically shaped per-member networks
+    or one ensemble network (e.g. EnsembleMlp) whose parameters are stacked
+    along a leading ensemble dimension.
+
+    Moving the networks to another device afterwards replaces the views, so
+    build the arena on the device the networks will be used on.
+
+    The buffer has room for `capacity` members (the number of members by
+    default), which add_member and remove_member resize it within.
+    """
+
+    def __init__(self, networks, device=None, capacity=None):
+        if isinstance(networks, nn.Module):
+            self._stacked_params = list(networks.parameters())
+            self._member_params = None
+            num_members = self._stacked_params[0].shape[0]
+            shapes = [param.shape[1:] for param in self._stacked_params]
+            param = self._stacked_params[0]
+        else:
+            self._stacked_params = None
+            self._member_params = [list(network.parameters()) for network in networks]
+            num_members = len(self._member_params)
+            shapes = [param.shape for param in self._member_params[0]]
+            param = self._member_params[0][0]
+        self._shapes = shapes
+        self._sizes = [shape.numel() for shape in shapes]
+        self.flat = torch.empty(
+            max(num_members, capacity or 0), sum(self._sizes),
+            dtype=param.dtype,
+            device=param.device if device is None else device,
+        )[:num_members]
+        self.capacity = max(num_members, capacity or 0)
+        with torch.no_grad():
+            if self._member_params is not None:
+                for index, params in enumerate(self._member_params):
+                    self.flat[index].copy_(torch.cat([p.reshape(-1) for p in params]))
+            else:
+                self.flat.copy_(torch.cat([p.reshape(num_members, -1) for p in self._stacked_params], dim=1))
+        self._bind()
+
+    def _bind(self):
+        views = torch.split(self.flat, self._sizes, dim=1)
+        if self._member_params is not None:
+            for index, params in enumerate(self._member_params):
+                for param, view, shape in zip(params, views, self._shapes):
+                    param.data = view[index].view(shape)
+        else:
+            for param, view, shape in zip(self._stacked_params, views, self._shapes):
+                param.data = view.unflatten(1, shape)
+                param.grad = None
+
+    def __len__(self):
+        return self.flat.shape[0]
+
+    def member(self, index):
+        """
+        All parameters of member `index` as one flat view.
+        """
+        return self.flat[index]
+
+    def soft_update_from(self, source, tau):
+        self.flat.lerp_(source.flat, tau)
+
+    def snapshot(self):
+        return self.flat.clone()
+
+    def load_snapshot(self, snapshot):
+        self.flat.copy_(snapshot)
+
+    def remove_member(self, index):
+        """
+        Drop member `index`. Per-member networks are dropped from the arena
+        (the caller drops the networks themselves), stacked parameters are
+        shrunk in place of EnsembleMlp.remove_member.
+        """
+        if self._member_params is not None:
+            del self._member_params[index]
+        self.flat = ptu.delete_row(self.flat, index)
+        self._bind()
+
+    def add_member(self, network=None):
+        """
+        Append a member: per-member `network`, whose parameters are copied
+        into the arena, or for stacked parameters a new row that the caller
+        fills (e.g. from another member's).
+        """
+        self.flat = ptu.resize_rows(self.flat, len(self) + 1, self.capacity)
+        if self._member_params is not None:
+            self._member_params.append(list(network.parameters()))
+            with torch.no_grad():
+                self.flat[-1].copy_(torch.cat([p.reshape(-1) for p in self._member_params[-1]]))
+        self._bind()
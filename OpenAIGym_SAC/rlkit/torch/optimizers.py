@@ -0,0 +1,298 @@
+import torch
+
+from rlkit.torch.pytorch_util import delete_row, resize_rows
+
+
+def member_parameters(networks):
+    """
+    Parameter slots of identically shaped per-member networks for
+    EnsembleAdam: one list per parameter, holding that parameter of every
+    member.
+    """
+    return [
+        list(params)
+        for params in zip(*[network.parameters() for network in networks])
+    ]
+
+
+def _per_member(values, like):
+    """
+    Reshape a [ensemble_size] tensor so it broadcasts against `like`.
+    """
+    return values.view(-1, *([1] * (like.dim() - 1)))
+
+
+def _is_stacked(slot):
+    return isinstance(slot, torch.Tensor)
+
+
+class EnsembleAdam(object):
+    """
+    Adam over the parameters of a whole ensemble, updated with multi-tensor
+    (foreach) kernels in a single call.
+
+    Parameters are given as slots, one per parameter of a member network.
+    A slot is either a parameter stacked along a leading ensemble dimension
+    (see EnsembleMlp) or a list holding that parameter for every member (see
+    member_parameters). Slots can be split into named param groups, each
+    with its own learning rate.
+
+    Every member keeps its own step count and moments per group, so this
+    behaves exactly like one torch.optim.Adam per member and group: a subset
+    of members or groups can be stepped on its own (e.g. when retraining a
+    replaced policy) and members can be added, removed or reset without
+    disturbing the others. As in torch.optim.Adam, a parameter whose grad is
+    None is skipped. A member's step count is shared by the parameters of a
+    group, so it is incremented if any of them has a gradient. The rows of
+    a stacked slot all share its grad, so use `members` to step a subset.
+
+    State is created lazily on the first step so that the parameters can be
+    moved to another device after the optimizer is built.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, capacity=None):
+        """
+        :param params: A list of slots, or a list of param group dicts with
+        a 'params' list of slots and optionally a 'name' and an 'lr'.
+        :param capacity: The number of members the state of stacked slots
+        has room for, so that add_member does not allocate.
+        """
+        self.capacity = capacity
+        params = list(params)
+        if len(params) == 0 or not isinstance(params[0], dict):
+            params = [dict(params=params)]
+        self.betas = betas
+        self.eps = eps
+        self.param_groups = []
+        for i, group in enumerate(params):
+            self.param_groups.append(dict(
+                name=group.get('name', i),
+                lr=group.get('lr', lr),
+                params=[
+                    slot if _is_stacked(slot) else list(slot)
+                    for slot in group['params']
+                ],
+                steps=None,
+                exp_avgs=None,
+                exp_avg_sqs=None,
+            ))
+
+    def _groups(self, groups=None):
+        if groups is None:
+            return self.param_groups
+        return [group for group in self.param_groups if group['name'] in groups]
+
+    def zero_grad(self, groups=None):
+        for group in self._groups(groups):
+            for slot in group['params']:
+                for param in ([slot] if _is_stacked(slot) else slot):
+                    param.grad = None
+
+    def _init_state(self, group):
+        slot = group['params'][0]
+        param = slot if _is_stacked(slot) else slot[0]
+        num_members = slot.shape[0] if _is_stacked(slot) else len(slot)
+        group['steps'] = self._reserve(torch.zeros(num_members, device=param.device))
+        for key in ['exp_avgs', 'exp_avg_sqs']:
+            group[key] = [
+                self._reserve(torch.zeros(slot.shape, dtype=slot.dtype, device=slot.device)) if _is_stacked(slot)
+                else [torch.zeros_like(p) for p in slot]
+                for slot in group['params']
+            ]
+
+    def _reserve(self, state):
+        return resize_rows(state, len(state), self.capacity)
+
+    @staticmethod
+    def _members_with_grads(group, members):
+        """
+        The members (all of them if None) with a gradient for at least one
+        parameter of the group.
+        """
+        slots = group['params']
+        num_members = slots[0].shape[0] if _is_stacked(slots[0]) else len(slots[0])
+        members = list(range(num_members) if members is None else members)
+        if any(_is_stacked(slot) and slot.grad is not None for slot in slots):
+            return members
+        return [
+            member for member in members
+            if any(not _is_stacked(slot) and slot[member].grad is not None for slot in slots)
+        ]
+
+    @torch.no_grad()
+    def step(self, members=None, groups=None):
+        """
+        :param members: Indices of the members to update. If None, every
+        member is updated.
+        :param groups: Names of the param groups to update. If None, every
+        group is updated.
+        """
+        beta1, beta2 = self.betas
+        params, grads, exp_avgs, exp_avg_sqs = [], [], [], []
+        step_sizes, bias_correction2_sqrts = [], []
+        # Rows of stacked slots gathered for a subset of members, written
+        # back after the update.
+        scatters = []
+
+        for group in self._groups(groups):
+            if group['steps'] is None:
+                self._init_state(group)
+            steps = group['steps']
+            # Like torch.optim.Adam, parameters without a gradient are
+            # skipped, and so are the members without any in this group.
+            active = self._members_with_grads(group, members)
+            if len(active) == 0:
+                continue
+            if len(active) == len(steps):
+                active = None
+                steps += 1
+                member_steps = steps
+            else:
+                index = torch.as_tensor(active, device=steps.device)
+                member_steps = steps.index_select(0, index) + 1
+                steps.index_copy_(0, index, member_steps)
+            step_size = group['lr'] / (1 - beta1 ** member_steps)
+            bias_correction2_sqrt = (1 - beta2 ** member_steps).sqrt()
+
+            for slot, exp_avg, exp_avg_sq in zip(
+                    group['params'], group['exp_avgs'], group['exp_avg_sqs']):
+                if _is_stacked(slot):
+                    if slot.grad is None:
+                        continue
+                    full = [slot.data, slot.grad, exp_avg, exp_avg_sq]
+                    if active is not None:
+                        rows = [t.index_select(0, index) for t in full]
+                        scatters.append((full, index, rows))
+                        full = rows
+                    params.append(full[0])
+                    grads.append(full[1])
+                    exp_avgs.append(full[2])
+                    exp_avg_sqs.append(full[3])
+                    step_sizes.append(_per_member(step_size, slot))
+                    bias_correction2_sqrts.append(
+                        _per_member(bias_correction2_sqrt, slot))
+                else:
+                    for i, member in enumerate(
+                            range(len(slot)) if active is None else active):
+                        param = slot[member]
+                        if param.grad is None:
+                            continue
+                        params.append(param.data)
+                        grads.append(param.grad)
+                        exp_avgs.append(exp_avg[member])
+                        exp_avg_sqs.append(exp_avg_sq[member])
+                        step_sizes.append(step_size[i])
+                        bias_correction2_sqrts.append(bias_correction2_sqrt[i])
+
+        if len(params) == 0:
+            return
+
+        torch._foreach_lerp_(exp_avgs, grads, 1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, 1 - beta2)
+
+        denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_div_(denom, bias_correction2_sqrts)
+        torch._foreach_add_(denom, self.eps)
+        updates = torch._foreach_div(exp_avgs, denom)
+        torch._foreach_mul_(updates, step_sizes)
+        torch._foreach_sub_(params, updates)
+
+        for full, index, rows in scatters:
+            for full_tensor, row_tensor in zip(full, rows):
+                if full_tensor is not full[1]:
+                    full_tensor.index_copy_(0, index, row_tensor)
+
+    def remove_member(self, index):
+        """
+        Forget member `index`. Stacked parameters are expected to be shrunk
+        by their owner (e.g. EnsembleMlp.remove_member), per-member slots
+        drop the member's parameter here.
+        """
+        for group in self.param_groups:
+            for slot in group['params']:
+                if not _is_stacked(slot):
+                    del slot[index]
+            if group['steps'] is None:
+                continue
+            group['steps'] = delete_row(group['steps'], index)
+            for key in ['exp_avgs', 'exp_avg_sqs']:
+                for i, state in enumerate(group[key]):
+                    if _is_stacked(state):
+                        group[key][i] = delete_row(state, index)
+                    else:
+                        del state[index]
+
+    def add_member(self, params=()):
+        """
+        Append a member with fresh state, as if it had never been stepped.
+        Stacked parameters are expected to be grown by their owner (e.g.
+        EnsembleMlp.add_member), per-member slots append the new member's
+        parameters `params`: one per such slot, in the order of the groups
+        and their slots.
+        """
+        params = iter(params)
+        for group in self.param_groups:
+            for slot in group['params']:
+                if not _is_stacked(slot):
+                    slot.append(next(params))
+            if group['steps'] is None:
+                continue
+            num_members = len(group['steps']) + 1
+            group['steps'] = resize_rows(group['steps'], num_members, self.capacity)
+            group['steps'][-1] = 0
+            for key in ['exp_avgs', 'exp_avg_sqs']:
+                for i, (state, slot) in enumerate(zip(group[key], group['params'])):
+                    if _is_stacked(state):
+                        group[key][i] = resize_rows(state, num_members, self.capacity)
+                        group[key][i][-1] = 0
+                    else:
+                        state.append(torch.zeros_like(slot[-1]))
+
+    def reset_member(self, index, groups=None):
+        """
+        Restart Adam from scratch for member `index`, e.g. after its
+        parameters were re-initialised.
+        """
+        for group in self._groups(groups):
+            if group['steps'] is None:
+                continue
+            group['steps'][index] = 0
+            for key in ['exp_avgs', 'exp_avg_sqs']:
+                for state in group[key]:
+                    state[index].zero_()
+
+    def state_dict(self):
+        return dict(
+            betas=self.betas,
+            eps=self.eps,
+            param_groups=[
+                dict(
+                    name=group['name'],
+                    lr=group['lr'],
+                    steps=group['steps'],
+                    exp_avgs=group['exp_avgs'],
+                    exp_avg_sqs=group['exp_avg_sqs'],
+                )
+                for group in self.param_groups
+            ],
+        )
+
+    def load_state_dict(self, state_dict):
+        self.betas = state_dict['betas']
+        self.eps = state_dict['eps']
+        assert len(state_dict['param_groups']) == len(self.param_groups)
+        for group, saved in zip(self.param_groups, state_dict['param_groups']):
+            group['lr'] = saved['lr']
+            if saved['steps'] is None:
+                group['steps'] = group['exp_avgs'] = group['exp_avg_sqs'] = None
+                continue
+            slot = group['params'][0]
+            device = slot.device if _is_stacked(slot) else slot[0].device
+            group['steps'] = self._reserve(saved['steps'].to(device).clone())
+            for key in ['exp_avgs', 'exp_avg_sqs']:
+                group[key] = [
+                    self._reserve(state.to(slot.device).clone()) if _is_stacked(slot)
+                    else [s.to(p.device).clone() for s, p in zip(state, slot)]
+                    for slot, state in zip(group['params'], saved[key])
+                ]
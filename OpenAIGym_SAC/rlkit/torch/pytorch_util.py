@@ -1,3 +1,6 @@
+import math
+import random
+
 import torch
 import numpy as np
 
@@ -14,6 +17,59 @@ def copy_model_params_from_to(source, target):
         target_param.data.copy_(param.data)
 
 
+def get_rng_state():
+    """
+    State of the Python, NumPy and torch random number generators.
+    """
+    return dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    )
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def resize_rows(tensor, num_rows, capacity=None):
+    """
+    `tensor` with num_rows rows along its first dimension. A tensor that is
+    the leading rows of a larger contiguous storage (as returned here) is
+    resized in place in that storage, so resizing within the capacity never
+    allocates and views of the kept rows stay valid. Otherwise (or if the
+    storage has no room for `capacity` rows) the rows are copied into new
+    storage with room for `capacity` rows.
+
+    Rows past the old end are left as they are (uninitialized or stale), the
+    caller fills them.
+    """
+    shape = (num_rows,) + tuple(tensor.shape[1:])
+    capacity = max(num_rows, capacity or 0)
+    row_size = math.prod(shape[1:])
+    end = tensor.storage_offset() + capacity * row_size
+    if tensor.is_contiguous() and end * tensor.element_size() <= tensor.untyped_storage().nbytes():
+        return tensor.new_empty(0).set_(tensor.untyped_storage(), tensor.storage_offset(), shape)
+    storage = tensor.new_empty((capacity,) + shape[1:])
+    num_kept = min(num_rows, len(tensor))
+    storage[:num_kept] = tensor[:num_kept]
+    return storage[:num_rows]
+
+
+def delete_row(tensor, index):
+    """
+    `tensor` without row `index`, with the rows after it moved up in place
+    (see resize_rows).
+    """
+    tensor[index:-1] = tensor[index + 1:].clone()
+    return resize_rows(tensor, len(tensor) - 1)
+
+
 def fanin_init(tensor):
     size = tensor.size()
     if len(size) == 2:
@@ -2,14 +2,19 @@ from collections import OrderedDict
 
 import numpy as np
 import torch
-import torch.optim as optim
 from torch import nn as nn
 import os
 
 import rlkit.torch.pytorch_util as ptu
+from rlkit.core.checkpoint_writer import snapshot_state, torch_save, write_checkpoint
 from rlkit.core.eval_util import create_stats_ordered_dict
+from rlkit.torch.core import ForwardCache
+from rlkit.torch.optimizers import EnsembleAdam, member_parameters
 from rlkit.torch.torch_rl_algorithm import TorchTrainer
 
+# Bumped whenever the layout of the checkpoint bundle changes.
+CHECKPOINT_VERSION = 1
+
 
 class DSunriseTrainer(TorchTrainer):
     def __init__(
@@ -27,7 +32,6 @@ class DSunriseTrainer(TorchTrainer):
 
             policy_lr=1e-3,
             qf_lr=1e-3,
-            optimizer_class=optim.Adam,
 
             soft_target_tau=1e-2,
             target_update_period=1,
@@ -59,144 +63,199 @@ class DSunriseTrainer(TorchTrainer):
                 self.target_entropy = target_entropy
             else:
                 self.target_entropy = -np.prod(self.env.action_space.shape).item()  # heuristic value from Tuomas
-            self.alpha_optimizer, self.log_alpha = [], []
-            for _ in range(len(self.ensemble)):
-                log_alpha = ptu.zeros(1, requires_grad=True)
-                alpha_optimizer = optimizer_class(
-                    [log_alpha],
-                    lr=policy_lr,
-                )
-                self.alpha_optimizer.append(alpha_optimizer)
-                self.log_alpha.append(log_alpha)
-                
 
         self.plotter = plotter
         self.render_eval_paths = render_eval_paths
 
         self.qf_criterion = nn.MSELoss(reduction="none")
         self.vf_criterion = nn.MSELoss(reduction="none")
-        
-        self.policy_optimizer, self.qf1_optimizer, self.qf2_optimizer, = [], [], []
-        
-        for en_index in range(len(self.ensemble)):
-            policy_optimizer = optimizer_class(
-                self.ensemble.get_policies()[en_index].parameters(),
-                lr=policy_lr,
-            )
-            qf1_optimizer = optimizer_class(
-                self.ensemble.get_critic1s()[en_index].parameters(),
-                lr=qf_lr,
-            )
-            qf2_optimizer = optimizer_class(
-                self.ensemble.get_critic2s()[en_index].parameters(),
-                lr=qf_lr,
-            )
-            self.policy_optimizer.append(policy_optimizer)
-            self.qf1_optimizer.append(qf1_optimizer)
-            self.qf2_optimizer.append(qf2_optimizer)
+
+        # A single EnsembleAdam updates every member's networks (and another one every member's alpha) in one
+        # multi-tensor step. It keeps per member Adam state, so this matches one Adam per member and role.
+        # Both have room for ensemble.max_size members, see add_policy
+        if self.ensemble.vectorized:
+            self.log_alpha = ptu.zeros(len(self.ensemble), 1, 1, requires_grad=True)
+            self.log_alpha.data = ptu.resize_rows(self.log_alpha.data, len(self.ensemble), self.ensemble.max_size)
+            policy_params = self.ensemble.policy.parameters()
+            qf1_params = self.ensemble.qf1.parameters()
+            qf2_params = self.ensemble.qf2.parameters()
+        else:
+            self.log_alpha = [ptu.zeros(1, requires_grad=True) for _ in range(len(self.ensemble))]
+            policy_params = member_parameters(self.ensemble.get_policies())
+            qf1_params = member_parameters(self.ensemble.get_critic1s())
+            qf2_params = member_parameters(self.ensemble.get_critic2s())
+        if self.use_automatic_entropy_tuning:
+            self.alpha_optimizer = EnsembleAdam([self.log_alpha], lr=policy_lr, capacity=self.ensemble.max_size)
+        self.optimizer = EnsembleAdam([
+            dict(name='policy', params=policy_params, lr=policy_lr),
+            dict(name='qf1', params=qf1_params, lr=qf_lr),
+            dict(name='qf2', params=qf2_params, lr=qf_lr),
+        ], capacity=self.ensemble.max_size)
 
         self.discount = discount
         self.reward_scale = reward_scale
         self.eval_statistics = OrderedDict()
         self._n_train_steps_total = 0
         self._need_to_update_eval_statistics = True
+        # No-grad forwards of corrective_feedback that the member updates of the same step can reuse
+        self._forward_cache = ForwardCache()
 
     def corrective_feedback(self, obs, update_type):
-        std_Q_list = []
-        
+        """
+        Uncertainty of the Q estimates of the ensemble on obs, evaluated for all learners at once.
+        update_type 0 uses the critics (actor update), otherwise the target critics (critic update).
+
+        Returns the std of Q as a tensor of shape (num_learners, batch, 1) for feedback types 0 and 2
+        (each learner's own twin critics) and of shape (1, batch, 1) for types 1 and 3 (all critics
+        of the ensemble).
+        """
+        with torch.no_grad():
+            policy_outputs = self.ensemble.policy_forward(
+                obs, reparameterize=True, return_log_prob=True,
+            )
+            Q1, Q2 = self.ensemble.critic_forward(obs, policy_outputs[0], target=update_type != 0)
+
+            if update_type != 0:
+                # The critic update needs exactly these to build its targets: a policy sample on the
+                # next observations and the target critics at that sample, with the same parameters.
+                self._forward_cache.put('policy', obs, policy_outputs)
+                self._forward_cache.put('target_critics', obs, (Q1, Q2))
+
+            if self.feedback_type == 0 or self.feedback_type == 2:
+                mean_Q = 0.5*(Q1 + Q2)
+                var_Q = 0.5*((Q1 - mean_Q)**2 + (Q2 - mean_Q)**2)
+            else:
+                L_target_Q = torch.cat((Q1, Q2))
+                mean_Q = L_target_Q.mean(dim=0, keepdim=True)
+                var_Q = ((L_target_Q - mean_Q)**2).mean(dim=0, keepdim=True)
+
+        return torch.sqrt(var_Q)
+
+    def _member_corrective_feedback(self, obs, update_type):
+        """
+        corrective_feedback for per member batches (see DynamicEnsembleEnvReplayBuffer.random_member_batch),
+        obs of shape (num_learners, batch, obs_dim) with learner i training on obs[i].
+
+        Returns the std of Q on each learner's own rows, of shape (num_learners, batch, 1) for every feedback
+        type. Types 0 and 2 only run each learner on its own rows. The std of types 1 and 3 needs all critics on
+        the rows of every learner, so those are evaluated on the concatenated batches.
+        """
         if self.feedback_type == 0 or self.feedback_type == 2:
-            for en_index in range(len(self.ensemble)):
-                with torch.no_grad():
-                    policy_action, _, _, _, *_ = self.ensemble.get_policies()[en_index](
-                        obs, reparameterize=True, return_log_prob=True,
-                    )
-                    if update_type == 0:
-                        actor_Q1 = self.ensemble.get_critic1s()[en_index](obs, policy_action)
-                        actor_Q2 = self.ensemble.get_critic2s()[en_index](obs, policy_action)
-                    else:
-                        actor_Q1 = self.ensemble.get_target_critic1s()[en_index](obs, policy_action)
-                        actor_Q2 = self.ensemble.get_target_critic2s()[en_index](obs, policy_action)
-                    mean_actor_Q = 0.5*(actor_Q1 + actor_Q2)
-                    var_Q = 0.5*((actor_Q1 - mean_actor_Q)**2 + (actor_Q2 - mean_actor_Q)**2)
-                std_Q_list.append(torch.sqrt(var_Q).detach())
-                
-        elif self.feedback_type == 1 or self.feedback_type == 3:
-            mean_Q, var_Q = None, None
-            L_target_Q = []
-            for en_index in range(len(self.ensemble)):
-                with torch.no_grad():
-                    policy_action, _, _, _, *_ = self.ensemble.get_policies()[en_index](
-                        obs, reparameterize=True, return_log_prob=True,
-                    )
-                    
-                    if update_type == 0: # actor
-                        target_Q1 = self.ensemble.get_critic1s()[en_index](obs, policy_action)
-                        target_Q2 = self.ensemble.get_critic2s()[en_index](obs, policy_action)
-                    else: # critic
-                        target_Q1 = self.ensemble.get_target_critic1s()[en_index](obs, policy_action)
-                        target_Q2 = self.ensemble.get_target_critic2s() [en_index](obs, policy_action)
-                    L_target_Q.append(target_Q1)
-                    L_target_Q.append(target_Q2)
-                    if en_index == 0:
-                        mean_Q = 0.5*(target_Q1 + target_Q2) / len(self.ensemble)
-                    else:
-                        mean_Q += 0.5*(target_Q1 + target_Q2) / len(self.ensemble)
-
-            temp_count = 0
-            for target_Q in L_target_Q:
-                if temp_count == 0:
-                    var_Q = (target_Q.detach() - mean_Q)**2
-                else:
-                    var_Q += (target_Q.detach() - mean_Q)**2
-                temp_count += 1
-            var_Q = var_Q / temp_count
-            std_Q_list.append(torch.sqrt(var_Q).detach())
-
-        return std_Q_list
+            return self.corrective_feedback(obs, update_type)
+
+        num_learners, batch_size = obs.shape[:2]
+        all_obs = obs.reshape(num_learners * batch_size, -1)
+        std_Q = self.corrective_feedback(all_obs, update_type)
+        if update_type != 0:
+            # Each learner's targets only need its own forwards on its own rows
+            for role in ('policy', 'target_critics'):
+                value = self._forward_cache.get(role, all_obs)
+                self._forward_cache.put(role, obs, _diagonal_blocks(value, num_learners))
+        if std_Q.shape[0] == 1:
+            return std_Q.reshape(num_learners, batch_size, 1)
+        return _diagonal_blocks(std_Q, num_learners)
         
     def train_from_torch(self, batch):
+        self._forward_cache.clear()
+        if self.ensemble.vectorized:
+            self._train_from_torch_vectorized(batch)
+        else:
+            self._train_from_torch_loop(batch)
+        self._forward_cache.clear()
+
+    def _target_forward(self, next_obs, en_index=None):
+        """
+        Policy sample on next_obs and the target critics' Q values for it, for one member or (en_index None)
+        the whole vectorized ensemble. Reuses the no-grad forwards of corrective_feedback when available.
+        """
+        policy_outputs = self._forward_cache.get('policy', next_obs, member=en_index)
+        target_Q = self._forward_cache.get('target_critics', next_obs, member=en_index)
+        if policy_outputs is None or target_Q is None:
+            if en_index is None:
+                policy = self.ensemble.policy
+                target_qf1, target_qf2 = self.ensemble.target_qf1, self.ensemble.target_qf2
+            else:
+                policy = self.ensemble.get_policies()[en_index]
+                target_qf1 = self.ensemble.get_target_critic1s()[en_index]
+                target_qf2 = self.ensemble.get_target_critic2s()[en_index]
+                if next_obs.dim() == 3:
+                    next_obs = next_obs[en_index]
+            policy_outputs = policy(next_obs, reparameterize=True, return_log_prob=True)
+            target_Q = (
+                target_qf1(next_obs, policy_outputs[0]),
+                target_qf2(next_obs, policy_outputs[0]),
+            )
+        new_log_pi = policy_outputs[3]
+        return torch.min(*target_Q), new_log_pi
+
+    def _train_from_torch_loop(self, batch):
         rewards = batch['rewards']
         terminals = batch['terminals']
         obs = batch['observations']
         actions = batch['actions']
         next_obs = batch['next_observations']
-        masks = batch['masks']
+        # Per member batches of shape (num_learners, batch, ...) are only drawn from rows in the member's mask
+        member_batches = obs.dim() == 3
         
         # variables for logging
         tot_qf1_loss, tot_qf2_loss, tot_q1_pred, tot_q2_pred, tot_q_target = 0, 0, 0, 0, 0
         tot_log_pi, tot_policy_mean, tot_policy_log_std, tot_policy_loss = 0, 0, 0, 0
         tot_alpha, tot_alpha_loss = 0, 0
         
-        std_Q_actor_list = self.corrective_feedback(obs=obs, update_type=0)
-        std_Q_critic_list = self.corrective_feedback(obs=next_obs, update_type=1)
+        if member_batches:
+            masks = batch['masks'].t()
+            std_Q_actor_list = self._member_corrective_feedback(obs=obs, update_type=0)
+            std_Q_critic_list = self._member_corrective_feedback(obs=next_obs, update_type=1)
+        else:
+            masks = batch['masks']
+            std_Q_actor_list = self.corrective_feedback(obs=obs, update_type=0)
+            std_Q_critic_list = self.corrective_feedback(obs=next_obs, update_type=1)
+        per_member_std = self.feedback_type == 0 or self.feedback_type == 2 or member_batches
+
+        def member_rows(x, en_index):
+            return x[en_index] if member_batches else x
         
         torch.autograd.set_detect_anomaly(True)
+        """
+        Alpha Loss
+        """
+        policy_outputs = [
+            policy(member_rows(obs, en_index), reparameterize=True, return_log_prob=True)
+            for en_index, policy in enumerate(self.ensemble.get_policies())
+        ]
+        if self.use_automatic_entropy_tuning:
+            alpha_losses = []
+            for en_index, (_, _, _, log_pi, *_) in enumerate(policy_outputs):
+                mask = masks[:,en_index].reshape(-1, 1)
+                alpha_loss = -(self.log_alpha[en_index] * (log_pi + self.target_entropy).detach()) * mask
+                alpha_losses.append(alpha_loss.sum() / (mask.sum() + 1))
+            self.alpha_optimizer.zero_grad()
+            sum(alpha_losses).backward()
+            self.alpha_optimizer.step()
+
+        tot_policy_loss_grad, tot_qf_loss_grad = 0, 0
         for en_index in range(len(self.ensemble)):
             mask = masks[:,en_index].reshape(-1, 1)
+            member_obs, member_actions = member_rows(obs, en_index), member_rows(actions, en_index)
+            member_rewards, member_terminals = member_rows(rewards, en_index), member_rows(terminals, en_index)
 
             """
-            Policy and Alpha Loss
+            Policy Loss
             """
-            new_obs_actions, policy_mean, policy_log_std, log_pi, *_ = self.ensemble.get_policies()[en_index](
-                obs, reparameterize=True, return_log_prob=True,
-            )
+            new_obs_actions, policy_mean, policy_log_std, log_pi, *_ = policy_outputs[en_index]
             if self.use_automatic_entropy_tuning:
-                alpha_loss = -(self.log_alpha[en_index] * (log_pi + self.target_entropy).detach()) * mask
-                alpha_loss = alpha_loss.sum() / (mask.sum() + 1)
-                self.alpha_optimizer[en_index].zero_grad()
-                alpha_loss.backward()
-                self.alpha_optimizer[en_index].step()
+                alpha_loss = alpha_losses[en_index]
                 alpha = self.log_alpha[en_index].exp()
             else:
                 alpha_loss = 0
                 alpha = 1
 
             q_new_actions = torch.min(
-                self.ensemble.get_critic1s()[en_index](obs, new_obs_actions),
-                self.ensemble.get_critic2s()[en_index](obs, new_obs_actions),
+                self.ensemble.get_critic1s()[en_index](member_obs, new_obs_actions),
+                self.ensemble.get_critic2s()[en_index](member_obs, new_obs_actions),
             )
             
-            if self.feedback_type == 0 or self.feedback_type == 2:
+            if per_member_std:
                 std_Q = std_Q_actor_list[en_index]
             else:
                 std_Q = std_Q_actor_list[0]
@@ -211,59 +270,26 @@ class DSunriseTrainer(TorchTrainer):
             """
             QF Loss
             """
-            q1_pred = self.ensemble.get_critic1s()[en_index](obs, actions)
-            q2_pred = self.ensemble.get_critic2s()[en_index](obs, actions)
+            q1_pred = self.ensemble.get_critic1s()[en_index](member_obs, member_actions)
+            q2_pred = self.ensemble.get_critic2s()[en_index](member_obs, member_actions)
 
             # Make sure policy accounts for squashing functions like tanh correctly!
-            new_next_actions, _, _, new_log_pi, *_ = self.ensemble.get_policies()[en_index](
-                next_obs, reparameterize=True, return_log_prob=True,
-            )
-            target_q_values = torch.min(
-                self.ensemble.get_target_critic1s()[en_index](next_obs, new_next_actions),
-                self.ensemble.get_target_critic2s()[en_index](next_obs, new_next_actions),
-            ) - alpha * new_log_pi
+            target_min_Q, new_log_pi = self._target_forward(next_obs, en_index)
+            target_q_values = target_min_Q - alpha * new_log_pi
             
-            if self.feedback_type == 0 or self.feedback_type == 2:
-                if self.feedback_type == 0:
-                    weight_target_Q = torch.sigmoid(-std_Q_critic_list[en_index]*self.temperature) + 0.5
-                else:
-                    weight_target_Q = 2*torch.sigmoid(-std_Q_critic_list[en_index]*self.temperature)
+            std_Q_critic = std_Q_critic_list[en_index] if per_member_std else std_Q_critic_list[0]
+            if self.feedback_type == 0 or self.feedback_type == 1:
+                weight_target_Q = torch.sigmoid(-std_Q_critic*self.temperature) + 0.5
             else:
-                if self.feedback_type == 1:
-                    weight_target_Q = torch.sigmoid(-std_Q_critic_list[0]*self.temperature) + 0.5
-                else:
-                    weight_target_Q = 2*torch.sigmoid(-std_Q_critic_list[0]*self.temperature)
-            q_target = self.reward_scale * rewards + (1. - terminals) * self.discount * target_q_values
+                weight_target_Q = 2*torch.sigmoid(-std_Q_critic*self.temperature)
+            q_target = self.reward_scale * member_rewards + (1. - member_terminals) * self.discount * target_q_values
             qf1_loss = self.qf_criterion(q1_pred, q_target.detach()) * mask * (weight_target_Q.detach())
             qf2_loss = self.qf_criterion(q2_pred, q_target.detach()) * mask * (weight_target_Q.detach())
             qf1_loss = qf1_loss.sum() / (mask.sum() + 1)
             qf2_loss = qf2_loss.sum() / (mask.sum() + 1)
-            
-            """
-            Update networks
-            """
-            self.policy_optimizer[en_index].zero_grad()
-            policy_loss.backward()
-            self.policy_optimizer[en_index].step()
-
-            self.qf1_optimizer[en_index].zero_grad()
-            qf1_loss.backward()
-            self.qf1_optimizer[en_index].step()
 
-            self.qf2_optimizer[en_index].zero_grad()
-            qf2_loss.backward()
-            self.qf2_optimizer[en_index].step()
-
-            """
-            Soft Updates
-            """
-            if self._n_train_steps_total % self.target_update_period == 0:
-                ptu.soft_update_from_to(
-                    self.ensemble.get_critic1s()[en_index], self.ensemble.get_target_critic1s()[en_index], self.soft_target_tau
-                )
-                ptu.soft_update_from_to(
-                    self.ensemble.get_critic2s()[en_index], self.ensemble.get_target_critic2s()[en_index], self.soft_target_tau
-                )
+            tot_policy_loss_grad += policy_loss
+            tot_qf_loss_grad += qf1_loss + qf2_loss
 
             """
             Statistics for log
@@ -280,6 +306,17 @@ class DSunriseTrainer(TorchTrainer):
             tot_alpha_loss += alpha_loss.item()
             tot_policy_loss = (log_pi - q_new_actions).mean() * (1/len(self.ensemble))
 
+        """
+        Update networks
+        """
+        self._update_networks(tot_policy_loss_grad, tot_qf_loss_grad)
+
+        """
+        Soft Updates
+        """
+        if self._n_train_steps_total % self.target_update_period == 0:
+            self.ensemble.soft_update_targets(self.soft_target_tau)
+
         """
         Save some statistics for eval
         """
@@ -324,11 +361,149 @@ class DSunriseTrainer(TorchTrainer):
                 
         self._n_train_steps_total += 1
 
+    def _train_from_torch_vectorized(self, batch):
+        """
+        Same update as the per member loop in train_from_torch, but every network role of the whole
+        ensemble is evaluated and updated at once through the stacked modules of the ensemble.
+        Per member tensors carry a leading ensemble dimension.
+        """
+        rewards = batch['rewards']
+        terminals = batch['terminals']
+        obs = batch['observations']
+        actions = batch['actions']
+        next_obs = batch['next_observations']
+        num_ensemble = len(self.ensemble)
+        policy = self.ensemble.policy
+        qf1, qf2 = self.ensemble.qf1, self.ensemble.qf2
+        if obs.dim() == 3:
+            # Per member batches, only drawn from rows in the member's mask. The stacked modules take them as is.
+            masks = batch['masks'].unsqueeze(-1)
+            std_Q_actor = self._member_corrective_feedback(obs=obs, update_type=0)
+            std_Q_critic = self._member_corrective_feedback(obs=next_obs, update_type=1)
+        else:
+            masks = batch['masks'].t().unsqueeze(-1)
+            # Either one std per member or a single std shared by all of them, both broadcast.
+            std_Q_actor = self.corrective_feedback(obs=obs, update_type=0)
+            std_Q_critic = self.corrective_feedback(obs=next_obs, update_type=1)
+        mask_count = masks.sum(dim=1, keepdim=True) + 1
+
+        """
+        Policy and Alpha Loss
+        """
+        new_obs_actions, policy_mean, policy_log_std, log_pi, *_ = policy(
+            obs, reparameterize=True, return_log_prob=True,
+        )
+        if self.use_automatic_entropy_tuning:
+            alpha_loss = -(self.log_alpha * (log_pi + self.target_entropy).detach()) * masks
+            alpha_loss = alpha_loss.sum(dim=1, keepdim=True) / mask_count
+            self.alpha_optimizer.zero_grad()
+            alpha_loss.sum().backward()
+            self.alpha_optimizer.step()
+            alpha = self.log_alpha.exp()
+        else:
+            alpha_loss = ptu.zeros(num_ensemble, 1, 1)
+            alpha = ptu.ones(num_ensemble, 1, 1)
+
+        q_new_actions = torch.min(
+            qf1(obs, new_obs_actions),
+            qf2(obs, new_obs_actions),
+        )
+
+        if self.feedback_type == 1 or self.feedback_type == 0:
+            weight_actor_Q = torch.sigmoid(-std_Q_actor*self.temperature_act) + 0.5
+            weight_target_Q = torch.sigmoid(-std_Q_critic*self.temperature) + 0.5
+        else:
+            weight_actor_Q = 2*torch.sigmoid(-std_Q_actor*self.temperature_act)
+            weight_target_Q = 2*torch.sigmoid(-std_Q_critic*self.temperature)
+        policy_loss = (alpha*log_pi - q_new_actions - self.expl_gamma * std_Q_actor) * masks * weight_actor_Q.detach()
+        policy_loss = policy_loss.sum(dim=1, keepdim=True) / mask_count
+
+        """
+        QF Loss
+        """
+        q1_pred = qf1(obs, actions)
+        q2_pred = qf2(obs, actions)
+
+        target_min_Q, new_log_pi = self._target_forward(next_obs)
+        target_q_values = target_min_Q - alpha * new_log_pi
+
+        q_target = self.reward_scale * rewards + (1. - terminals) * self.discount * target_q_values
+        qf1_loss = self.qf_criterion(q1_pred, q_target.detach()) * masks * (weight_target_Q.detach())
+        qf2_loss = self.qf_criterion(q2_pred, q_target.detach()) * masks * (weight_target_Q.detach())
+        qf1_loss = qf1_loss.sum(dim=1, keepdim=True) / mask_count
+        qf2_loss = qf2_loss.sum(dim=1, keepdim=True) / mask_count
+
+        """
+        Update networks
+        """
+        self._update_networks(policy_loss.sum(), qf1_loss.sum() + qf2_loss.sum())
+
+        """
+        Soft Updates
+        """
+        if self._n_train_steps_total % self.target_update_period == 0:
+            self.ensemble.soft_update_targets(self.soft_target_tau)
+
+        """
+        Save some statistics for eval
+        """
+        if self._need_to_update_eval_statistics:
+            self._need_to_update_eval_statistics = False
+            self.eval_statistics['QF1 Loss'] = np.mean(ptu.get_numpy(qf1_loss.mean()))
+            self.eval_statistics['QF2 Loss'] = np.mean(ptu.get_numpy(qf2_loss.mean()))
+            # Matches the per member loop, which logs the last member's loss.
+            self.eval_statistics['Policy Loss'] = np.mean(ptu.get_numpy(
+                (log_pi[-1] - q_new_actions[-1]).mean() / num_ensemble
+            ))
+            self.eval_statistics.update(create_stats_ordered_dict(
+                'Q1 Predictions',
+                ptu.get_numpy(q1_pred.mean(dim=0)),
+            ))
+            self.eval_statistics.update(create_stats_ordered_dict(
+                'Q2 Predictions',
+                ptu.get_numpy(q2_pred.mean(dim=0)),
+            ))
+            self.eval_statistics.update(create_stats_ordered_dict(
+                'Q Targets',
+                ptu.get_numpy(q_target.mean(dim=0)),
+            ))
+            self.eval_statistics.update(create_stats_ordered_dict(
+                'Log Pis',
+                ptu.get_numpy(log_pi.mean(dim=0)),
+            ))
+            self.eval_statistics.update(create_stats_ordered_dict(
+                'Policy mu',
+                ptu.get_numpy(policy_mean.mean(dim=0)),
+            ))
+            self.eval_statistics.update(create_stats_ordered_dict(
+                'Policy log std',
+                ptu.get_numpy(policy_log_std.mean(dim=0)),
+            ))
+            if self.use_automatic_entropy_tuning:
+                self.eval_statistics['Alpha'] = alpha.mean().item()
+                self.eval_statistics['Alpha Loss'] = alpha_loss.sum().item()
+
+        self._n_train_steps_total += 1
+
+    def _update_networks(self, policy_loss, qf_loss):
+        """
+        Apply the policy and critic losses summed over all members with a single optimizer step.
+        The policy loss also reaches the critics through Q(s, pi(s)); those gradients are dropped
+        before the critic loss is backpropagated, as with a separate optimizer per role.
+        """
+        self.optimizer.zero_grad()
+        policy_loss.backward()
+        self.optimizer.zero_grad(groups=['qf1', 'qf2'])
+        qf_loss.backward()
+        self.optimizer.step()
+
     def get_diagnostics(self):
+        self.eval_statistics['Forward Cache Hits'] = self._forward_cache.hits
         return self.eval_statistics
 
     def end_epoch(self, epoch):
         self._need_to_update_eval_statistics = True
+        self._forward_cache.hits = 0
 
     def train_single_policy(self, batch, policy_idx):
 
@@ -349,9 +524,9 @@ class DSunriseTrainer(TorchTrainer):
         if self.use_automatic_entropy_tuning:
             alpha_loss = -(self.log_alpha[policy_idx] * (log_pi + self.target_entropy).detach())
             alpha_loss = alpha_loss.sum() / (mask.shape[0]+1)
-            self.alpha_optimizer[policy_idx].zero_grad()
+            self.alpha_optimizer.zero_grad()
             alpha_loss.backward()
-            self.alpha_optimizer[policy_idx].step()
+            self.alpha_optimizer.step(members=[policy_idx])
             alpha = self.log_alpha[policy_idx].exp()
         else:
             alpha_loss = 0
@@ -374,25 +549,50 @@ class DSunriseTrainer(TorchTrainer):
         policy_loss = (alpha*log_pi - q_new_actions - self.expl_gamma * std_Q) * weight_actor_Q.detach()
         policy_loss = policy_loss.sum() / (mask.shape[0]+1)
 
-        self.policy_optimizer[policy_idx].zero_grad()
+        self.optimizer.zero_grad()
         policy_loss.backward()
-        self.policy_optimizer[policy_idx].step()
+        self.optimizer.step(members=[policy_idx], groups=['policy'])
 
     def remove_policy(self, removed_policy):
         """
         When a policy is removed from the ensemble the trainer needs to be updated to remove the corresponding
         elements from the replay buffer and any other relevant data structures.
         """
-        
-        del self.policy_optimizer[removed_policy]
-        del self.qf1_optimizer[removed_policy]
-        del self.qf2_optimizer[removed_policy]
-        del self.log_alpha[removed_policy]
-        del self.alpha_optimizer[removed_policy]
-        
+        self.optimizer.remove_member(removed_policy)
+        if self.use_automatic_entropy_tuning:
+            self.alpha_optimizer.remove_member(removed_policy)
+        if self.ensemble.vectorized:
+            self.log_alpha.data = ptu.delete_row(self.log_alpha.data, removed_policy)
+            self.log_alpha.grad = None
+        else:
+            del self.log_alpha[removed_policy]
+
+    def add_policy(self, source_policy):
+        """
+        When a learner is added to the ensemble (see Ensemble.add_learner) the trainer needs optimizer state for
+        it, which starts fresh, and an entropy temperature, which starts from that of the learner it was copied
+        from.
+        """
+        index = len(self.ensemble) - 1
+        if self.ensemble.vectorized:
+            self.log_alpha.data = ptu.resize_rows(self.log_alpha.data, index + 1, self.ensemble.max_size)
+            self.log_alpha.data[index] = self.log_alpha.data[source_policy]
+            self.log_alpha.grad = None
+            self.optimizer.add_member()
+        else:
+            self.log_alpha.append(self.log_alpha[source_policy].detach().clone().requires_grad_())
+            self.optimizer.add_member([
+                param
+                for networks in [self.ensemble.get_policies(), self.ensemble.get_critic1s(), self.ensemble.get_critic2s()]
+                for param in networks[index].parameters()
+            ])
+        if self.use_automatic_entropy_tuning:
+            self.alpha_optimizer.add_member([] if self.ensemble.vectorized else [self.log_alpha[index]])
 
     @property
     def networks(self):
+        if self.ensemble.vectorized:
+            return self.ensemble.get_networks()
         output = []
         for en_index in range(len(self.ensemble)):
             output.append(self.ensemble.get_policies()[en_index])
@@ -403,6 +603,40 @@ class DSunriseTrainer(TorchTrainer):
         return output
 
     def get_snapshot(self):
+        return self._member_networks()
+    
+    def save_models(self, step):
+        write_checkpoint(*self.get_checkpoint(step))
+
+    def get_checkpoint(self, step):
+        """
+        Snapshot of the training state for save_models, as (files, finalize)
+        for rlkit.core.checkpoint_writer: a single bundle with the networks of
+        every member, the optimizer states, the entropy temperatures, the
+        number of members and the random number generator states. Everything
+        is copied to the CPU, so the file can be written on another thread
+        while training goes on.
+        """
+        bundle = dict(
+            version=CHECKPOINT_VERSION,
+            step=step,
+            num_members=len(self.ensemble),
+            # Per member state_dicts load into any layout of the ensemble
+            # (lists, vectorized, flat parameters).
+            networks={
+                role: [network.state_dict() for network in networks]
+                for role, networks in self._member_networks().items()
+            },
+            optimizer=self.get_optimizer_state(),
+            n_train_steps_total=self._n_train_steps_total,
+            rng=ptu.get_rng_state(),
+        )
+        return [(self._checkpoint_path(step), torch_save, snapshot_state(bundle))], None
+
+    def _checkpoint_path(self, step):
+        return '%s/checkpoint_%s.pt' % (self.model_dir, step)
+
+    def _member_networks(self):
         return dict(
             policy=self.ensemble.get_policies(),
             qf1=self.ensemble.get_critic1s(),
@@ -410,55 +644,126 @@ class DSunriseTrainer(TorchTrainer):
             target_qf1=self.ensemble.get_target_critic1s(),
             target_qf2=self.ensemble.get_target_critic2s(),
         )
-    
-    def save_models(self, step):
+
+    def get_optimizer_state(self):
+        state = dict(
+            optimizer=self.optimizer.state_dict(),
+            log_alpha=self.log_alpha,
+        )
+        if self.use_automatic_entropy_tuning:
+            state['alpha_optimizer'] = self.alpha_optimizer.state_dict()
+        return state
+
+    def load_optimizer_state(self, state):
+        self.optimizer.load_state_dict(state['optimizer'])
+        with torch.no_grad():
+            if self.ensemble.vectorized:
+                self.log_alpha.copy_(state['log_alpha'])
+            else:
+                for log_alpha, saved_log_alpha in zip(self.log_alpha, state['log_alpha']):
+                    log_alpha.copy_(saved_log_alpha)
+        if self.use_automatic_entropy_tuning:
+            self.alpha_optimizer.load_state_dict(state['alpha_optimizer'])
+
+    def load_models(self, steps: list):
+        """
+        Load the first of `steps` that has a checkpoint.
+        :return: The loaded step, or None if none of them has one.
+        """
+        for step in steps:
+            if os.path.exists(self._checkpoint_path(step)):
+                self.load_checkpoint(self._checkpoint_path(step))
+            elif not self._load_legacy_models(step):
+                print(f"Model files for step {step} not found. Skipping loading for this step.")
+                continue
+            print(f"Loaded models for step {step} successfully.")
+            return step
+        return None
+
+    def load_checkpoint(self, path):
+        """
+        Restore the training state saved by get_checkpoint. The file is
+        memory-mapped, so only the tensors are read, straight into the
+        networks and optimizers. An ensemble of another size than the saved
+        one is shrunk or grown (within its max_size) to that size first.
+        """
+        bundle = torch.load(path, mmap=True, weights_only=False)
+        if bundle['version'] != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version {} in {}".format(bundle['version'], path))
+        num_members = bundle['num_members']
+        if num_members > self.ensemble.max_size:
+            raise ValueError("The checkpoint has {} members, the ensemble only room for {}".format(
+                num_members, self.ensemble.max_size))
+        # Every member is overwritten below, so which ones go or are copied does not matter.
+        while len(self.ensemble) > num_members:
+            self.ensemble.remove_policy(len(self.ensemble) - 1)
+            self.remove_policy(len(self.ensemble))
+        while len(self.ensemble) < num_members:
+            self.ensemble.add_learner(0)
+            self.add_policy(0)
+
+        for role, networks in self._member_networks().items():
+            for network, state_dict in zip(networks, bundle['networks'][role]):
+                network.load_state_dict(state_dict)
+        self.load_optimizer_state(bundle['optimizer'])
+        self._n_train_steps_total = bundle['n_train_steps_total']
+        ptu.set_rng_state(bundle['rng'])
+
+    def _load_legacy_models(self, step):
+        """
+        Checkpoints written before the bundle: the networks in one
+        parameters file (flat parameters) or one file per member and role,
+        and, if it was saved, the optimizer state.
+        """
+        parameters_path = '%s/parameters_%s.pt' % (self.model_dir, step)
+        try:
+            if self.ensemble.arenas is not None and os.path.exists(parameters_path):
+                self.ensemble.load_parameter_snapshot(torch.load(parameters_path, weights_only=False))
+            else:
+                self._load_member_models(step)
+        except FileNotFoundError as e:
+            print(e)
+            return False
+        optimizer_path = '%s/optimizer_%s.pt' % (self.model_dir, step)
+        if os.path.exists(optimizer_path):
+            self.load_optimizer_state(torch.load(optimizer_path, weights_only=False))
+        return True
+
+    def _load_member_models(self, step):
         for en_index in range(len(self.ensemble)):
-            torch.save(
-                self.ensemble.get_policies()[en_index].state_dict(), '%s/%d_th_actor_%s.pt' % (self.model_dir, en_index, step)
+            self.ensemble.get_policies()[en_index].load_state_dict(
+                torch.load('%s/%d_th_actor_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
             )
-            torch.save(
-                self.ensemble.get_critic1s()[en_index].state_dict(), '%s/%d_th_1st_critic_%s.pt' % (self.model_dir, en_index, step)
+            self.ensemble.get_critic1s()[en_index].load_state_dict(
+                torch.load('%s/%d_th_1st_critic_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
             )
-            torch.save(
-                self.ensemble.get_critic2s()[en_index].state_dict(), '%s/%d_th_2nd_critic_%s.pt' % (self.model_dir, en_index, step)
+            self.ensemble.get_critic2s()[en_index].load_state_dict(
+                torch.load('%s/%d_th_2nd_critic_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
             )
-            torch.save(
-                self.ensemble.get_target_critic1s()[en_index].state_dict(), '%s/%d_th_1st_target_critic_%s.pt' % (self.model_dir, en_index, step)
+            self.ensemble.get_target_critic1s()[en_index].load_state_dict(
+                torch.load('%s/%d_th_1st_target_critic_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
             )
-            torch.save(
-                self.ensemble.get_target_critic2s()[en_index].state_dict(), '%s/%d_th_2nd_target_critic_%s.pt' % (self.model_dir, en_index, step)
+            self.ensemble.get_target_critic2s()[en_index].load_state_dict(
+                torch.load('%s/%d_th_2nd_target_critic_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
             )
 
-    def load_models(self, steps: list):
-        for step in steps:
-            try:
-                for en_index in range(len(self.ensemble)):
-                    self.ensemble.get_policies()[en_index].load_state_dict(
-                        torch.load('%s/%d_th_actor_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
-                    )
-                    self.ensemble.get_critic1s()[en_index].load_state_dict(
-                        torch.load('%s/%d_th_1st_critic_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
-                    )
-                    self.ensemble.get_critic2s()[en_index].load_state_dict(
-                        torch.load('%s/%d_th_2nd_critic_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
-                    )
-                    self.ensemble.get_target_critic1s()[en_index].load_state_dict(
-                        torch.load('%s/%d_th_1st_target_critic_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
-                    )
-                    self.ensemble.get_target_critic2s()[en_index].load_state_dict(
-                        torch.load('%s/%d_th_2nd_target_critic_%s.pt' % (self.model_dir, en_index, step), weights_only=False)
-                    )
-            except FileNotFoundError as e:
-                print(f"Model files for step {step} not found. Skipping loading for this step.")
-                print(e)
-                continue
-            print(f"Loaded models for step {step} successfully.")
-            break
-            
-            
     def print_model(self):
         for name, param in self.ensemble.get_policies()[0].named_parameters():
             if param.requires_grad:
                 print(name)
                 print(param.data)
-                break;
\ No newline at end of file
+                break;
+
+
+def _diagonal_blocks(value, num_learners):
+    """
+    From outputs with a leading ensemble dimension on the concatenated batches of all learners, of shape
+    (num_learners, num_learners * batch, ...), each learner's outputs on its own batch: value[i, i*batch:(i+1)*batch].
+    """
+    if value is None:
+        return None
+    if isinstance(value, tuple):
+        return tuple(_diagonal_blocks(v, num_learners) for v in value)
+    blocks = value.reshape((num_learners, num_learners, -1) + tuple(value.shape[2:]))
+    learners = torch.arange(num_learners, device=value.device)
+    return blocks[learners, learners]
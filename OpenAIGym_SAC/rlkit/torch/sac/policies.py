@@ -1,17 +1,64 @@
 import numpy as np
 import torch
 from torch import nn as nn
+from torch.nn import functional as F
 
 from rlkit.policies.base import ExplorationPolicy, Policy
 from rlkit.torch.core import eval_np
 from rlkit.torch.distributions import TanhNormal
-from rlkit.torch.networks import Mlp
+from rlkit.torch.networks import Mlp, EnsembleMlp, EnsembleLinear, EnsembleMember
 
 
 LOG_SIG_MAX = 2
 LOG_SIG_MIN = -20
 
 
+def _tanh_gaussian_outputs(
+        mean,
+        log_std,
+        std,
+        reparameterize,
+        deterministic,
+        return_log_prob,
+):
+    """
+    Sample from tanh(N(mean, std)) and package the outputs the way
+    TanhGaussianPolicy.forward returns them. Works for any number of leading
+    batch dimensions.
+    """
+    log_prob = None
+    entropy = None
+    mean_action_log_prob = None
+    pre_tanh_value = None
+    if deterministic:
+        action = torch.tanh(mean)
+    else:
+        tanh_normal = TanhNormal(mean, std)
+        if return_log_prob:
+            if reparameterize is True:
+                action, pre_tanh_value = tanh_normal.rsample(
+                    return_pretanh_value=True
+                )
+            else:
+                action, pre_tanh_value = tanh_normal.sample(
+                    return_pretanh_value=True
+                )
+            log_prob = tanh_normal.log_prob(
+                action,
+                pre_tanh_value=pre_tanh_value
+            )
+            log_prob = log_prob.sum(dim=-1, keepdim=True)
+        else:
+            if reparameterize is True:
+                action = tanh_normal.rsample()
+            else:
+                action = tanh_normal.sample()
+    return (
+        action, mean, log_std, log_prob, entropy, std,
+        mean_action_log_prob, pre_tanh_value,
+    )
+
+
 class TanhGaussianPolicy(Mlp, ExplorationPolicy):
     """
     Usage:
@@ -48,6 +95,8 @@ class TanhGaussianPolicy(Mlp, ExplorationPolicy):
             **kwargs
         )
         self.id = id
+        self.numpy_inference = False
+        self._inference = None
         self.log_std = None
         self.std = std
         if std is None:
@@ -62,12 +111,25 @@ class TanhGaussianPolicy(Mlp, ExplorationPolicy):
             assert LOG_SIG_MIN <= self.log_std <= LOG_SIG_MAX
 
     def get_action(self, obs_np, deterministic=False):
-        actions = self.get_actions(obs_np[None], deterministic=deterministic)
-        return actions[0, :], {"policy_id": self.id}
+        return _get_inference(self).get_action(obs_np, deterministic), {"policy_id": self.id}
 
     def get_actions(self, obs_np, deterministic=False):
         return eval_np(self, obs_np, deterministic=deterministic)[0]
 
+    def inference_layers(self):
+        """
+        :return: The (weight, bias) pairs of the hidden layers, of the mean
+        head and of the log_std head (None for a fixed std).
+        """
+        log_std_layer = None
+        if self.std is None:
+            log_std_layer = (self.last_fc_log_std.weight, self.last_fc_log_std.bias)
+        return (
+            [(fc.weight, fc.bias) for fc in self.fcs],
+            (self.last_fc.weight, self.last_fc.bias),
+            log_std_layer,
+        )
+
     def forward(
             self,
             obs,
@@ -92,36 +154,8 @@ class TanhGaussianPolicy(Mlp, ExplorationPolicy):
             std = self.std
             log_std = self.log_std
 
-        log_prob = None
-        entropy = None
-        mean_action_log_prob = None
-        pre_tanh_value = None
-        if deterministic:
-            action = torch.tanh(mean)
-        else:
-            tanh_normal = TanhNormal(mean, std)
-            if return_log_prob:
-                if reparameterize is True:
-                    action, pre_tanh_value = tanh_normal.rsample(
-                        return_pretanh_value=True
-                    )
-                else:
-                    action, pre_tanh_value = tanh_normal.sample(
-                        return_pretanh_value=True
-                    )
-                log_prob = tanh_normal.log_prob(
-                    action,
-                    pre_tanh_value=pre_tanh_value
-                )
-                log_prob = log_prob.sum(dim=1, keepdim=True)
-            else:
-                if reparameterize is True:
-                    action = tanh_normal.rsample()
-                else:
-                    action = tanh_normal.sample()
-        return (
-            action, mean, log_std, log_prob, entropy, std,
-            mean_action_log_prob, pre_tanh_value,
+        return _tanh_gaussian_outputs(
+            mean, log_std, std, reparameterize, deterministic, return_log_prob,
         )
 
 
@@ -138,3 +172,207 @@ class MakeDeterministic(nn.Module, Policy):
         return self.stochastic_policy.get_actions(
             observations, deterministic=True
         )
+
+
+class EnsembleTanhGaussianPolicy(EnsembleMlp):
+    """
+    `ensemble_size` TanhGaussianPolicy networks stacked along a leading
+    ensemble dimension. forward returns the same tuple as
+    TanhGaussianPolicy.forward with an extra leading ensemble dimension, or
+    a single member's outputs when `member` is given.
+    """
+    def __init__(
+            self,
+            ensemble_size,
+            hidden_sizes,
+            obs_dim,
+            action_dim,
+            init_w=1e-3,
+            **kwargs
+    ):
+        super().__init__(
+            ensemble_size,
+            hidden_sizes,
+            input_size=obs_dim,
+            output_size=action_dim,
+            init_w=init_w,
+            **kwargs
+        )
+        last_hidden_size = obs_dim
+        if len(hidden_sizes) > 0:
+            last_hidden_size = hidden_sizes[-1]
+        self.last_fc_log_std = EnsembleLinear(
+            ensemble_size, last_hidden_size, action_dim
+        )
+        self.last_fc_log_std.weight.data.uniform_(-init_w, init_w)
+        self.last_fc_log_std.bias.data.uniform_(-init_w, init_w)
+        self._reserve()
+
+    def forward(
+            self,
+            obs,
+            reparameterize=True,
+            deterministic=False,
+            return_log_prob=False,
+            member=None,
+    ):
+        h = obs
+        for fc in self.fcs:
+            h = self.hidden_activation(fc(h, member=member))
+        mean = self.last_fc(h, member=member)
+        log_std = self.last_fc_log_std(h, member=member)
+        log_std = torch.clamp(log_std, LOG_SIG_MIN, LOG_SIG_MAX)
+        std = torch.exp(log_std)
+        return _tanh_gaussian_outputs(
+            mean, log_std, std, reparameterize, deterministic, return_log_prob,
+        )
+
+
+class EnsembleMemberPolicy(EnsembleMember, ExplorationPolicy):
+    """
+    A single member of an EnsembleTanhGaussianPolicy, usable anywhere a
+    TanhGaussianPolicy is.
+    """
+    def __init__(self, ensemble_policy, index, id=None):
+        super().__init__(ensemble_policy, index)
+        self.id = id
+        self.numpy_inference = False
+        self._inference = None
+
+    @property
+    def hidden_activation(self):
+        return self.ensemble_network.hidden_activation
+
+    def get_action(self, obs_np, deterministic=False):
+        return _get_inference(self).get_action(obs_np, deterministic), {"policy_id": self.id}
+
+    def get_actions(self, obs_np, deterministic=False):
+        return eval_np(self, obs_np, deterministic=deterministic)[0]
+
+    def inference_layers(self):
+        """
+        See TanhGaussianPolicy.inference_layers.
+        """
+        network = self.ensemble_network
+        return (
+            [(fc.weight[self.index], fc.bias[self.index]) for fc in network.fcs],
+            (network.last_fc.weight[self.index], network.last_fc.bias[self.index]),
+            (network.last_fc_log_std.weight[self.index], network.last_fc_log_std.bias[self.index]),
+        )
+
+
+def _get_inference(policy):
+    if (
+            policy._inference is None
+            or policy._inference.use_numpy != policy.numpy_inference
+    ):
+        policy._inference = TanhGaussianInference(policy, use_numpy=policy.numpy_inference)
+    return policy._inference
+
+
+_NUMPY_ACTIVATIONS = {
+    F.relu: lambda x: np.maximum(x, 0, out=x),
+    torch.relu: lambda x: np.maximum(x, 0, out=x),
+    torch.tanh: lambda x: np.tanh(x, out=x),
+}
+
+
+class TanhGaussianInference(object):
+    """
+    Single observation action selection for a TanhGaussianPolicy (or an
+    EnsembleMemberPolicy), used by their get_action.
+
+    The forward only computes what sampling an action needs (no log_prob, no
+    TanhNormal, no extra outputs), reuses preallocated input, noise and
+    output buffers and runs under torch.inference_mode. It draws its noise
+    from the torch generator the same way TanhNormal.rsample does, so it
+    returns the same actions as the training forward.
+
+    With use_numpy=True the forward runs in NumPy on views of the CPU
+    weights instead, which avoids the torch dispatch overhead that dominates
+    for small MLPs. Its noise comes from np.random, so sampled actions match
+    the torch forward in distribution only.
+
+    The weights are looked up again whenever their storage changes (device
+    moves, ParameterArena rebinding, ensemble member removal), so an engine
+    stays valid while the policy is trained.
+    """
+
+    def __init__(self, policy, use_numpy=False):
+        self.policy = policy
+        self.use_numpy = use_numpy
+        # The parameters owning the weights: the stacked ones for an ensemble
+        # member, whose views are only rebuilt when these change.
+        network = getattr(policy, 'ensemble_network', policy)
+        self._parameters = list(network.parameters())
+        self._signature = None
+
+    def _sync(self):
+        signature = tuple(param.data_ptr() for param in self._parameters)
+        signature += (getattr(self.policy, 'index', None),)
+        if signature == self._signature:
+            return
+        hidden, mean_layer, log_std_layer = self.policy.inference_layers()
+        weight = mean_layer[0]
+        if self.use_numpy:
+            if weight.device.type != 'cpu':
+                raise ValueError("NumPy inference needs the policy on the CPU")
+            if self.policy.hidden_activation not in _NUMPY_ACTIVATIONS:
+                raise ValueError("NumPy inference does not support {}".format(
+                    self.policy.hidden_activation))
+            self._activation = _NUMPY_ACTIVATIONS[self.policy.hidden_activation]
+            # Views sharing memory with the parameters, so they follow updates
+            to_numpy = lambda layer: tuple(t.detach().numpy() for t in layer)
+        else:
+            self._activation = self.policy.hidden_activation
+            self._obs = torch.empty(1, hidden[0][0].shape[1] if hidden else weight.shape[1], device=weight.device)
+            self._noise = torch.empty(1, weight.shape[0], device=weight.device)
+            self._action = torch.empty(1, weight.shape[0], device=weight.device)
+            self._action_np = self._action[0].numpy() if weight.device.type == 'cpu' else None
+            to_numpy = lambda layer: tuple(t.detach() for t in layer)
+        self._hidden = [to_numpy(layer) for layer in hidden]
+        self._mean_layer = to_numpy(mean_layer)
+        self._log_std_layer = None if log_std_layer is None else to_numpy(log_std_layer)
+        self._signature = signature
+
+    def get_action(self, obs_np, deterministic=False):
+        """
+        :param obs_np: A single observation as a numpy array
+        :return: The action as a numpy array
+        """
+        self._sync()
+        if self.use_numpy:
+            return self._numpy_action(obs_np, deterministic)
+        with torch.inference_mode():
+            self._obs.copy_(torch.from_numpy(np.asarray(obs_np)).reshape(1, -1))
+            h = self._obs
+            for weight, bias in self._hidden:
+                h = self._activation(torch.addmm(bias, h, weight.t()))
+            mean = torch.addmm(self._mean_layer[1], h, self._mean_layer[0].t())
+            if deterministic:
+                torch.tanh(mean, out=self._action)
+            else:
+                if self._log_std_layer is None:
+                    std = self.policy.std
+                else:
+                    log_std = torch.addmm(self._log_std_layer[1], h, self._log_std_layer[0].t())
+                    std = log_std.clamp_(LOG_SIG_MIN, LOG_SIG_MAX).exp_()
+                self._noise.normal_()
+                torch.tanh(mean + std * self._noise, out=self._action)
+            if self._action_np is not None:
+                return self._action_np.copy()
+            return self._action[0].cpu().numpy()
+
+    def _numpy_action(self, obs_np, deterministic):
+        h = np.asarray(obs_np, dtype=np.float32)
+        for weight, bias in self._hidden:
+            h = self._activation(weight @ h + bias)
+        mean = self._mean_layer[0] @ h + self._mean_layer[1]
+        if not deterministic:
+            if self._log_std_layer is None:
+                std = self.policy.std
+            else:
+                log_std = self._log_std_layer[0] @ h + self._log_std_layer[1]
+                std = np.exp(np.clip(log_std, LOG_SIG_MIN, LOG_SIG_MAX))
+            mean += std * np.random.standard_normal(mean.shape).astype(np.float32)
+        return np.tanh(mean)
@@ -3,6 +3,7 @@ from collections import OrderedDict
 
 from typing import Iterable
 from torch import nn as nn
+import numpy as np
 import torch
 import time
 from functools import partial
@@ -11,7 +12,9 @@ from rlkit.core.batch_rl_algorithm import BatchRLAlgorithm
 from rlkit.core.batch_normalized_rl_algorithm import BatchNormalRLAlgorithm
 from rlkit.core.online_rl_algorithm import OnlineRLAlgorithm
 from rlkit.core.trainer import Trainer
+import rlkit.torch.pytorch_util as ptu
 from rlkit.torch.core import np_to_pytorch_batch
+from rlkit.torch.data_management.batch_prefetcher import BatchPrefetcher
 
 from rlkit.core import logger
 
@@ -26,9 +29,43 @@ class TorchOnlineRLAlgorithm(OnlineRLAlgorithm):
 
 
 class TorchBatchRLAlgorithm(BatchRLAlgorithm):
+    def __init__(self, *args, prefetch_batches=0, pin_memory=False, **kwargs):
+        """
+        :param prefetch_batches: Sample and convert up to this many training
+        batches ahead on a background thread, while the trainer runs. 0
+        samples each batch right before its training step.
+        :param pin_memory: Prefetch into pinned memory, for asynchronous
+        copies to the GPU.
+        """
+        super().__init__(*args, **kwargs)
+        self.batch_prefetcher = None
+        if prefetch_batches > 0:
+            self.batch_prefetcher = BatchPrefetcher(
+                self.replay_buffer, self.batch_size, prefetch_batches, pin_memory=pin_memory,
+                sample_batch=self._random_batch,
+            )
+
     def to(self, device):
         for net in self.trainer.networks:
             net.to(device)
+        if self.batch_prefetcher is not None:
+            self.batch_prefetcher.device = device
+
+    def _training_batches(self, num_batches):
+        if self.batch_prefetcher is None:
+            return super()._training_batches(num_batches)
+        return self.batch_prefetcher.batches(num_batches)
+
+    def _gather_batches(self, num_batches):
+        # Converted once, the trainer gets views of the tensors
+        return np_to_pytorch_batch(super()._gather_batches(num_batches))
+
+    def _log_stats(self, epoch):
+        if self.batch_prefetcher is not None:
+            # Non-zero when sampling is slower than training
+            logger.record_tabular('prefetch/wait (s)', self.batch_prefetcher.wait_time)
+            self.batch_prefetcher.wait_time = 0.
+        super()._log_stats(epoch)
 
     def training_mode(self, mode):
         for net in self.trainer.networks:
@@ -41,12 +78,19 @@ class DynamicTorchBatchRLAlgorithm(TorchBatchRLAlgorithm):
                  removal_check_frequency,
                  removal_check_buffer_size,
                  always_dryrun,
+                 add_learner_frequency=None,
                  **kwargs):
+        """
+        :param add_learner_frequency: If given, add a learner (see
+        add_learner) every this many steps, while the ensemble is smaller
+        than its max_size
+        """
         super().__init__(*args, **kwargs)
         self.ensemble = ensemble
         self.removal_check_frequency = removal_check_frequency
         self.removal_check_buffer_size = removal_check_buffer_size
         self.always_dryrun = always_dryrun
+        self.add_learner_frequency = add_learner_frequency
 
     def _end_epoch(self, epoch):
 
@@ -54,6 +98,38 @@ class DynamicTorchBatchRLAlgorithm(TorchBatchRLAlgorithm):
 
         if self.replay_buffer.num_steps_can_sample() % self.removal_check_frequency == 0:
             self.perform_removal_checks(self.always_dryrun)
+
+        if (
+                self.add_learner_frequency
+                and self.replay_buffer.num_steps_can_sample() % self.add_learner_frequency == 0
+                and len(self.ensemble) < self.ensemble.max_size
+        ):
+            self.add_learner()
+
+    def add_learner(self, source_index=None):
+        """
+        Grow the ensemble by a perturbed copy of learner source_index, by
+        default the best performing one, with a new bootstrap mask.
+        :return: The index of the new learner
+        """
+        if source_index is None:
+            source_index = int(np.argmax(self.replay_buffer.get_policy_performances()))
+        index = self.ensemble.add_learner(source_index)
+        self.trainer.add_policy(source_index)
+        self.replay_buffer.add_policy(torch.rand(self.replay_buffer._max_replay_buffer_size) < 0.5)
+        print(f"== Added learner {index}, a copy of learner {source_index} ==")
+        return index
+
+    def _random_batch(self):
+        if not getattr(self.replay_buffer, 'member_sampling', False):
+            return super()._random_batch()
+        # One batch per member, see DynamicEnsembleEnvReplayBuffer.random_member_batch
+        return self.replay_buffer.random_member_batch(self.batch_size)
+
+    def _gather_batches(self, num_batches):
+        if not getattr(self.replay_buffer, 'member_sampling', False):
+            return super()._gather_batches(num_batches)
+        return np_to_pytorch_batch(self.replay_buffer.random_member_batches(num_batches, self.batch_size))
     
     def perform_removal_checks(self, dry_run=False):
 
@@ -66,10 +142,13 @@ class DynamicTorchBatchRLAlgorithm(TorchBatchRLAlgorithm):
         removal_check_start_time = time.time()
 
         sample = self.replay_buffer.random_batch(self.removal_check_buffer_size)["observations"]
-        returns = self.replay_buffer.get_policy_historic_performance()
+        if isinstance(sample, torch.Tensor):
+            # The policies' get_actions take NumPy observations
+            sample = ptu.get_numpy(sample)
+        performances = self.replay_buffer.get_policy_performances()
         # Get the actions form the polices for all the observations in the sample
 
-        removal_check_results, debug = self.ensemble.removal_check(sample, returns)
+        removal_check_results, debug = self.ensemble.removal_check(sample, performances)
 
         print(f"== Removal check results: {removal_check_results} ==")
 
@@ -77,7 +156,7 @@ class DynamicTorchBatchRLAlgorithm(TorchBatchRLAlgorithm):
 
         if not dry_run and removal_check_results is not None:
             # Replace the worst performing policy
-            self.replay_buffer.update_mask(actor=removal_check_results, mask=torch.bernoulli(torch.tensor([0.5] * self.replay_buffer._max_replay_buffer_size)))
+            self.replay_buffer.update_mask(actor=removal_check_results, mask=torch.rand(self.replay_buffer._max_replay_buffer_size) < 0.5)
             removed_policy, div = self.ensemble.replace_policy(
                 removal_check_results,
                 sample,
@@ -0,0 +1,118 @@
+"""
+Time DSunriseTrainer gradient steps with the batches sampled in the training
+loop and with them prefetched on a background thread.
+
+    python scripts/benchmark_prefetcher.py --obs_dim 376 --action_dim 17 --prefetch_batches 2
+"""
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+from gymnasium.spaces import Box
+
+import rlkit.torch.pytorch_util as ptu
+from rlkit.data_management.simple_replay_buffer import EnsembleSimpleReplayBuffer
+from rlkit.torch.data_management.batch_prefetcher import BatchPrefetcher
+from rlkit.torch.sac.dsunrise import DSunriseTrainer
+
+from examples.sunrise_ensemble import Ensemble
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default=int(2E5), type=int)
+    parser.add_argument('--obs_dim', default=376, type=int)
+    parser.add_argument('--action_dim', default=17, type=int)
+    parser.add_argument('--num_ensemble', default=5, type=int)
+    parser.add_argument('--layer_size', default=256, type=int)
+    parser.add_argument('--vectorized_ensemble', action='store_true')
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--num_batches', default=200, type=int)
+    parser.add_argument('--prefetch_batches', default=2, type=int)
+    parser.add_argument('--pin_memory', action='store_true')
+    parser.add_argument('--computation_device', default='cpu', type=str)
+    return parser.parse_args()
+
+
+def make_buffer(args):
+    buffer = EnsembleSimpleReplayBuffer(
+        args.size, args.obs_dim, args.action_dim, env_info_sizes={},
+        num_ensemble=args.num_ensemble, log_dir=tempfile.mkdtemp(),
+    )
+    rng = np.random.RandomState(0)
+    length = 1000
+    for _ in range(args.size // length):
+        buffer.add_path(dict(
+            observations=rng.randn(length, args.obs_dim).astype(np.float32),
+            actions=rng.uniform(-1, 1, (length, args.action_dim)).astype(np.float32),
+            rewards=rng.randn(length, 1).astype(np.float32),
+            next_observations=rng.randn(length, args.obs_dim).astype(np.float32),
+            terminals=np.zeros((length, 1), dtype=np.uint8),
+            masks=(rng.rand(length, args.num_ensemble) < 0.5).astype(np.uint8),
+            env_infos=[{}] * length,
+        ))
+    return buffer
+
+
+class Spaces(object):
+    def __init__(self, args):
+        self.observation_space = Box(-np.inf, np.inf, (args.obs_dim,))
+        self.action_space = Box(-1, 1, (args.action_dim,))
+
+
+def make_trainer(args):
+    env = Spaces(args)
+    ensemble = Ensemble(
+        args.num_ensemble, env.observation_space, env.action_space, [args.layer_size] * 2,
+        0.2, 0.1, 0.95, 1000, 0.1, 0, vectorized=args.vectorized_ensemble,
+    )
+    trainer = DSunriseTrainer(
+        env=env, ensemble=ensemble, feedback_type=1, temperature=20.0, temperature_act=0,
+        expl_gamma=0, log_dir=tempfile.mkdtemp(), use_automatic_entropy_tuning=True,
+    )
+    for network in trainer.networks:
+        network.to(ptu.device)
+    return trainer
+
+
+def time_steps(trainer, batches):
+    """
+    :return: The mean time of a training step, sampling included.
+    """
+    start = time.time()
+    num_steps = 0
+    for batch in batches:
+        trainer.train(batch)
+        num_steps += 1
+    if ptu.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / num_steps
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    ptu.set_gpu_mode('cuda' in args.computation_device)
+    buffer = make_buffer(args)
+    trainer = make_trainer(args)
+    # Warm up
+    time_steps(trainer, (buffer.random_batch(args.batch_size) for _ in range(10)))
+
+    start = time.time()
+    for _ in range(args.num_batches):
+        buffer.random_batch(args.batch_size)
+    sample_time = (time.time() - start) / args.num_batches
+    serial_time = time_steps(trainer, (buffer.random_batch(args.batch_size) for _ in range(args.num_batches)))
+    prefetcher = BatchPrefetcher(buffer, args.batch_size, args.prefetch_batches, args.pin_memory, device=ptu.device)
+    prefetch_time = time_steps(trainer, prefetcher.batches(args.num_batches))
+
+    print("random_batch({}) {:.2f} ms".format(args.batch_size, sample_time * 1000))
+    print("train step, serial sampling:     {:.2f} ms".format(serial_time * 1000))
+    print("train step, prefetched ({} ahead): {:.2f} ms (waited {:.2f} ms per step)".format(
+        args.prefetch_batches, prefetch_time * 1000, prefetcher.wait_time / args.num_batches * 1000))
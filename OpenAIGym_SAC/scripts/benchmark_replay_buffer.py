@@ -0,0 +1,93 @@
+"""
+Compare the storage backends of the ensemble replay buffer: time to fill it,
+to sample training batches (as tensors) from it, and to checkpoint and
+reload it.
+
+    python scripts/benchmark_replay_buffer.py --size 1000000 --obs_dim 376
+"""
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from rlkit.data_management.simple_replay_buffer import EnsembleSimpleReplayBuffer
+from rlkit.torch.core import np_to_pytorch_batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default=int(1E6), type=int)
+    parser.add_argument('--obs_dim', default=376, type=int)
+    parser.add_argument('--action_dim', default=17, type=int)
+    parser.add_argument('--num_ensemble', default=10, type=int)
+    parser.add_argument('--path_length', default=1000, type=int)
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--num_batches', default=1000, type=int)
+    parser.add_argument('--storage', default=['memory', 'memmap', 'torch'], nargs='+')
+    parser.add_argument('--dir', default=None, type=str, help='Where to put the buffer files (default: a temporary directory)')
+    return parser.parse_args()
+
+
+def make_path(args, rng):
+    length = args.path_length
+    return dict(
+        observations=rng.randn(length, args.obs_dim).astype(np.float32),
+        actions=rng.uniform(-1, 1, (length, args.action_dim)).astype(np.float32),
+        rewards=rng.randn(length, 1).astype(np.float32),
+        next_observations=rng.randn(length, args.obs_dim).astype(np.float32),
+        terminals=np.zeros((length, 1), dtype=np.uint8),
+        masks=(rng.rand(length, args.num_ensemble) < 0.5).astype(np.uint8),
+        env_infos=[{}] * length,
+    )
+
+
+def benchmark(args, storage):
+    log_dir = tempfile.mkdtemp(dir=args.dir)
+    buffer_kwargs = dict(
+        max_replay_buffer_size=args.size,
+        observation_dim=args.obs_dim,
+        action_dim=args.action_dim,
+        env_info_sizes={},
+        num_ensemble=args.num_ensemble,
+        log_dir=log_dir,
+        storage=storage,
+    )
+    buffer = EnsembleSimpleReplayBuffer(**buffer_kwargs)
+    path = make_path(args, np.random.RandomState(0))
+
+    start = time.time()
+    for _ in range(args.size // args.path_length):
+        buffer.add_path(path)
+    fill_time = time.time() - start
+
+    start = time.time()
+    for _ in range(args.num_batches):
+        # What the trainer gets
+        np_to_pytorch_batch(buffer.random_batch(args.batch_size))
+    sample_time = (time.time() - start) / args.num_batches
+
+    start = time.time()
+    buffer.save_buffer(0)
+    save_time = time.time() - start
+
+    start = time.time()
+    loaded = EnsembleSimpleReplayBuffer(**buffer_kwargs)
+    loaded.load_buffer(0)
+    load_time = time.time() - start
+
+    print(
+        "{:>8}: fill {:.2f} s, random_batch({}) as tensors {:.3f} ms, save {:.2f} s, load {:.2f} s".format(
+            storage, fill_time, args.batch_size, sample_time * 1000, save_time, load_time)
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    for storage in args.storage:
+        benchmark(args, storage)
@@ -0,0 +1,114 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import rlkit.torch.pytorch_util as ptu
+from rlkit.data_management.simple_replay_buffer import EnsembleSimpleReplayBuffer
+from rlkit.torch.core import np_to_pytorch_batch
+from rlkit.torch.data_management.batch_prefetcher import BatchPrefetcher
+
+
+ptu.set_gpu_mode(False)
+
+NUM_ENSEMBLE = 3
+BATCH_SIZE = 8
+
+
+def make_buffer():
+    rng = np.random.RandomState(0)
+    buffer = EnsembleSimpleReplayBuffer(
+        100, observation_dim=3, action_dim=1, env_info_sizes={}, num_ensemble=NUM_ENSEMBLE,
+        log_dir=tempfile.mkdtemp(),
+    )
+    length = 50
+    buffer.add_path(dict(
+        observations=rng.randn(length, 3),
+        actions=rng.uniform(-1, 1, (length, 1)),
+        rewards=rng.randn(length, 1),
+        next_observations=rng.randn(length, 3),
+        terminals=rng.rand(length, 1) < 0.1,
+        masks=(rng.rand(length, NUM_ENSEMBLE) < 0.5).astype(float),
+        env_infos=[{} for _ in range(length)],
+    ))
+    return buffer
+
+
+class FailingBuffer(object):
+    def random_batch(self, batch_size):
+        raise ValueError("Empty buffer")
+
+
+class TestBatchPrefetcher(unittest.TestCase):
+
+    def test_matches_random_batch(self):
+        buffer = make_buffer()
+        np.random.seed(0)
+        expected = [np_to_pytorch_batch(buffer.random_batch(BATCH_SIZE)) for _ in range(7)]
+
+        prefetcher = BatchPrefetcher(buffer, BATCH_SIZE, num_prefetch=2)
+        np.random.seed(0)
+        # Two train loops, with the buffer free to change in between
+        for batches in [expected[:4], expected[4:]]:
+            for batch, expected_batch in zip(prefetcher.batches(len(batches)), batches):
+                self.assertEqual(sorted(batch.keys()), sorted(expected_batch.keys()))
+                for key, value in batch.items():
+                    self.assertEqual(value.dtype, torch.float32)
+                    torch.testing.assert_close(value, expected_batch[key], rtol=0, atol=0)
+
+    def test_mask_width_changes(self):
+        buffer = make_buffer()
+        prefetcher = BatchPrefetcher(buffer, BATCH_SIZE, num_prefetch=2)
+        self.assertEqual(len(list(prefetcher.batches(3))), 3)
+        # As after removing a member of the ensemble
+        buffer._set_mask_slots(buffer._mask_slots[1:])
+        for batch in prefetcher.batches(4):
+            self.assertEqual(tuple(batch['masks'].shape), (BATCH_SIZE, NUM_ENSEMBLE - 1))
+
+    def test_sample_batch(self):
+        buffer = make_buffer()
+        np.random.seed(0)
+        expected = [np_to_pytorch_batch(buffer.random_batches(2, BATCH_SIZE)) for _ in range(3)]
+
+        prefetcher = BatchPrefetcher(
+            buffer, BATCH_SIZE, num_prefetch=2, sample_batch=lambda: buffer.random_batches(2, BATCH_SIZE),
+        )
+        np.random.seed(0)
+        for batch, expected_batch in zip(prefetcher.batches(3), expected):
+            for key, value in batch.items():
+                torch.testing.assert_close(value, expected_batch[key], rtol=0, atol=0)
+
+    def test_stop_early(self):
+        buffer = make_buffer()
+        prefetcher = BatchPrefetcher(buffer, BATCH_SIZE, num_prefetch=2)
+        for _ in range(3):
+            for i, batch in enumerate(prefetcher.batches(10)):
+                if i == 1:
+                    break
+            self.assertEqual(prefetcher._free_slots.qsize(), prefetcher.num_prefetch + 1)
+            self.assertTrue(prefetcher._ready_slots.empty())
+        self.assertEqual(len(list(prefetcher.batches(4))), 4)
+
+    def test_error_is_raised(self):
+        prefetcher = BatchPrefetcher(FailingBuffer(), BATCH_SIZE)
+        with self.assertRaises(RuntimeError):
+            list(prefetcher.batches(3))
+        self.assertEqual(prefetcher._free_slots.qsize(), prefetcher.num_prefetch + 1)
+
+    def test_ignores_non_arrays(self):
+        buffer = make_buffer()
+        prefetcher = BatchPrefetcher(
+            buffer, BATCH_SIZE, sample_batch=lambda: dict(buffer.random_batch(BATCH_SIZE), infos=[{}] * BATCH_SIZE),
+        )
+        for batch in prefetcher.batches(2):
+            self.assertNotIn('infos', batch)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from rlkit.core.checkpoint_writer import CheckpointWriter, snapshot_state, torch_save
+
+
+def blocking_save(event):
+    def save_fn(payload, file):
+        event.wait()
+        torch.save(payload, file)
+    return save_fn
+
+
+class TestCheckpointWriter(unittest.TestCase):
+
+    def test_background_writes(self):
+        directory = tempfile.mkdtemp()
+        array = np.arange(5)
+        state = snapshot_state(dict(array=array, tensors=[torch.ones(3)]))
+        array[:] = 0
+        release = threading.Event()
+        finalized = []
+
+        writer = CheckpointWriter(max_pending=1)
+        path = os.path.join(directory, 'a.pt')
+        writer.submit([(path, blocking_save(release), state)], lambda: finalized.append(path))
+        writer.submit([(os.path.join(directory, 'b.pt'), torch_save, state)])
+        self.assertEqual(writer.num_pending(), 2)
+        # Nothing but the temporary file is visible until the write is done
+        self.assertFalse(os.path.exists(path))
+        release.set()
+        writer.wait()
+
+        self.assertEqual(finalized, [path])
+        self.assertEqual(sorted(os.listdir(directory)), ['a.pt', 'b.pt'])
+        loaded = torch.load(path, weights_only=False)
+        np.testing.assert_array_equal(loaded['array'], np.arange(5))
+        self.assertGreater(writer.last_write_bytes, 0)
+
+    def test_error_is_raised(self):
+        writer = CheckpointWriter()
+        writer.submit([(os.path.join(tempfile.mkdtemp(), 'missing', 'a.pt'), torch_save, {})])
+        with self.assertRaises(RuntimeError):
+            writer.wait()
+        writer.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
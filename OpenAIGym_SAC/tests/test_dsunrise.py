@@ -0,0 +1,426 @@
+import random
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import torch
+from gymnasium.spaces import Box
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import rlkit.torch.pytorch_util as ptu
+from rlkit.core.checkpoint_writer import write_checkpoint
+from rlkit.torch.sac.dsunrise import DSunriseTrainer
+
+from examples.sunrise_ensemble import Ensemble
+
+
+ptu.set_gpu_mode(False)
+
+OBS_DIM = 5
+ACTION_DIM = 2
+BATCH_SIZE = 32
+NUM_ENSEMBLE = 4
+
+
+class FakeEnv(object):
+    observation_space = Box(-np.inf, np.inf, (OBS_DIM,))
+    action_space = Box(-1, 1, (ACTION_DIM,))
+
+
+def make_trainer(feedback_type, vectorized=False, flat_parameters=False, max_size=None):
+    ensemble = Ensemble(
+        NUM_ENSEMBLE,
+        FakeEnv.observation_space,
+        FakeEnv.action_space,
+        [16, 16],
+        diversity_threshold=0.2,
+        diversity_critical_threshold=0.1,
+        performance_gamma=0.95,
+        window_size=10,
+        noise=0.1,
+        retrain_steps=0,
+        vectorized=vectorized,
+        flat_parameters=flat_parameters,
+        max_size=max_size,
+    )
+    return DSunriseTrainer(
+        env=FakeEnv(),
+        ensemble=ensemble,
+        feedback_type=feedback_type,
+        temperature=20.0,
+        temperature_act=0.0,
+        expl_gamma=0.0,
+        log_dir=tempfile.mkdtemp(),
+    )
+
+
+def loop_corrective_feedback(trainer, obs, update_type):
+    """
+    The original one learner at a time implementation of corrective_feedback.
+    """
+    ensemble = trainer.ensemble
+    std_Q_list = []
+
+    if trainer.feedback_type == 0 or trainer.feedback_type == 2:
+        for en_index in range(len(ensemble)):
+            with torch.no_grad():
+                policy_action, *_ = ensemble.get_policies()[en_index](
+                    obs, reparameterize=True, return_log_prob=True,
+                )
+                if update_type == 0:
+                    actor_Q1 = ensemble.get_critic1s()[en_index](obs, policy_action)
+                    actor_Q2 = ensemble.get_critic2s()[en_index](obs, policy_action)
+                else:
+                    actor_Q1 = ensemble.get_target_critic1s()[en_index](obs, policy_action)
+                    actor_Q2 = ensemble.get_target_critic2s()[en_index](obs, policy_action)
+                mean_actor_Q = 0.5*(actor_Q1 + actor_Q2)
+                var_Q = 0.5*((actor_Q1 - mean_actor_Q)**2 + (actor_Q2 - mean_actor_Q)**2)
+            std_Q_list.append(torch.sqrt(var_Q))
+    else:
+        L_target_Q = []
+        for en_index in range(len(ensemble)):
+            with torch.no_grad():
+                policy_action, *_ = ensemble.get_policies()[en_index](
+                    obs, reparameterize=True, return_log_prob=True,
+                )
+                if update_type == 0:
+                    target_Q1 = ensemble.get_critic1s()[en_index](obs, policy_action)
+                    target_Q2 = ensemble.get_critic2s()[en_index](obs, policy_action)
+                else:
+                    target_Q1 = ensemble.get_target_critic1s()[en_index](obs, policy_action)
+                    target_Q2 = ensemble.get_target_critic2s()[en_index](obs, policy_action)
+                L_target_Q.append(target_Q1)
+                L_target_Q.append(target_Q2)
+                if en_index == 0:
+                    mean_Q = 0.5*(target_Q1 + target_Q2) / len(ensemble)
+                else:
+                    mean_Q += 0.5*(target_Q1 + target_Q2) / len(ensemble)
+
+        var_Q = sum((target_Q - mean_Q)**2 for target_Q in L_target_Q) / len(L_target_Q)
+        std_Q_list.append(torch.sqrt(var_Q))
+
+    return std_Q_list
+
+
+def make_policies_deterministic(ensemble):
+    """
+    Pin log_std to its minimum so that sampled actions do not depend on the
+    order the noise is drawn in.
+    """
+    for policy in ensemble.get_policies():
+        state_dict = policy.state_dict()
+        state_dict['last_fc_log_std.weight'].zero_()
+        state_dict['last_fc_log_std.bias'].fill_(-100)
+        policy.load_state_dict(state_dict)
+
+
+class TestCorrectiveFeedback(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.obs = torch.randn(BATCH_SIZE, OBS_DIM)
+
+    def assert_matches_loop(self, trainer, update_type, seed=None):
+        if seed is not None:
+            torch.manual_seed(seed)
+        expected = loop_corrective_feedback(trainer, self.obs, update_type)
+        if seed is not None:
+            torch.manual_seed(seed)
+        std_Q = trainer.corrective_feedback(self.obs, update_type)
+
+        self.assertEqual(std_Q.shape[0], len(expected))
+        for en_index, expected_std_Q in enumerate(expected):
+            np.testing.assert_allclose(
+                ptu.get_numpy(std_Q[en_index]),
+                ptu.get_numpy(expected_std_Q),
+                rtol=1e-5, atol=1e-6,
+            )
+
+    def test_matches_loop(self):
+        for feedback_type in range(4):
+            trainer = make_trainer(feedback_type)
+            for update_type in [0, 1]:
+                with self.subTest(feedback_type=feedback_type, update_type=update_type):
+                    self.assert_matches_loop(trainer, update_type, seed=1)
+
+    def test_matches_loop_vectorized(self):
+        for feedback_type in range(4):
+            trainer = make_trainer(feedback_type, vectorized=True)
+            make_policies_deterministic(trainer.ensemble)
+            for update_type in [0, 1]:
+                with self.subTest(feedback_type=feedback_type, update_type=update_type):
+                    self.assert_matches_loop(trainer, update_type)
+
+    def test_feedback_shapes(self):
+        for feedback_type, num_std in [(0, NUM_ENSEMBLE), (1, 1), (2, NUM_ENSEMBLE), (3, 1)]:
+            trainer = make_trainer(feedback_type)
+            std_Q = trainer.corrective_feedback(self.obs, 0)
+            self.assertEqual(tuple(std_Q.shape), (num_std, BATCH_SIZE, 1))
+
+
+def make_batch(num_ensemble=NUM_ENSEMBLE):
+    rng = np.random.RandomState(0)
+    return dict(
+        observations=rng.randn(BATCH_SIZE, OBS_DIM),
+        next_observations=rng.randn(BATCH_SIZE, OBS_DIM),
+        actions=rng.uniform(-1, 1, (BATCH_SIZE, ACTION_DIM)),
+        rewards=rng.randn(BATCH_SIZE, 1),
+        terminals=np.zeros((BATCH_SIZE, 1), dtype='uint8'),
+        masks=(rng.rand(BATCH_SIZE, num_ensemble) < 0.5).astype(float),
+    )
+
+
+class TestForwardCache(unittest.TestCase):
+
+    def test_train_step_reuses_target_forwards(self):
+        for vectorized, expected_hits in [(False, 2 * NUM_ENSEMBLE), (True, 2)]:
+            with self.subTest(vectorized=vectorized):
+                trainer = make_trainer(feedback_type=1, vectorized=vectorized)
+                trainer.train(make_batch())
+                self.assertEqual(trainer.get_diagnostics()['Forward Cache Hits'], expected_hits)
+                trainer.end_epoch(0)
+                self.assertEqual(trainer.get_diagnostics()['Forward Cache Hits'], 0)
+
+
+class TestMemberBatches(unittest.TestCase):
+
+    def test_member_corrective_feedback(self):
+        torch.manual_seed(0)
+        obs = torch.randn(NUM_ENSEMBLE, BATCH_SIZE, OBS_DIM)
+        for vectorized in [False, True]:
+            for feedback_type in range(4):
+                with self.subTest(vectorized=vectorized, feedback_type=feedback_type):
+                    trainer = make_trainer(feedback_type, vectorized=vectorized)
+                    make_policies_deterministic(trainer.ensemble)
+                    input_rows = []
+                    hooks = [
+                        policy.register_forward_pre_hook(lambda module, args: input_rows.append(args[0].shape[-2]))
+                        for policy in trainer.ensemble.get_policies()
+                    ]
+                    std_Q = trainer._member_corrective_feedback(obs, update_type=1)
+                    for hook in hooks:
+                        hook.remove()
+                    self.assertEqual(tuple(std_Q.shape), (NUM_ENSEMBLE, BATCH_SIZE, 1))
+                    if not vectorized and feedback_type in (0, 2):
+                        # Each learner only runs on its own rows
+                        self.assertEqual(input_rows, [BATCH_SIZE] * NUM_ENSEMBLE)
+                    for en_index in range(NUM_ENSEMBLE):
+                        expected = trainer.corrective_feedback(obs[en_index], update_type=1)
+                        expected = expected[en_index if len(expected) > 1 else 0]
+                        torch.testing.assert_close(std_Q[en_index], expected, rtol=1e-5, atol=1e-6)
+                        # The targets of each learner on its own rows
+                        policy_action = trainer._forward_cache.get('policy', obs, member=en_index)[0]
+                        expected_action = trainer.ensemble.get_policies()[en_index](obs[en_index])[0]
+                        torch.testing.assert_close(policy_action, expected_action, rtol=1e-5, atol=1e-6)
+                    trainer._forward_cache.clear()
+
+    def test_matches_full_masks(self):
+        """
+        Member batches that all hold the same rows train like a batch with every mask bit set.
+        """
+        batch = make_batch()
+        batch['masks'][:] = 1
+        member_batch = {key: np.stack([value] * NUM_ENSEMBLE) for key, value in batch.items() if key != 'masks'}
+        member_batch['masks'] = batch['masks'].T
+        for vectorized in [False, True]:
+            for feedback_type in range(4):
+                with self.subTest(vectorized=vectorized, feedback_type=feedback_type):
+                    trainers = []
+                    for train_batch in [batch, member_batch]:
+                        torch.manual_seed(0)
+                        trainer = make_trainer(feedback_type, vectorized=vectorized)
+                        make_policies_deterministic(trainer.ensemble)
+                        trainer.train(train_batch)
+                        trainers.append(trainer)
+                    # The losses and Q statistics, as Adam's first step amplifies float noise in tiny gradients.
+                    # log_pi still depends on the noise of the samples, which is drawn in another order.
+                    expected, result = (trainer.get_diagnostics() for trainer in trainers)
+                    np.testing.assert_allclose(result['Q1 Predictions Mean'], expected['Q1 Predictions Mean'], rtol=1e-6)
+                    for key in ['QF1 Loss', 'QF2 Loss', 'Q Targets Mean']:
+                        np.testing.assert_allclose(result[key], expected[key], rtol=1e-3, err_msg=key)
+
+
+def all_parameters(trainer):
+    return torch.cat([param.detach().reshape(-1) for network in trainer.networks for param in network.parameters()])
+
+
+class TestParameterArena(unittest.TestCase):
+
+    def train(self, trainers, num_ensemble):
+        for trainer in trainers:
+            torch.manual_seed(1)
+            trainer.train(make_batch(num_ensemble))
+
+    def test_matches_per_parameter_storage(self):
+        for vectorized in [False, True]:
+            with self.subTest(vectorized=vectorized):
+                trainers = []
+                for flat in [False, True]:
+                    torch.manual_seed(0)
+                    trainers.append(make_trainer(1, vectorized=vectorized, flat_parameters=flat))
+                self.train(trainers, NUM_ENSEMBLE)
+                for trainer in trainers:
+                    trainer.ensemble.remove_policy(1)
+                    trainer.remove_policy(1)
+                self.train(trainers, NUM_ENSEMBLE - 1)
+
+                expected, result = map(all_parameters, trainers)
+                np.testing.assert_allclose(ptu.get_numpy(result), ptu.get_numpy(expected), atol=1e-6)
+                self.assertEqual(len(trainers[1].ensemble.arenas['policy']), NUM_ENSEMBLE - 1)
+
+    def test_checkpoint_round_trip(self):
+        trainer = make_trainer(1, flat_parameters=True)
+        trainer.train(make_batch())
+        trainer.save_models(0)
+
+        restored = make_trainer(1, flat_parameters=True)
+        restored.model_dir = trainer.model_dir
+        restored.load_models([0])
+        torch.testing.assert_close(all_parameters(restored), all_parameters(trainer), rtol=0, atol=0)
+
+    def test_checkpoint_snapshot(self):
+        for flat in [False, True]:
+            with self.subTest(flat_parameters=flat):
+                trainer = make_trainer(1, flat_parameters=flat)
+                trainer.train(make_batch())
+                expected = all_parameters(trainer).clone()
+                checkpoint = trainer.get_checkpoint(0)
+                # Training goes on while the checkpoint is written
+                trainer.train(make_batch())
+                write_checkpoint(*checkpoint)
+
+                restored = make_trainer(1, flat_parameters=flat)
+                restored.model_dir = trainer.model_dir
+                restored.load_models([0])
+                torch.testing.assert_close(all_parameters(restored), expected, rtol=0, atol=0)
+
+
+class TestCheckpointBundle(unittest.TestCase):
+
+    def test_resume(self):
+        for vectorized, flat in [(False, False), (True, False), (False, True)]:
+            with self.subTest(vectorized=vectorized, flat_parameters=flat):
+                trainer = make_trainer(1, vectorized=vectorized, flat_parameters=flat)
+                trainer.train(make_batch())
+                trainer.ensemble.remove_policy(1)
+                trainer.remove_policy(1)
+                trainer.train(make_batch(NUM_ENSEMBLE - 1))
+                trainer.save_models(2)
+                expected_draws = torch.rand(3), np.random.rand(3), random.random()
+
+                restored = make_trainer(1, vectorized=vectorized, flat_parameters=flat)
+                restored.model_dir = trainer.model_dir
+                self.assertEqual(restored.load_models([3, 2]), 2)
+                self.assertEqual(len(restored.ensemble), NUM_ENSEMBLE - 1)
+                self.assertEqual(restored._n_train_steps_total, trainer._n_train_steps_total)
+                # The random number generators continue where they were saved
+                torch.testing.assert_close(torch.rand(3), expected_draws[0], rtol=0, atol=0)
+                np.testing.assert_array_equal(np.random.rand(3), expected_draws[1])
+                self.assertEqual(random.random(), expected_draws[2])
+                torch.testing.assert_close(all_parameters(restored), all_parameters(trainer), rtol=0, atol=0)
+
+                # Same optimizer moments and temperatures: the next step matches too
+                batch = make_batch(NUM_ENSEMBLE - 1)
+                for t in [trainer, restored]:
+                    torch.manual_seed(0)
+                    t.train(batch)
+                torch.testing.assert_close(all_parameters(restored), all_parameters(trainer), rtol=0, atol=0)
+
+    def test_grows_to_saved_size(self):
+        trainer = make_trainer(1, max_size=NUM_ENSEMBLE + 1)
+        trainer.ensemble.add_learner(0)
+        trainer.add_policy(0)
+        trainer.train(make_batch(NUM_ENSEMBLE + 1))
+        trainer.save_models(0)
+        restored = make_trainer(1, max_size=NUM_ENSEMBLE + 1)
+        restored.model_dir = trainer.model_dir
+        restored.ensemble.remove_policy(0)
+        restored.remove_policy(0)
+        restored.load_models([0])
+        self.assertEqual(len(restored.ensemble), NUM_ENSEMBLE + 1)
+        torch.testing.assert_close(all_parameters(restored), all_parameters(trainer), rtol=0, atol=0)
+
+    def test_too_many_members(self):
+        trainer = make_trainer(1, max_size=NUM_ENSEMBLE + 1)
+        trainer.ensemble.add_learner(0)
+        trainer.add_policy(0)
+        trainer.save_models(0)
+        restored = make_trainer(1)
+        restored.model_dir = trainer.model_dir
+        with self.assertRaises(ValueError):
+            restored.load_models([0])
+
+
+class TestAddLearner(unittest.TestCase):
+
+    def storage_pointers(self, trainer):
+        """
+        The data pointers of the stacked parameters and optimizer states.
+        """
+        states = [
+            state for group in trainer.optimizer.param_groups + trainer.alpha_optimizer.param_groups
+            for key in ['exp_avgs', 'exp_avg_sqs'] for state in group[key] if isinstance(state, torch.Tensor)
+        ]
+        tensors = [param for network in trainer.ensemble.get_networks() for param in network.parameters()]
+        return [tensor.data_ptr() for tensor in tensors + states + [trainer.log_alpha]]
+
+    def test_add_and_remove(self):
+        for vectorized, flat in [(False, False), (True, False), (False, True), (True, True)]:
+            with self.subTest(vectorized=vectorized, flat_parameters=flat):
+                trainer = make_trainer(0, vectorized=vectorized, flat_parameters=flat, max_size=NUM_ENSEMBLE + 1)
+                trainer.train(make_batch())
+                pointers = self.storage_pointers(trainer) if vectorized else None
+
+                ensemble = trainer.ensemble
+                self.assertEqual(ensemble.add_learner(1), NUM_ENSEMBLE)
+                trainer.add_policy(1)
+                self.assertEqual(len(ensemble), NUM_ENSEMBLE + 1)
+                for networks in [ensemble.get_critic1s(), ensemble.get_target_critic2s()]:
+                    for param, source_param in zip(networks[-1].parameters(), networks[1].parameters()):
+                        torch.testing.assert_close(param, source_param, rtol=0, atol=0)
+                self.assertFalse(torch.equal(
+                    next(ensemble.get_policies()[-1].parameters()), next(ensemble.get_policies()[1].parameters())))
+                torch.testing.assert_close(trainer.log_alpha[-1], trainer.log_alpha[1], rtol=0, atol=0)
+                if vectorized:
+                    # Resized in place within the preallocated capacity
+                    self.assertEqual(self.storage_pointers(trainer), pointers)
+
+                trainer.train(make_batch(NUM_ENSEMBLE + 1))
+                for group in trainer.optimizer.param_groups:
+                    np.testing.assert_array_equal(ptu.get_numpy(group['steps']), [2] * NUM_ENSEMBLE + [1])
+
+                ensemble.remove_policy(0)
+                trainer.remove_policy(0)
+                trainer.train(make_batch())
+                if vectorized:
+                    self.assertEqual(self.storage_pointers(trainer), pointers)
+                ensemble.add_learner(0)
+                trainer.add_policy(0)
+                with self.assertRaises(ValueError):
+                    ensemble.add_learner(0)
+
+    def test_add_then_remove_matches(self):
+        for vectorized in [False, True]:
+            with self.subTest(vectorized=vectorized):
+                trainers = []
+                for grow in [False, True]:
+                    torch.manual_seed(0)
+                    trainer = make_trainer(1, vectorized=vectorized, max_size=NUM_ENSEMBLE + 1)
+                    trainer.train(make_batch())
+                    if grow:
+                        trainer.ensemble.add_learner(2)
+                        trainer.add_policy(2)
+                        trainer.ensemble.remove_policy(NUM_ENSEMBLE)
+                        trainer.remove_policy(NUM_ENSEMBLE)
+                    torch.manual_seed(1)
+                    trainer.train(make_batch())
+                    trainers.append(trainer)
+                torch.testing.assert_close(all_parameters(trainers[1]), all_parameters(trainers[0]), rtol=0, atol=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import sys
+import unittest
+from pathlib import Path
+
+import torch
+from torch import nn as nn
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from rlkit.torch.optimizers import EnsembleAdam, member_parameters
+from rlkit.torch.pytorch_util import resize_rows
+
+
+NUM_ENSEMBLE = 3
+
+
+def make_members():
+    torch.manual_seed(0)
+    return [nn.Linear(4, 2) for _ in range(NUM_ENSEMBLE)]
+
+
+def stacked_copy(members):
+    return [
+        nn.Parameter(torch.stack([p.detach().clone() for p in params]))
+        for params in member_parameters(members)
+    ]
+
+
+def member_loss(params, member, x):
+    weight, bias = params
+    return (torch.tanh(x @ weight.t() + bias) ** 2).sum() * (member + 1)
+
+
+class TestEnsembleAdam(unittest.TestCase):
+
+    def setUp(self):
+        self.inputs = [torch.randn(8, 4) for _ in range(4)]
+
+    def run_reference(self, members, steps):
+        """
+        One torch.optim.Adam per member, stepping only the members in `steps`.
+        """
+        optimizers = [torch.optim.Adam(m.parameters(), lr=1e-2) for m in members]
+        for x, step_members in zip(self.inputs, steps):
+            for i in step_members:
+                optimizers[i].zero_grad()
+                member_loss(list(members[i].parameters()), i, x).backward()
+                optimizers[i].step()
+
+    def run_ensemble(self, slots, get_params, steps):
+        optimizer = EnsembleAdam(slots, lr=1e-2)
+        for x, step_members in zip(self.inputs, steps):
+            optimizer.zero_grad()
+            sum(member_loss(get_params(i), i, x) for i in step_members).backward()
+            optimizer.step(members=None if len(step_members) == NUM_ENSEMBLE else step_members)
+        return optimizer
+
+    def test_matches_per_member_adam(self):
+        steps = [range(NUM_ENSEMBLE), [1], range(NUM_ENSEMBLE), [0, 2]]
+        for stacked in [False, True]:
+            with self.subTest(stacked=stacked):
+                reference = make_members()
+                self.run_reference(reference, steps)
+
+                members = make_members()
+                if stacked:
+                    slots = stacked_copy(members)
+                    self.run_ensemble(slots, lambda i: [p[i] for p in slots], steps)
+                    results = [[p[i] for p in slots] for i in range(NUM_ENSEMBLE)]
+                else:
+                    self.run_ensemble(
+                        member_parameters(members), lambda i: list(members[i].parameters()), steps,
+                    )
+                    results = [list(m.parameters()) for m in members]
+
+                for expected, result in zip(reference, results):
+                    for p, q in zip(expected.parameters(), result):
+                        torch.testing.assert_close(q, p, rtol=1e-5, atol=1e-6)
+
+    def test_skips_members_without_grads(self):
+        # Members selected for the step whose loss is not in the backward pass
+        selected = [range(NUM_ENSEMBLE), [0, 1], range(NUM_ENSEMBLE), [1, 2]]
+        trained = [[0, 2], [0], [1], [2]]
+        reference = make_members()
+        self.run_reference(reference, trained)
+
+        members = make_members()
+        optimizer = EnsembleAdam(member_parameters(members), lr=1e-2)
+        for x, step_members, loss_members in zip(self.inputs, selected, trained):
+            optimizer.zero_grad()
+            sum(member_loss(list(members[i].parameters()), i, x) for i in loss_members).backward()
+            optimizer.step(members=None if len(step_members) == NUM_ENSEMBLE else step_members)
+        self.assertEqual(optimizer.param_groups[0]['steps'].tolist(), [2, 1, 2])
+        for expected, member in zip(reference, members):
+            for p, q in zip(expected.parameters(), member.parameters()):
+                torch.testing.assert_close(q, p, rtol=1e-5, atol=1e-6)
+
+        # Stacked slots without a grad are left as they are
+        slots = stacked_copy(make_members())
+        optimizer = self.run_ensemble(slots, lambda i: [p[i] for p in slots], [range(NUM_ENSEMBLE)])
+        before = [slot.detach().clone() for slot in slots]
+        optimizer.zero_grad()
+        optimizer.step()
+        self.assertEqual(optimizer.param_groups[0]['steps'].tolist(), [1] * NUM_ENSEMBLE)
+        for slot, expected in zip(slots, before):
+            torch.testing.assert_close(slot.detach(), expected)
+
+    def test_remove_member_and_state_dict(self):
+        members = make_members()
+        optimizer = self.run_ensemble(
+            member_parameters(members), lambda i: list(members[i].parameters()), [range(NUM_ENSEMBLE)] * 2,
+        )
+        del members[1]
+        optimizer.remove_member(1)
+        self.assertEqual(optimizer.param_groups[0]['steps'].tolist(), [2, 2])
+
+        restored_members = make_members()[:NUM_ENSEMBLE - 1]
+        for member, restored_member in zip(members, restored_members):
+            restored_member.load_state_dict(member.state_dict())
+        restored = EnsembleAdam(member_parameters(restored_members), lr=1e-2)
+        restored.load_state_dict(optimizer.state_dict())
+
+        for optim, networks in [(optimizer, members), (restored, restored_members)]:
+            optim.zero_grad()
+            sum(
+                member_loss(list(m.parameters()), i, self.inputs[2]) for i, m in enumerate(networks)
+            ).backward()
+            optim.step()
+        for member, restored_member in zip(members, restored_members):
+            for p, q in zip(member.parameters(), restored_member.parameters()):
+                torch.testing.assert_close(q, p)
+
+    def test_add_member(self):
+        for stacked in [False, True]:
+            with self.subTest(stacked=stacked):
+                members = make_members()
+                new_member = nn.Linear(4, 2)
+                new_params = [p.detach().clone() for p in new_member.parameters()]
+                if stacked:
+                    slots = stacked_copy(members)
+                    for slot in slots:
+                        slot.data = resize_rows(slot.data, NUM_ENSEMBLE, NUM_ENSEMBLE + 1)
+                    get_params = lambda i: [p[i] for p in slots]
+                else:
+                    slots = member_parameters(members)
+                    get_params = lambda i: list((members + [new_member])[i].parameters())
+                optimizer = EnsembleAdam(slots, lr=1e-2, capacity=NUM_ENSEMBLE + 1)
+                optimizer.zero_grad()
+                sum(member_loss(get_params(i), i, self.inputs[0]) for i in range(NUM_ENSEMBLE)).backward()
+                optimizer.step()
+                pointers = [state.data_ptr() for state in optimizer.param_groups[0]['exp_avgs'] if stacked]
+
+                if stacked:
+                    # The owner of stacked parameters grows them
+                    for slot, param in zip(slots, new_params):
+                        slot.data = resize_rows(slot.data, NUM_ENSEMBLE + 1)
+                        slot.data[-1] = param
+                    optimizer.add_member()
+                else:
+                    optimizer.add_member(list(new_member.parameters()))
+                self.assertEqual(pointers, [state.data_ptr() for state in optimizer.param_groups[0]['exp_avgs'] if stacked])
+
+                optimizer.zero_grad()
+                sum(member_loss(get_params(i), i, self.inputs[1]) for i in range(NUM_ENSEMBLE + 1)).backward()
+                optimizer.step()
+                self.assertEqual(optimizer.param_groups[0]['steps'].tolist(), [2] * NUM_ENSEMBLE + [1])
+
+                # The new member is stepped like a fresh Adam
+                reference_params = [nn.Parameter(p.clone()) for p in new_params]
+                reference = torch.optim.Adam(reference_params, lr=1e-2)
+                member_loss(reference_params, NUM_ENSEMBLE, self.inputs[1]).backward()
+                reference.step()
+                for p, q in zip(reference_params, get_params(NUM_ENSEMBLE)):
+                    torch.testing.assert_close(q, p, rtol=1e-5, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import sys
+import unittest
+from pathlib import Path
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import rlkit.torch.pytorch_util as ptu
+from rlkit.envs.wrappers import NormalizedBoxEnv
+from rlkit.samplers.data_collector import DynamicEnsembleMdpPathCollector
+
+from examples.sunrise_ensemble import Ensemble
+
+
+ptu.set_gpu_mode(False)
+
+NUM_ENVS = 3
+NUM_ENSEMBLE = 4
+MAX_PATH_LENGTH = 20
+
+
+def make_env():
+    return NormalizedBoxEnv(gym.make('Pendulum-v1'))
+
+
+class RandomTermination(gym.Wrapper):
+    """
+    Ends episodes after a random number of steps, drawn from the seed of the
+    first reset, so that the sub-environments of a vector env end at
+    different steps.
+    """
+
+    def reset(self, seed=None, **kwargs):
+        obs, info = self.env.reset(seed=seed, **kwargs)
+        if seed is not None:
+            self._rng = np.random.RandomState(seed)
+        self._steps_left = self._rng.randint(1, MAX_PATH_LENGTH)
+        return obs, info
+
+    def step(self, action):
+        obs, reward, terminated, truncated, info = self.env.step(action)
+        self._steps_left -= 1
+        return obs, reward, terminated or self._steps_left == 0, truncated, info
+
+
+def make_terminating_env():
+    return RandomTermination(make_env())
+
+
+def make_ensemble(vectorized=False):
+    env = make_env()
+    torch.manual_seed(0)
+    return Ensemble(
+        NUM_ENSEMBLE,
+        env.observation_space,
+        env.action_space,
+        [16, 16],
+        diversity_threshold=0.2,
+        diversity_critical_threshold=0.1,
+        performance_gamma=0.95,
+        window_size=10,
+        noise=0.1,
+        retrain_steps=0,
+        vectorized=vectorized,
+    )
+
+
+class TestDynamicEnsembleMdpPathCollector(unittest.TestCase):
+
+    def assert_valid_paths(self, paths, num_ensemble):
+        for path in paths:
+            path_len = len(path['actions'])
+            self.assertLessEqual(path_len, MAX_PATH_LENGTH)
+            self.assertEqual(path['observations'].shape, (path_len, 3))
+            self.assertEqual(path['next_observations'].shape, (path_len, 3))
+            self.assertEqual(path['actions'].shape, (path_len, 1))
+            self.assertEqual(path['rewards'].shape, (path_len, 1))
+            self.assertEqual(path['terminals'].shape, (path_len, 1))
+            self.assertEqual(path['masks'].shape, (path_len, num_ensemble))
+            self.assertTrue((path['masks'].sum(axis=1) > 0).all())
+            self.assertEqual(len(path['agent_infos']), path_len)
+            self.assertEqual(len(path['env_infos']), path_len)
+            np.testing.assert_array_equal(path['observations'][1:], path['next_observations'][:-1])
+
+    def test_vector_env_paths(self):
+        for vectorized in [False, True]:
+            for inference_type in [0.0, 1.0]:
+                with self.subTest(vectorized=vectorized, inference_type=inference_type):
+                    env = gym.vector.SyncVectorEnv([make_env] * NUM_ENVS)
+                    ensemble = make_ensemble(vectorized=vectorized)
+                    collector = DynamicEnsembleMdpPathCollector(
+                        env, ensemble, inference_type=inference_type,
+                    )
+                    paths = collector.collect_new_paths(MAX_PATH_LENGTH, 50, False)
+                    # 50 rounded up to a multiple of NUM_ENVS
+                    self.assertEqual(sum(len(path['actions']) for path in paths), 51)
+                    self.assert_valid_paths(paths, NUM_ENSEMBLE)
+                    if inference_type == 0:
+                        for path in paths:
+                            policy_ids = {info['policy_id'] for info in path['agent_infos']}
+                            self.assertEqual(len(policy_ids), 1)
+
+                    ensemble.remove_policy(NUM_ENSEMBLE - 1)
+                    paths = collector.collect_new_paths(MAX_PATH_LENGTH, 30, False)
+                    self.assert_valid_paths(paths, NUM_ENSEMBLE - 1)
+                    env.close()
+
+    def test_partial_reset(self):
+        results = []
+        for vector_env_class in [gym.vector.SyncVectorEnv, gym.vector.AsyncVectorEnv]:
+            with self.subTest(vector_env_class=vector_env_class.__name__):
+                env = vector_env_class([make_terminating_env] * NUM_ENVS)
+                env.reset(seed=0)
+                np.random.seed(0)
+                collector = DynamicEnsembleMdpPathCollector(env, make_ensemble())
+                paths = collector.collect_new_paths(MAX_PATH_LENGTH, 120, False)
+                env.close()
+                # Only the ended sub-environments were reset
+                self.assert_valid_paths(paths, NUM_ENSEMBLE)
+                for path in paths[:-NUM_ENVS]:
+                    path_len = len(path['actions'])
+                    self.assertTrue(path['terminals'][-1] or path_len == MAX_PATH_LENGTH)
+                    self.assertFalse(path['terminals'][:-1].any())
+                self.assertGreater(len({len(path['actions']) for path in paths}), 1)
+                results.append(paths)
+        for sync_path, async_path in zip(*results):
+            for key in ['observations', 'actions', 'rewards', 'terminals']:
+                np.testing.assert_array_equal(async_path[key], sync_path[key])
+
+    def test_eval_aggregations(self):
+        env = make_env()
+        ensemble = make_ensemble()
+        for aggregation in ['mean', 'median', 'ucb', 'vote']:
+            with self.subTest(aggregation=aggregation):
+                collector = DynamicEnsembleMdpPathCollector(
+                    env, ensemble, eval_flag=True, eval_aggregation=aggregation,
+                )
+                paths = collector.collect_new_paths(MAX_PATH_LENGTH, 2 * MAX_PATH_LENGTH, True)
+                self.assertEqual(len(paths), 2)
+                for path in paths:
+                    self.assertEqual(path['actions'].shape, (MAX_PATH_LENGTH, 1))
+                    self.assertTrue(np.isfinite(path['actions']).all())
+
+    def test_vector_env_rejects_eval(self):
+        env = gym.vector.SyncVectorEnv([make_env] * NUM_ENVS)
+        with self.assertRaises(ValueError):
+            DynamicEnsembleMdpPathCollector(env, make_ensemble(), eval_flag=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from rlkit.data_management.performance_tracker import PerformanceTracker
+
+
+NUM_MEMBERS = 3
+WINDOW_SIZE = 7
+GAMMA = 0.9
+
+
+def expected_performance(rewards):
+    """
+    Ensemble.compute_performance of a reward history.
+    """
+    if len(rewards) < WINDOW_SIZE:
+        return 1.0
+    weights = np.array([GAMMA ** (WINDOW_SIZE - 1 - i) for i in range(WINDOW_SIZE)])
+    weights /= weights.sum()
+    return np.dot(np.array(rewards[-WINDOW_SIZE:]), weights)
+
+
+class TestPerformanceTracker(unittest.TestCase):
+
+    def assert_matches(self, tracker, histories):
+        np.testing.assert_allclose(
+            tracker.performances(), [expected_performance(rewards) for rewards in histories], rtol=1e-10)
+        for member, rewards in enumerate(histories):
+            np.testing.assert_array_equal(tracker.history(member), rewards[-WINDOW_SIZE:])
+
+    def test_matches_full_history(self):
+        rng = np.random.RandomState(0)
+        tracker = PerformanceTracker(NUM_MEMBERS, WINDOW_SIZE, GAMMA)
+        histories = [[] for _ in range(NUM_MEMBERS)]
+        for step in range(200):
+            member = rng.randint(NUM_MEMBERS)
+            if step % 10 == 0:
+                # Paths, some longer than the window
+                rewards = rng.randn(rng.randint(1, 2 * WINDOW_SIZE), 1)
+                tracker.extend(member, rewards)
+                histories[member].extend(rewards[:, 0])
+            else:
+                reward = rng.randn()
+                tracker.add(member, np.array([reward]) if step % 2 else reward)
+                histories[member].append(reward)
+            if step == 100:
+                tracker.reset(1)
+                histories[1] = []
+            self.assert_matches(tracker, histories)
+
+        tracker.remove(0)
+        self.assert_matches(tracker, histories[1:])
+
+    def test_add_member(self):
+        rng = np.random.RandomState(0)
+        tracker = PerformanceTracker(NUM_MEMBERS, WINDOW_SIZE, GAMMA, capacity=NUM_MEMBERS + 1)
+        rewards = tracker._rewards
+        histories = [list(rng.randn(length)) for length in [3, 10, 20]]
+        for member, member_rewards in enumerate(histories):
+            tracker.extend(member, member_rewards)
+        tracker.remove(1)
+        tracker.add_member()
+        tracker.add_member()
+        histories = [histories[0], histories[2], [], []]
+        self.assert_matches(tracker, histories)
+        # Within the capacity the rows are reused
+        self.assertIs(tracker._rewards, rewards)
+        for member in [2, 3]:
+            tracker.extend(member, rng.randn(WINDOW_SIZE))
+        self.assertEqual(len(tracker), NUM_MEMBERS + 1)
+        self.assertEqual(tracker.state_dict()['rewards'].shape, (NUM_MEMBERS + 1, WINDOW_SIZE))
+
+    def test_state_dict(self):
+        rng = np.random.RandomState(0)
+        histories = [list(rng.randn(length)) for length in [3, 10, 20]]
+        tracker = PerformanceTracker(NUM_MEMBERS, WINDOW_SIZE, GAMMA)
+        # The reward histories of older checkpoints
+        tracker.load_state_dict([np.array(rewards) for rewards in histories])
+        self.assert_matches(tracker, histories)
+
+        restored = PerformanceTracker(NUM_MEMBERS, WINDOW_SIZE, GAMMA)
+        restored.load_state_dict(tracker.state_dict())
+        self.assert_matches(restored, histories)
+
+        # Another window keeps the rewards both windows hold
+        larger = PerformanceTracker(NUM_MEMBERS, 2 * WINDOW_SIZE, GAMMA)
+        larger.load_state_dict(tracker.state_dict())
+        for member, rewards in enumerate(histories):
+            np.testing.assert_array_equal(larger.history(member), rewards[-WINDOW_SIZE:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import rlkit.torch.pytorch_util as ptu
+from rlkit.torch.core import eval_np
+from rlkit.torch.networks import ParameterArena
+from rlkit.torch.sac.policies import (
+    TanhGaussianPolicy,
+    EnsembleTanhGaussianPolicy,
+    EnsembleMemberPolicy,
+)
+
+
+ptu.set_gpu_mode(False)
+
+OBS_DIM = 5
+ACTION_DIM = 2
+NUM_ENSEMBLE = 3
+
+
+def make_policies():
+    torch.manual_seed(0)
+    policy = TanhGaussianPolicy([16, 16], OBS_DIM, ACTION_DIM, id=0, init_w=1)
+    ensemble_policy = EnsembleTanhGaussianPolicy(NUM_ENSEMBLE, [16, 16], OBS_DIM, ACTION_DIM, init_w=1)
+    member = EnsembleMemberPolicy(ensemble_policy, 1, id=1)
+    return policy, member
+
+
+class TestTanhGaussianInference(unittest.TestCase):
+
+    def setUp(self):
+        self.obs = np.random.RandomState(0).randn(OBS_DIM)
+
+    def assert_matches_forward(self, policy, deterministic, atol=0.0):
+        torch.manual_seed(1)
+        expected = eval_np(policy, self.obs[None], deterministic=deterministic)[0][0]
+        torch.manual_seed(1)
+        action, info = policy.get_action(self.obs, deterministic=deterministic)
+        np.testing.assert_allclose(action, expected, rtol=0, atol=atol)
+        self.assertEqual(info, {"policy_id": policy.id})
+
+    def test_matches_forward(self):
+        for policy in make_policies():
+            for deterministic in [True, False]:
+                with self.subTest(policy=type(policy).__name__, deterministic=deterministic):
+                    self.assert_matches_forward(policy, deterministic)
+
+    def test_numpy_forward(self):
+        for policy in make_policies():
+            with self.subTest(policy=type(policy).__name__):
+                policy.numpy_inference = True
+                self.assert_matches_forward(policy, True, atol=1e-6)
+                action, _ = policy.get_action(self.obs)
+                self.assertEqual(action.shape, (ACTION_DIM,))
+                self.assertTrue((np.abs(action) <= 1).all())
+
+    def test_follows_parameter_changes(self):
+        policy, member = make_policies()
+        for use_numpy in [False, True]:
+            with self.subTest(use_numpy=use_numpy):
+                policy.numpy_inference = member.numpy_inference = use_numpy
+                for p in [policy, member]:
+                    p.get_action(self.obs)
+                with torch.no_grad():
+                    for param in policy.parameters():
+                        param.add_(0.1)
+                    member.ensemble_network.last_fc.bias.data.add_(0.1)
+                self.assert_matches_forward(policy, True, atol=1e-6)
+                self.assert_matches_forward(member, True, atol=1e-6)
+
+                # Rebinding to a flat buffer and shrinking the ensemble move the weights
+                ParameterArena([policy])
+                member.ensemble_network.remove_member(0)
+                member.index = 0
+                self.assert_matches_forward(policy, True, atol=1e-6)
+                self.assert_matches_forward(member, True, atol=1e-6)
+                policy, member = make_policies()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,507 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import gymnasium as gym
+import numpy as np
+import torch
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import rlkit.torch.pytorch_util as ptu
+from rlkit.data_management.env_replay_buffer import DynamicEnsembleEnvReplayBuffer
+from rlkit.data_management.replay_buffer import EnsembleReplayBuffer
+from rlkit.data_management.simple_replay_buffer import _to_numpy
+from rlkit.envs.wrappers import NormalizedBoxEnv
+from rlkit.samplers.data_collector import DynamicEnsembleMdpPathCollector
+
+from examples.sunrise_ensemble import Ensemble
+
+
+ptu.set_gpu_mode(False)
+
+NUM_ENSEMBLE = 3
+BUFFER_SIZE = 50
+
+
+def make_env():
+    return NormalizedBoxEnv(gym.make('Pendulum-v1'))
+
+
+def make_buffer(env, observation_dtype='float32', single_copy_obs=False, storage='memory', log_dir=None,
+                **kwargs):
+    return DynamicEnsembleEnvReplayBuffer(
+        BUFFER_SIZE, env, NUM_ENSEMBLE, log_dir=log_dir or tempfile.mkdtemp(),
+        observation_dtype=observation_dtype, single_copy_obs=single_copy_obs, storage=storage, **kwargs
+    )
+
+
+def make_path(rng, length, num_ensemble=NUM_ENSEMBLE):
+    return dict(
+        observations=rng.randn(length, 3),
+        actions=rng.uniform(-1, 1, (length, 1)),
+        rewards=rng.randn(length, 1),
+        next_observations=rng.randn(length, 3),
+        terminals=rng.rand(length, 1) < 0.1,
+        masks=(rng.rand(length, num_ensemble) < 0.5).astype(float),
+        agent_infos=[{"policy_id": rng.randint(num_ensemble)} for _ in range(length)],
+        env_infos=[{} for _ in range(length)],
+    )
+
+
+def make_episode(rng, length, first_obs=None):
+    """
+    A path whose observations follow on from each other, starting from
+    first_obs if given.
+    """
+    path = make_path(rng, length)
+    observations = rng.randn(length + 1, 3)
+    if first_obs is not None:
+        observations[0] = first_obs
+    path["observations"] = observations[:-1]
+    path["next_observations"] = observations[1:]
+    return path
+
+
+def buffer_contents(buffer):
+    return [
+        buffer._observations, buffer._actions, buffer._rewards, buffer._terminals,
+        buffer._next_obs, buffer._host_mask(), buffer._top, buffer._size,
+    ] + buffer.get_policy_historic_performance()
+
+
+class TestEnsembleReplayBuffer(unittest.TestCase):
+
+    def assert_same_contents(self, result, expected):
+        for result_array, expected_array in zip(buffer_contents(result), buffer_contents(expected)):
+            np.testing.assert_array_equal(result_array, expected_array)
+
+    def test_add_path_matches_add_sample(self):
+        env = make_env()
+        rng = np.random.RandomState(0)
+        # Wraps around the end of the buffer, and the last path is longer
+        # than the whole buffer
+        paths = [make_path(rng, length) for length in [20, 25, 30, 1, 120]]
+        expected, result = make_buffer(env), make_buffer(env)
+        for path in paths:
+            EnsembleReplayBuffer.add_path(expected, path)
+            result.add_path(path)
+            self.assert_same_contents(result, expected)
+
+    def test_streamed_paths(self):
+        results = []
+        for stream in [False, True]:
+            env = make_env()
+            env.reset(seed=0)
+            buffer = make_buffer(env)
+            torch.manual_seed(0)
+            np.random.seed(0)
+            ensemble = Ensemble(
+                NUM_ENSEMBLE, env.observation_space, env.action_space, [16, 16],
+                diversity_threshold=0.2, diversity_critical_threshold=0.1, performance_gamma=0.95,
+                window_size=10, noise=0.1, retrain_steps=0,
+            )
+            collector = DynamicEnsembleMdpPathCollector(
+                env, ensemble, replay_buffer=buffer if stream else None,
+            )
+            paths = collector.collect_new_paths(20, 70, discard_incomplete_paths=False)
+            if not stream:
+                buffer.add_paths(paths)
+            results.append((buffer, paths))
+
+        (expected, expected_paths), (result, paths) = results
+        self.assert_same_contents(result, expected)
+        self.assertEqual(len(paths), len(expected_paths))
+        for path, expected_path in zip(paths, expected_paths):
+            # Streamed paths are read back from the float32 storage
+            for key in ['actions', 'rewards', 'terminals']:
+                np.testing.assert_array_equal(path[key], np.asarray(expected_path[key]).astype(path[key].dtype))
+            self.assertEqual(path['agent_infos'], expected_path['agent_infos'])
+
+        with self.assertRaises(ValueError):
+            collector.collect_new_paths(20, 10, discard_incomplete_paths=True)
+
+    def test_storage_dtypes(self):
+        env = make_env()
+        rng = np.random.RandomState(0)
+        path = make_path(rng, 40)
+        for observation_dtype, atol in [('float32', 1e-6), ('float16', 1e-2), ('bfloat16', 5e-2)]:
+            with self.subTest(observation_dtype=observation_dtype):
+                buffer = make_buffer(env, observation_dtype)
+                buffer.add_path(path)
+                self.assertEqual(buffer._mask.dtype, np.uint8)
+                self.assertEqual(buffer._actions.dtype, np.float32)
+                self.assertEqual(buffer._observations.itemsize, 4 if observation_dtype == 'float32' else 2)
+
+                batch = buffer.random_batch(10)
+                for key in ['observations', 'next_observations', 'actions', 'rewards', 'masks']:
+                    self.assertEqual(batch[key].dtype, np.float32)
+                np.testing.assert_allclose(
+                    buffer._decode_observations(buffer._observations[:40]), path['observations'],
+                    rtol=atol, atol=atol,
+                )
+                np.testing.assert_array_equal(buffer._host_mask()[:40], path['masks'])
+
+                buffer.save_buffer(0)
+                loaded = make_buffer(env, observation_dtype)
+                loaded.buffer_dir = buffer.buffer_dir
+                loaded.load_buffer([0])
+                self.assertEqual(loaded._observations.dtype, buffer._observations.dtype)
+                self.assertEqual(loaded._mask.dtype, np.uint8)
+                np.testing.assert_array_equal(loaded._observations[:40], buffer._observations[:40])
+
+    def test_unknown_observation_dtype(self):
+        with self.assertRaises(ValueError):
+            make_buffer(make_env(), 'int8')
+
+    def test_single_copy_obs(self):
+        env = make_env()
+        for observation_dtype in ['float32', 'bfloat16']:
+            with self.subTest(observation_dtype=observation_dtype):
+                rng = np.random.RandomState(0)
+                expected = make_buffer(env, observation_dtype)
+                result = make_buffer(env, observation_dtype, single_copy_obs=True)
+                self.assertIsNone(result._next_obs)
+                last_obs = None
+                # Episodes continued across paths and single steps, random
+                # paths, wraparound and a path longer than the buffer
+                for length, kind in [(10, 'continue'), (7, 'continue'), (1, 'sample'), (1, 'sample'),
+                                     (12, 'random'), (25, 'episode'), (3, 'continue'), (1, 'sample'),
+                                     (60, 'episode'), (30, 'continue'), (45, 'sample')]:
+                    if kind == 'random':
+                        path = make_path(rng, length)
+                    else:
+                        path = make_episode(rng, length, last_obs if kind != 'episode' else None)
+                    last_obs = path["next_observations"][-1]
+                    if kind == 'sample':
+                        for buffer in [expected, result]:
+                            for k in range(length):
+                                buffer.add_sample(
+                                    path["observations"][k], path["actions"][k], path["rewards"][k],
+                                    path["terminals"][k], path["next_observations"][k], path["masks"][k],
+                                    agent_info=path["agent_infos"][k], env_info=path["env_infos"][k],
+                                )
+                    else:
+                        expected.add_path(path)
+                        result.add_path(path)
+
+                    rows = np.arange(expected._size)
+                    np.testing.assert_array_equal(result._observations, expected._observations)
+                    np.testing.assert_array_equal(
+                        result._get_next_observations(rows), expected._next_obs[rows])
+                    # Only the rows not followed by their next observation
+                    # (and the newest row) are kept in the side table
+                    ends = np.any(expected._next_obs[rows] != expected._observations[(rows + 1) % BUFFER_SIZE], axis=1)
+                    self.assertLessEqual(len(result._episode_next_obs), ends.sum() + 1)
+                    np.random.seed(0)
+                    expected_batch = expected.random_batch(64)
+                    np.random.seed(0)
+                    batch = result.random_batch(64)
+                    for key, value in expected_batch.items():
+                        np.testing.assert_array_equal(batch[key], value)
+
+                result.save_buffer(0)
+                loaded = make_buffer(env, observation_dtype, single_copy_obs=True)
+                loaded.buffer_dir = result.buffer_dir
+                loaded.load_buffer([0])
+                np.testing.assert_array_equal(
+                    loaded._get_next_observations(rows), expected._next_obs[rows])
+                self.assertLessEqual(len(loaded._episode_next_obs), len(result._episode_next_obs) + 1)
+
+    def test_memmap_storage(self):
+        env = make_env()
+        rng = np.random.RandomState(0)
+        log_dir = tempfile.mkdtemp()
+        expected = make_buffer(env)
+        result = make_buffer(env, storage='memmap', log_dir=log_dir)
+        self.assertIsInstance(result._observations, np.memmap)
+        for length in [20, 25, 30]:
+            path = make_path(rng, length)
+            expected.add_path(path)
+            result.add_path(path)
+        for buffer in [expected, result]:
+            buffer.update_mask(1, torch.ones(BUFFER_SIZE))
+            buffer.remove_policy(0)
+        self.assertIsInstance(result._mask, np.memmap)
+        self.assert_same_contents(result, expected)
+        np.random.seed(0)
+        expected_batch = expected.random_batch(16)
+        np.random.seed(0)
+        for key, value in result.random_batch(16).items():
+            np.testing.assert_array_equal(value, expected_batch[key])
+
+        # A new run in the same directory restores the rows as they were at
+        # each checkpoint, although later rows overwrote them in the files
+        snapshots = {}
+        for epoch, length in [(3, 0), (4, 40)]:
+            if length > 0:
+                result.add_path(make_path(rng, length, NUM_ENSEMBLE - 1))
+            result.save_buffer(epoch)
+            snapshots[epoch] = [np.copy(array) for array in buffer_contents(result)]
+        # Rows added after the last checkpoint, e.g. before a crash
+        result.add_path(make_path(rng, 30, NUM_ENSEMBLE - 1))
+        for epoch in [3, 4]:
+            reopened = DynamicEnsembleEnvReplayBuffer(
+                BUFFER_SIZE, env, NUM_ENSEMBLE - 1, log_dir=log_dir, storage='memmap')
+            reopened.load_buffer([epoch])
+            self.assertIsInstance(reopened._observations, np.memmap)
+            for result_array, expected_array in zip(buffer_contents(reopened), snapshots[epoch]):
+                np.testing.assert_array_equal(result_array, expected_array)
+
+        # Checkpoints of in-RAM buffers load into memmap storage
+        expected.save_buffer(0)
+        converted = DynamicEnsembleEnvReplayBuffer(
+            BUFFER_SIZE, env, NUM_ENSEMBLE - 1, log_dir=tempfile.mkdtemp(), storage='memmap')
+        converted.buffer_dir = expected.buffer_dir
+        converted.load_buffer([0])
+        self.assertIsInstance(converted._observations, np.memmap)
+        np.testing.assert_array_equal(converted._observations, expected._observations)
+
+        with self.assertRaises(ValueError):
+            make_buffer(env, single_copy_obs=True, storage='memmap')
+
+    def test_torch_storage(self):
+        env = make_env()
+        for observation_dtype in ['float32', 'bfloat16']:
+            with self.subTest(observation_dtype=observation_dtype):
+                expected = make_buffer(env, observation_dtype)
+                result = make_buffer(env, observation_dtype, storage='torch')
+                self.assertIsInstance(result._observations, torch.Tensor)
+                for buffer in [expected, result]:
+                    for length in [20, 25, 30]:
+                        buffer.add_path(make_path(np.random.RandomState(length), length))
+                    # Row by row too
+                    EnsembleReplayBuffer.add_path(buffer, make_path(np.random.RandomState(3), 3))
+                    buffer.update_mask(1, torch.ones(BUFFER_SIZE))
+                    buffer.remove_policy(0)
+
+                batch = result.random_batch(16)
+                for key in ['observations', 'next_observations', 'actions', 'rewards', 'terminals', 'masks']:
+                    self.assertIsInstance(batch[key], torch.Tensor)
+                    self.assertEqual(batch[key].dtype, torch.float32)
+                    self.assertEqual(len(batch[key]), 16)
+                np.testing.assert_array_equal(batch['masks'][:, 0], 1)
+                observations = expected._decode_observations(expected._observations)
+                for observation in ptu.get_numpy(batch['observations']):
+                    self.assertTrue(np.any(np.all(observations == observation, axis=1)))
+
+                # The checkpoints are interchangeable with those of in-RAM buffers
+                expected.save_buffer(0)
+                result.save_buffer(1)
+                payloads = [
+                    torch.load(Path(buffer.buffer_dir, 'replay_%d.pt' % epoch), weights_only=False)
+                    for buffer, epoch in [(expected, 0), (result, 1)]
+                ]
+                for result_array, expected_array in zip(*payloads):
+                    np.testing.assert_array_equal(result_array, expected_array)
+                loaded = DynamicEnsembleEnvReplayBuffer(
+                    BUFFER_SIZE, env, NUM_ENSEMBLE - 1, log_dir=tempfile.mkdtemp(),
+                    observation_dtype=observation_dtype, storage='torch')
+                loaded.buffer_dir = expected.buffer_dir
+                loaded.load_buffer([0])
+                np.testing.assert_array_equal(loaded._host_copy(loaded._observations), payloads[0][0])
+                np.testing.assert_array_equal(loaded._host_mask(), payloads[0][5])
+
+        with self.assertRaises(ValueError):
+            make_buffer(env, single_copy_obs=True, storage='torch')
+
+    def test_random_batches(self):
+        env = make_env()
+        for storage, single_copy_obs in [('memory', False), ('memory', True), ('torch', False)]:
+            with self.subTest(storage=storage, single_copy_obs=single_copy_obs):
+                buffer = make_buffer(env, storage=storage, single_copy_obs=single_copy_obs)
+                rng = np.random.RandomState(0)
+                for length in [20, 25, 30]:
+                    buffer.add_path(make_episode(rng, length))
+                np.random.seed(0)
+                torch.manual_seed(0)
+                batches = buffer.random_batches(3, 16)
+                np.random.seed(0)
+                torch.manual_seed(0)
+                indices = torch.randint(0, buffer._size, (3 * 16,)).reshape(3, 16)
+                for i in range(3):
+                    if storage == 'torch':
+                        expected = buffer._gather_torch(indices[i])
+                    else:
+                        expected = buffer.random_batch(16)
+                    self.assertEqual(sorted(batches.keys()), sorted(expected.keys()))
+                    for key, value in expected.items():
+                        self.assertEqual(tuple(batches[key].shape), (3,) + tuple(value.shape))
+                        np.testing.assert_array_equal(batches[key][i], value)
+
+    def test_packed_mask(self):
+        env = make_env()
+        for storage in ['memory', 'memmap', 'torch']:
+            with self.subTest(storage=storage):
+                buffer = make_buffer(env, storage=storage)
+                path = make_path(np.random.RandomState(0), 30)
+                buffer.add_path(path)
+                EnsembleReplayBuffer.add_path(buffer, make_path(np.random.RandomState(1), 5))
+                expected = np.concatenate([path['masks'], make_path(np.random.RandomState(1), 5)['masks']])
+                self.assertEqual(buffer._mask.shape, (BUFFER_SIZE, 1))
+                np.testing.assert_array_equal(buffer._host_mask(), expected)
+
+                # Removing a member frees its slot, the other bits stay in place
+                packed = np.copy(_to_numpy(buffer._mask))
+                buffer.remove_policy(1)
+                np.testing.assert_array_equal(_to_numpy(buffer._mask), packed)
+                expected = np.delete(expected, 1, axis=1)
+                np.testing.assert_array_equal(buffer._host_mask(), expected)
+
+                new_mask = torch.rand(BUFFER_SIZE) < 0.5
+                buffer.update_mask(1, new_mask)
+                expected[:, 1] = ptu.get_numpy(new_mask)[:len(expected)]
+                np.testing.assert_array_equal(buffer._host_mask(), expected)
+                indices = np.random.RandomState(0).randint(0, len(expected), 16)
+                if storage == 'torch':
+                    batch = buffer._gather_torch(torch.as_tensor(indices))
+                else:
+                    batch = buffer._gather(indices)
+                np.testing.assert_array_equal(_to_numpy(batch['masks']), expected[indices])
+
+    def test_add_policy(self):
+        env = make_env()
+        for storage in ['memory', 'memmap', 'torch']:
+            with self.subTest(storage=storage):
+                buffer = make_buffer(env, storage=storage, member_sampling=True, max_num_ensemble=NUM_ENSEMBLE + 1)
+                buffer.add_path(make_path(np.random.RandomState(0), 30))
+                mask_array, expected = buffer._mask, buffer._host_mask()
+                # The removed policy's slot and rows are reused
+                buffer.remove_policy(0)
+                new_masks = []
+                for _ in range(2):
+                    new_masks.append(torch.rand(BUFFER_SIZE) < 0.5)
+                    buffer.add_policy(new_masks[-1])
+                self.assertIs(buffer._mask, mask_array)
+                self.assertEqual(len(buffer.get_policy_performances()), NUM_ENSEMBLE + 1)
+                expected = np.concatenate(
+                    [expected[:, 1:]] + [ptu.get_numpy(mask)[:30, None] for mask in new_masks], axis=1)
+                np.testing.assert_array_equal(buffer._host_mask(), expected)
+                self.assert_member_rows(buffer)
+
+                buffer.add_path(make_path(np.random.RandomState(1), 30, NUM_ENSEMBLE + 1))
+                self.assert_member_rows(buffer)
+                self.assertEqual(buffer.random_batch(8)['masks'].shape, (8, NUM_ENSEMBLE + 1))
+                with self.assertRaises(ValueError):
+                    buffer.add_policy(torch.ones(BUFFER_SIZE))
+
+    def assert_member_rows(self, buffer):
+        mask = buffer._host_mask()
+        self.assertEqual(len(buffer._member_rows), mask.shape[1])
+        for member, member_rows in enumerate(buffer._member_rows):
+            rows = member_rows.rows[:member_rows.count]
+            np.testing.assert_array_equal(np.sort(rows), np.flatnonzero(mask[:, member]))
+            np.testing.assert_array_equal(member_rows.positions[rows], np.arange(member_rows.count))
+            self.assertEqual(np.sum(member_rows.positions >= 0), member_rows.count)
+
+    def test_member_sampling(self):
+        env = make_env()
+        for storage in ['memory', 'torch']:
+            with self.subTest(storage=storage):
+                buffer = make_buffer(env, storage=storage, member_sampling=True)
+                # Wraps around the end of the buffer
+                for length in [20, 25, 30]:
+                    buffer.add_path(make_path(np.random.RandomState(length), length))
+                    self.assert_member_rows(buffer)
+                # Row by row too
+                EnsembleReplayBuffer.add_path(buffer, make_path(np.random.RandomState(3), 10))
+                self.assert_member_rows(buffer)
+                buffer.update_mask(1, torch.bernoulli(torch.full((BUFFER_SIZE,), 0.5)))
+                self.assert_member_rows(buffer)
+                buffer.remove_policy(0)
+                self.assert_member_rows(buffer)
+
+                batch = buffer.random_member_batch(16)
+                np.testing.assert_array_equal(_to_numpy(batch['masks']), np.ones((NUM_ENSEMBLE - 1, 16)))
+                observations = buffer._host_copy(buffer._observations)
+                mask = buffer._host_mask()
+                for key in ['observations', 'next_observations', 'actions', 'rewards', 'terminals']:
+                    self.assertEqual(batch[key].shape[:2], (NUM_ENSEMBLE - 1, 16))
+                for member in range(NUM_ENSEMBLE - 1):
+                    for observation in np.asarray(_to_numpy(batch['observations'][member])):
+                        rows = np.flatnonzero(np.all(observations == observation, axis=1))
+                        self.assertTrue(np.any(mask[rows, member]))
+
+                batches = buffer.random_member_batches(3, 16)
+                for key, value in batch.items():
+                    self.assertEqual(tuple(batches[key].shape), (3,) + tuple(value.shape))
+                for member in range(NUM_ENSEMBLE - 1):
+                    observations_in_mask = observations[mask[:, member] != 0]
+                    for observation in np.asarray(_to_numpy(batches['observations'][:, member])).reshape(-1, 3):
+                        self.assertTrue(np.any(np.all(observations_in_mask == observation, axis=1)))
+
+                buffer.save_buffer(0)
+                loaded = DynamicEnsembleEnvReplayBuffer(
+                    BUFFER_SIZE, env, NUM_ENSEMBLE - 1, log_dir=tempfile.mkdtemp(), storage=storage,
+                    member_sampling=True)
+                loaded.buffer_dir = buffer.buffer_dir
+                loaded.load_buffer([0])
+                self.assert_member_rows(loaded)
+
+                # A member without rows is left out through its mask
+                buffer.update_mask(0, torch.zeros(BUFFER_SIZE))
+                self.assert_member_rows(buffer)
+                masks = _to_numpy(buffer.random_member_batch(16)['masks'])
+                np.testing.assert_array_equal(masks, [np.zeros(16)] + [np.ones(16)] * (NUM_ENSEMBLE - 2))
+                masks = _to_numpy(buffer.random_member_batches(3, 16)['masks'])
+                np.testing.assert_array_equal(masks[:, 0], np.zeros((3, 16)))
+                np.testing.assert_array_equal(masks[:, 1:], np.ones((3, NUM_ENSEMBLE - 2, 16)))
+
+    def test_incremental_checkpoints(self):
+        env = make_env()
+        for single_copy_obs in [False, True]:
+            with self.subTest(single_copy_obs=single_copy_obs):
+                rng = np.random.RandomState(0)
+                log_dir = tempfile.mkdtemp()
+                buffer = make_buffer(
+                    env, single_copy_obs=single_copy_obs, log_dir=log_dir,
+                    incremental_checkpoints=True, keep_last_checkpoints=2, keep_checkpoint_every=3,
+                )
+                snapshots = {}
+                last_obs = None
+                for epoch, length in enumerate([10, 15, 0, 30, 8, 70, 12], 1):
+                    if length > 0:
+                        path = make_episode(rng, length, last_obs)
+                        last_obs = path["next_observations"][-1]
+                        buffer.add_path(path)
+                    if epoch == 4:
+                        buffer.update_mask(0, torch.zeros(BUFFER_SIZE))
+                    buffer.save_buffer(epoch)
+                    snapshots[epoch] = (
+                        [np.copy(array) for array in buffer_contents(buffer)],
+                        buffer._get_next_observations(np.arange(buffer._size)),
+                    )
+
+                files = set(os.listdir(buffer.buffer_dir))
+                self.assertEqual({f for f in files if f.startswith('replay')},
+                                 {'replay_3.pt', 'replay_6.pt', 'replay_7.pt'})
+                self.assertEqual({f for f in files if f.startswith('policy_rewards')},
+                                 {'policy_rewards_3.pt', 'policy_rewards_6.pt', 'policy_rewards_7.pt'})
+                # Epoch 6 wrote the whole ring, so the older chunks are only
+                # kept for epoch 3
+                self.assertEqual({f for f in files if f.startswith('chunk')},
+                                 {'chunk_0_10.npz', 'chunk_10_25.npz', 'chunk_83_133.npz', 'chunk_133_145.npz'})
+
+                for epoch in [3, 6, 7]:
+                    loaded = make_buffer(
+                        env, single_copy_obs=single_copy_obs, log_dir=log_dir, incremental_checkpoints=True)
+                    # The checkpoints retention deleted are skipped
+                    self.assertEqual(loaded.load_buffer([1, 2, epoch]), epoch)
+                    contents, next_obs = snapshots[epoch]
+                    for result_array, expected_array in zip(buffer_contents(loaded), contents):
+                        np.testing.assert_array_equal(result_array, expected_array)
+                    np.testing.assert_array_equal(loaded._get_next_observations(np.arange(loaded._size)), next_obs)
+
+                self.assertIsNone(loaded.load_buffer([1, 2]))
+
+                # Saving after a resume only writes the new transitions
+                loaded.add_path(make_path(rng, 5))
+                loaded.save_buffer(8)
+                self.assertIn('chunk_145_150.npz', os.listdir(buffer.buffer_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
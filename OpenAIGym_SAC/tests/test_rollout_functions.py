@@ -0,0 +1,144 @@
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+import torch
+from gymnasium.spaces import Box
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import rlkit.torch.pytorch_util as ptu
+from rlkit.samplers.rollout_functions import get_ensemble_eval_actions, get_ucb_action
+
+from examples.sunrise_ensemble import Ensemble
+
+
+ptu.set_gpu_mode(False)
+
+OBS_DIM = 5
+ACTION_DIM = 2
+NUM_ENSEMBLE = 4
+
+
+def make_ensemble(vectorized=False):
+    torch.manual_seed(0)
+    return Ensemble(
+        NUM_ENSEMBLE,
+        Box(-np.inf, np.inf, (OBS_DIM,)),
+        Box(-1, 1, (ACTION_DIM,)),
+        [16, 16],
+        diversity_threshold=0.2,
+        diversity_critical_threshold=0.1,
+        performance_gamma=0.95,
+        window_size=10,
+        noise=0.1,
+        retrain_steps=0,
+        vectorized=vectorized,
+    )
+
+
+def loop_ucb_action(o, agent, critic1, critic2, inference_type, feedback_type):
+    """
+    The original selection of ensemble_ucb_rollout: get_action and a UCB
+    score for one policy at a time.
+    """
+    num_ensemble = len(agent)
+    a_max, ucb_max, agent_info_max = None, None, None
+    for en_index in range(num_ensemble):
+        _a, agent_info = agent[en_index].get_action(o)
+        obs = ptu.from_numpy(o).reshape(1, -1)
+        policy_action = ptu.from_numpy(_a).reshape(1, -1)
+        with torch.no_grad():
+            if feedback_type == 0 or feedback_type == 2:
+                L_target_Q = [critic1[en_index](obs, policy_action), critic2[en_index](obs, policy_action)]
+            else:
+                L_target_Q = []
+                for qf1, qf2 in zip(critic1, critic2):
+                    L_target_Q += [qf1(obs, policy_action), qf2(obs, policy_action)]
+        mean_Q = sum(L_target_Q) / len(L_target_Q)
+        var_Q = sum((target_Q - mean_Q)**2 for target_Q in L_target_Q) / len(L_target_Q)
+        ucb_score = mean_Q + inference_type * torch.sqrt(var_Q)
+        if en_index == 0 or ucb_score > ucb_max:
+            a_max, ucb_max, agent_info_max = _a, ucb_score, agent_info
+    return a_max, agent_info_max
+
+
+class TestUCBAction(unittest.TestCase):
+
+    def test_matches_loop(self):
+        ensemble = make_ensemble()
+        networks = (ensemble.get_policies(), ensemble.get_critic1s(), ensemble.get_critic2s())
+        rng = np.random.RandomState(0)
+        for feedback_type in range(4):
+            for step in range(5):
+                with self.subTest(feedback_type=feedback_type, step=step):
+                    o = rng.randn(OBS_DIM).astype(np.float32)
+                    torch.manual_seed(step)
+                    expected, expected_info = loop_ucb_action(o, *networks, 1.0, feedback_type)
+                    torch.manual_seed(step)
+                    action, info = get_ucb_action(o, *networks, 1.0, feedback_type)
+                    np.testing.assert_allclose(action, expected, rtol=1e-6, atol=1e-6)
+                    self.assertEqual(info, expected_info)
+
+    def test_vectorized_ensemble(self):
+        ensemble = make_ensemble(vectorized=True)
+        # Pin log_std to its minimum so that the batched and the per-member
+        # sampling give the same actions.
+        with torch.no_grad():
+            ensemble.policy.last_fc_log_std.weight.zero_()
+            ensemble.policy.last_fc_log_std.bias.fill_(-100)
+        networks = (ensemble.get_policies(), ensemble.get_critic1s(), ensemble.get_critic2s())
+        o = np.random.RandomState(0).randn(OBS_DIM).astype(np.float32)
+        for feedback_type in range(4):
+            with self.subTest(feedback_type=feedback_type):
+                expected, expected_info = loop_ucb_action(o, *networks, 1.0, feedback_type)
+                action, info = get_ucb_action(o, *networks, 1.0, feedback_type, ensemble=ensemble)
+                np.testing.assert_allclose(action, expected, rtol=1e-6, atol=1e-6)
+                self.assertEqual(info, expected_info)
+
+
+class TestEnsembleEvalActions(unittest.TestCase):
+
+    def setUp(self):
+        self.obs = np.random.RandomState(0).randn(3, OBS_DIM).astype(np.float32)
+
+    def eval_actions(self, ensemble, aggregation, batched):
+        return get_ensemble_eval_actions(
+            self.obs,
+            ensemble.get_eval_policies(),
+            aggregation=aggregation,
+            critic1=ensemble.get_critic1s(),
+            critic2=ensemble.get_critic2s(),
+            ensemble=ensemble if batched else None,
+        )
+
+    def test_mean_matches_loop(self):
+        for vectorized in [False, True]:
+            with self.subTest(vectorized=vectorized):
+                ensemble = make_ensemble(vectorized=vectorized)
+                expected = np.stack([
+                    sum(policy.get_action(o)[0] for policy in ensemble.get_eval_policies()) / NUM_ENSEMBLE
+                    for o in self.obs
+                ])
+                for batched in [False, True]:
+                    actions, index = self.eval_actions(ensemble, 'mean', batched)
+                    np.testing.assert_allclose(actions, expected, rtol=1e-5, atol=1e-6)
+                    self.assertIsNone(index)
+
+    def test_member_aggregations(self):
+        ensemble = make_ensemble()
+        member_actions = np.stack([policy.get_actions(self.obs) for policy in ensemble.get_eval_policies()])
+        actions, _ = self.eval_actions(ensemble, 'median', False)
+        np.testing.assert_allclose(actions, np.sort(member_actions, axis=0)[(NUM_ENSEMBLE - 1) // 2], rtol=1e-6)
+        for aggregation in ['ucb', 'vote']:
+            with self.subTest(aggregation=aggregation):
+                actions, index = self.eval_actions(ensemble, aggregation, False)
+                np.testing.assert_allclose(actions, member_actions[index, np.arange(len(self.obs))], rtol=1e-6)
+                batched_actions, batched_index = self.eval_actions(ensemble, aggregation, True)
+                np.testing.assert_array_equal(batched_index, index)
+
+
+if __name__ == '__main__':
+    unittest.main()
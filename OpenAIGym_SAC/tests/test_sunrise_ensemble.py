@@ -0,0 +1,144 @@
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import torch
+from gymnasium.spaces import Box
+
+# Add OpenAIGym_SAC to sys.path, as the example scripts do
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import rlkit.torch.pytorch_util as ptu
+
+import examples.sunrise_ensemble as sunrise_ensemble
+from examples.sunrise_ensemble import Ensemble
+
+
+ptu.set_gpu_mode(False)
+
+OBS_DIM = 5
+ACTION_DIM = 2
+NUM_ENSEMBLE = 4
+NUM_SAMPLES = 100
+
+
+def make_ensemble(vectorized=False, retrain_steps=0, diversity_critical_threshold=0.1, max_size=None):
+    torch.manual_seed(0)
+    return Ensemble(
+        NUM_ENSEMBLE,
+        Box(-np.inf, np.inf, (OBS_DIM,)),
+        Box(-1, 1, (ACTION_DIM,)),
+        [16, 16],
+        diversity_threshold=0.2,
+        diversity_critical_threshold=diversity_critical_threshold,
+        performance_gamma=0.95,
+        window_size=10,
+        noise=0.1,
+        retrain_steps=retrain_steps,
+        vectorized=vectorized,
+        max_size=max_size,
+    )
+
+
+def loop_diversity(ensemble, policy_actions, learner_idx):
+    """
+    The original one pair at a time implementation of compute_diversity.
+    """
+    a_i = policy_actions[learner_idx]
+    return np.min([
+        np.mean(np.linalg.norm(a_i - a_j, axis=1)) / ensemble.max_dist
+        for j, a_j in enumerate(policy_actions)
+        if j != learner_idx
+    ])
+
+
+class TestGetAllActions(unittest.TestCase):
+
+    def test_matches_eval_policies(self):
+        samples = np.random.RandomState(0).randn(NUM_SAMPLES, OBS_DIM)
+        for vectorized in [False, True]:
+            with self.subTest(vectorized=vectorized):
+                ensemble = make_ensemble(vectorized=vectorized)
+                # Several chunks, the last one partial
+                actions = ensemble.get_all_actions(samples, chunk_size=30)
+                self.assertEqual(actions.shape, (NUM_ENSEMBLE, NUM_SAMPLES, ACTION_DIM))
+                for policy, policy_actions in zip(ensemble.get_eval_policies(), actions):
+                    np.testing.assert_allclose(policy_actions, policy.get_actions(samples), rtol=1e-5, atol=1e-6)
+
+
+class TestDiversityMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.samples = np.random.RandomState(0).randn(NUM_SAMPLES, OBS_DIM).astype(np.float32)
+
+    def test_matches_loop(self):
+        ensemble = make_ensemble()
+        policy_actions = np.random.RandomState(1).uniform(-1, 1, (NUM_ENSEMBLE, NUM_SAMPLES, ACTION_DIM))
+        # Several chunks of states
+        with mock.patch.object(sunrise_ensemble, 'DIVERSITY_CHUNK_SIZE', 7 * NUM_ENSEMBLE ** 2):
+            diversity = ensemble.compute_diversity_matrix(policy_actions)
+        self.assertEqual(diversity.shape, (NUM_ENSEMBLE, NUM_ENSEMBLE))
+        np.testing.assert_array_equal(np.diag(diversity), np.inf)
+        np.testing.assert_allclose(diversity, diversity.T)
+        for i in range(NUM_ENSEMBLE):
+            expected = loop_diversity(ensemble, policy_actions, i)
+            self.assertAlmostEqual(diversity[i].min(), expected, places=10)
+            self.assertAlmostEqual(ensemble.compute_diversity(policy_actions, i), expected, places=10)
+
+    def test_removal_check(self):
+        ensemble = make_ensemble()
+        _, debug = ensemble.removal_check(self.samples, np.ones(NUM_ENSEMBLE))
+        policy_actions = [policy.get_actions(self.samples) for policy in ensemble.get_eval_policies()]
+        np.testing.assert_allclose(
+            debug["diversities"],
+            [loop_diversity(ensemble, policy_actions, i) for i in range(NUM_ENSEMBLE)],
+            rtol=1e-6,
+        )
+
+    def test_replace_policy_updates_one_row(self):
+        for vectorized in [False, True]:
+            with self.subTest(vectorized=vectorized):
+                ensemble = make_ensemble(vectorized=vectorized, diversity_critical_threshold=0)
+                ensemble.removal_check(self.samples, np.ones(NUM_ENSEMBLE))
+                removed, div = ensemble.replace_policy(2, self.samples, None, None)
+                self.assertIsNone(removed)
+
+                expected = ensemble.compute_diversity_matrix(np.stack([
+                    policy.get_actions(self.samples) for policy in ensemble.get_eval_policies()
+                ]))
+                np.testing.assert_allclose(ensemble.diversity_matrix, expected, rtol=1e-6)
+                self.assertAlmostEqual(div, expected[2].min(), places=6)
+
+                ensemble.remove_policy(1)
+                np.testing.assert_allclose(
+                    ensemble.diversity_matrix, np.delete(np.delete(expected, 1, axis=0), 1, axis=1), rtol=1e-6)
+
+    def test_add_learner(self):
+        for vectorized in [False, True]:
+            with self.subTest(vectorized=vectorized):
+                ensemble = make_ensemble(vectorized=vectorized, max_size=NUM_ENSEMBLE + 1)
+                ensemble.removal_check(self.samples, np.ones(NUM_ENSEMBLE))
+                self.assertEqual(ensemble.add_learner(2), NUM_ENSEMBLE)
+                self.assertEqual(ensemble.get_policies()[-1].id, NUM_ENSEMBLE)
+
+                actions = ensemble.get_all_actions(self.samples)
+                self.assertEqual(actions.shape[0], NUM_ENSEMBLE + 1)
+                np.testing.assert_allclose(ensemble.diversity_matrix, ensemble.compute_diversity_matrix(actions), rtol=1e-6)
+                # A perturbed copy of its source
+                self.assertGreater(ensemble.diversity_matrix[-1, 2], 0)
+                with self.assertRaises(ValueError):
+                    ensemble.add_learner(0)
+
+    def test_replace_policy_on_new_samples(self):
+        ensemble = make_ensemble(diversity_critical_threshold=np.inf)
+        ensemble.removal_check(self.samples, np.ones(NUM_ENSEMBLE))
+        removed, _ = ensemble.replace_policy(0, self.samples[:10], None, None)
+        self.assertEqual(removed, 0)
+        self.assertEqual(len(ensemble), NUM_ENSEMBLE - 1)
+        self.assertEqual(ensemble.diversity_matrix.shape, (NUM_ENSEMBLE - 1, NUM_ENSEMBLE - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()